@@ -96,6 +96,7 @@ setup(
     extras_require={  # Optional
         'dev': ['check-manifest'],
         'test': ['coverage'],
+        'zstd': ['zstandard'],
     },
 
     # List additional URLs that are relevant to your project as a dict.
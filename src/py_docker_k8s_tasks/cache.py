@@ -0,0 +1,54 @@
+import os
+import json
+import time
+import hashlib
+from .lazy import lazy_import
+
+tempfile = lazy_import("tempfile")
+
+CACHE_DIRNAME = "py-docker-k8s-tasks"
+
+
+def cache_dir(namespace):
+    base = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, CACHE_DIRNAME, namespace)
+
+
+def cache_path(namespace, *key):
+    digest = hashlib.sha256("\0".join(key).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir(namespace), f"{digest}.json")
+
+
+def load(namespace, *key):
+    """Returns the entry stored for key, or None if missing or unreadable"""
+    try:
+        with open(cache_path(namespace, *key), "rt") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def store(namespace, entry, *key):
+    """Atomically writes the entry, readable only by the current user"""
+    path = cache_path(namespace, *key)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wt") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return entry
+
+
+def delete(namespace, *key):
+    try:
+        os.unlink(cache_path(namespace, *key))
+    except FileNotFoundError:
+        pass
+
+
+def is_fresh(entry, ttl, field="fetched_at"):
+    return entry is not None and time.time() - entry.get(field, 0) < ttl
@@ -0,0 +1,90 @@
+"""Runs a batch of commands in one process, sent to the container with python -c
+
+The runner reads the commands from stdin, one JSON argv list per line. manage.py commands run
+in the runner process with runpy, so Django imports the project and loads its settings and
+apps once for the whole batch. Other commands run as subprocesses. After each command the
+runner writes a STATUS_MARKER line with the command index and its exit status to stdout.
+
+StatusReader, on the host side, takes those lines out of the output.
+"""
+import sys
+import json
+import runpy
+import traceback
+import subprocess
+
+STATUS_MARKER = "@@py-docker-k8s-tasks-status@@"
+
+
+def run_manage(argv):
+    """Runs a manage.py command in this process, returns its exit status"""
+    sys.argv = list(argv)
+    try:
+        runpy.run_path(argv[0], run_name="__main__")
+    except SystemExit as err:
+        if err.code is None or isinstance(err.code, int):
+            return err.code or 0
+        print(err.code, file=sys.stderr)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def run_command(argv):
+    if argv[0].endswith("manage.py"):
+        return run_manage(argv)
+    return subprocess.call(argv)
+
+
+def main():
+    commands = [json.loads(line) for line in sys.stdin if line.strip()]
+    for index, argv in enumerate(commands):
+        exited = run_command(argv)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        print(STATUS_MARKER, json.dumps({"index": index, "exited": exited}), flush=True)
+
+
+def source():
+    """The runner code, for python -c"""
+    with open(__file__, "rt") as f:
+        return f.read()
+
+
+class StatusReader:
+    """Binary stream that copies the runner output to out and keeps the command statuses"""
+
+    def __init__(self, out):
+        self.out = out
+        self.exit_codes = {}
+        self._partial = b""
+        self._marker = STATUS_MARKER.encode()
+
+    def write(self, data):
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()  # Held until it ends, it could be the start of a marker
+        for line in lines:
+            before, marker, status = line.partition(self._marker)
+            if not marker:
+                self.out.write(line + b"\n")
+                continue
+            if before:  # The command output didn't end with a newline
+                self.out.write(before + b"\n")
+            status = json.loads(status)
+            self.exit_codes[status["index"]] = status["exited"]
+        return len(data)
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        if self._partial:
+            self.out.write(self._partial)
+            self._partial = b""
+        self.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,64 @@
+import io
+import sys
+import json
+import shlex
+import subprocess
 from invoke import task
-from .docker_tasks import docker_exec
+from . import django_runner
+from .docker_tasks import docker_exec, _docker_engine, _docker_exec_envs
+
+
+def _run_batch(c, container, argv, stdin, out):
+    """Runs argv in the container with stdin bytes as input and its stdout going to out,
+    returns its exit code"""
+    engine = _docker_engine(c)
+    envs = _docker_exec_envs({})
+    if engine is not None:
+        return engine.exec_run(container, argv, env=envs, stdin=io.BytesIO(stdin), stdout=out)
+    env_args = [arg for k, v in envs.items() for arg in ("--env", f"{k}={v}")]
+    proc = subprocess.Popen(["docker", "exec", "-i"] + env_args + [container] + argv,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc.stdin.write(stdin)  # A few lines, can't fill the pipe
+    proc.stdin.close()
+    for chunk in iter(lambda: proc.stdout.read1(65536), b""):
+        out.write(chunk)
+        out.flush()
+    proc.stdout.close()
+    return proc.wait()
+
+
+def manage_batch(c, commands, container=None):
+    """Runs several commands (argv lists) in one docker exec, returns their exit codes
+
+    The manage.py commands share a single Python process, so Django starts once for all of
+    them (see django_runner). Prints the exit status of each command and raises RuntimeError
+    if any of them failed.
+    """
+    container = container or c.config.container
+    python = c.config.get("django_python", "python")
+    stdin = "".join(json.dumps(argv) + "\n" for argv in commands).encode("utf-8")
+    sys.stdout.flush()  # The command output goes straight to the binary buffer
+    statuses = django_runner.StatusReader(sys.stdout.buffer)
+    try:
+        exit_code = _run_batch(c, container, [python, "-c", django_runner.source()], stdin,
+                               statuses)
+    finally:
+        statuses.close()
+
+    exit_codes = [statuses.exit_codes.get(i) for i in range(len(commands))]
+    names = [" ".join(argv) for argv in commands]
+    width = max(len(name) for name in names + ["COMMAND"])
+    print("{}  {}".format("COMMAND".ljust(width), "EXIT"))
+    for name, exited in zip(names, exit_codes):
+        print("{}  {}".format(name.ljust(width), "not run" if exited is None else exited))
+    failed = [name for name, exited in zip(names, exit_codes) if exited != 0]
+    if failed:
+        raise RuntimeError("Failed (batch exit code {}): {}".format(exit_code, ", ".join(failed)))
+    return exit_codes
+
+
+def _languages(language):
+    return [lang.strip() for lang in language.split(",") if lang.strip()]
 
 
 @task
@@ -55,20 +114,33 @@ def manage(c, command):
     docker_exec(c, "./manage.py {}".format(command))
 
 
+@task(iterable=["command"])
+def manage_many(c, command):
+    """Runs several manage.py commands (one per --command) in one process in the container"""
+    manage_batch(c, [["./manage.py"] + shlex.split(cmd) for cmd in command])
+
+
 @task
 def makemessages(c, language=None):
+    """Makes the messages of each language (comma separated, defaults to
+    config.translations.languages), all in one process in the container"""
     if language:
-        languages = [language]
+        languages = _languages(language)
     else:
         languages = c.config.translations.languages
-    extra_params = c.config.translations.get("extra_params", [])
-    for lang in languages:
-        docker_exec(c, "./manage.py makemessages -l {} {}".format(lang, " ".join(extra_params)))
+    extra_params = shlex.split(" ".join(c.config.translations.get("extra_params", [])))
+    manage_batch(c, [["./manage.py", "makemessages", "-l", lang] + extra_params
+                     for lang in languages])
 
 
 @task
 def compilemessages(c, language=None):
-    docker_exec(c, "./manage.py compilemessages" + ("-l {}".format(language) if language else ""))
+    """Compiles the messages of every language, or of the given ones (comma separated)"""
+    if not language:
+        manage_batch(c, [["./manage.py", "compilemessages"]])
+        return
+    manage_batch(c, [["./manage.py", "compilemessages", "-l", lang]
+                     for lang in _languages(language)])
 
 
 @task
@@ -78,5 +150,4 @@ def create_su(c, username="admin", email="testing@gogames.co"):
 
 @task
 def coverage(c):
-    docker_exec(c, "coverage run --source=. manage.py test")
-    docker_exec(c, "coverage html")
+    manage_batch(c, [["coverage", "run", "--source=.", "manage.py", "test"], ["coverage", "html"]])
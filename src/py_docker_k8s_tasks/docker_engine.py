@@ -0,0 +1,238 @@
+"""Minimal Docker Engine API client talking to the daemon Unix socket
+
+Keeps one keep-alive connection per thread, so listing images, copying files and running
+commands don't fork the docker CLI nor parse its text output.
+"""
+import os
+import sys
+import json
+import shlex
+import base64
+import socket
+import struct
+import tarfile
+import threading
+import http.client
+from urllib.parse import quote, urlencode
+
+DOCKER_SOCKET = "/var/run/docker.sock"
+DIRECTORY_MODE = 1 << 31  # Go's os.ModeDir, as returned in the archive stat header
+
+
+class DockerEngineError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Docker Engine API error {status}: {message}")
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def _tar_filter():
+    # Python versions with extraction filters reject absolute paths and links out of the target
+    return {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+
+class DockerEngine:
+    def __init__(self, socket_path=DOCKER_SOCKET, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self, fresh=False):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or fresh:
+            if conn is not None:
+                conn.close()
+            conn = self._local.conn = UnixHTTPConnection(self.socket_path, self.timeout)
+        return conn
+
+    def request(self, method, path, params=None, body=None, headers=None, stream=False):
+        """Sends a request, returns the decoded JSON body, raw bytes, or the response if stream"""
+        if params:
+            path = f"{path}?{urlencode(params)}"
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        retry = not hasattr(body, "read")  # A consumed stream can't be sent again
+        try:
+            conn = self._connection()
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+        except (ConnectionError, http.client.HTTPException):
+            # Stale keep-alive connection closed by the daemon
+            if not retry:
+                raise
+            conn = self._connection(fresh=True)
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+
+        if response.status >= 400:
+            data = response.read()
+            try:
+                message = json.loads(data)["message"]
+            except (ValueError, KeyError, TypeError):
+                message = data.decode("utf-8", "replace")
+            raise DockerEngineError(response.status, message)
+        if stream:
+            return response
+        data = response.read()
+        if response.getheader("Content-Type", "").startswith("application/json") and data:
+            return json.loads(data)
+        return data
+
+    def images(self, reference=None):
+        params = {"filters": json.dumps({"reference": [reference]})} if reference else None
+        return self.request("GET", "/images/json", params)
+
+    def archive_stat(self, container, path):
+        """Returns the stat of a path inside the container, None if it doesn't exist"""
+        try:
+            response = self.request("HEAD", f"/containers/{quote(container)}/archive",
+                                    {"path": path}, stream=True)
+        except DockerEngineError as err:
+            if err.status == 404:
+                return None
+            raise
+        response.read()
+        return json.loads(base64.b64decode(response.getheader("X-Docker-Container-Path-Stat")))
+
+    def put_archive(self, container, path, fileobj):
+        """Extracts a tar stream (optionally gzip, bzip2 or xz compressed) into path"""
+        return self.request("PUT", f"/containers/{quote(container)}/archive", {"path": path},
+                            body=fileobj, headers={"Content-Type": "application/x-tar"})
+
+    def get_archive(self, container, path):
+        """Returns the response streaming a tar of path"""
+        return self.request("GET", f"/containers/{quote(container)}/archive", {"path": path},
+                            stream=True)
+
+    def put_path(self, container, source, target):
+        """Copies a host file or directory into the container, with docker cp semantics"""
+        stat = self.archive_stat(container, target)
+        if stat is not None and stat["mode"] & DIRECTORY_MODE:
+            dest, arcname = target, os.path.basename(source.rstrip("/"))
+        else:
+            dest, arcname = os.path.dirname(target.rstrip("/")) or "/", os.path.basename(target)
+
+        read_fd, write_fd = os.pipe()
+        errors = []
+
+        def write_tar():
+            try:
+                with os.fdopen(write_fd, "wb") as pipe, \
+                        tarfile.open(fileobj=pipe, mode="w|") as tar:
+                    tar.add(source, arcname=arcname)
+            except BaseException as err:
+                errors.append(err)
+
+        writer = threading.Thread(target=write_tar, daemon=True)
+        writer.start()
+        try:
+            with os.fdopen(read_fd, "rb") as pipe:
+                self.put_archive(container, dest, pipe)
+        finally:
+            writer.join()
+            # A broken pipe only means the upload stopped reading, put_archive tells why
+            if errors and not isinstance(errors[0], BrokenPipeError):
+                raise errors[0]
+
+    def get_path(self, container, source, target):
+        """Copies a file or directory from the container to the host, with docker cp semantics"""
+        if os.path.isdir(target):
+            dest, rename = target, None
+        else:
+            dest, rename = os.path.dirname(target) or ".", os.path.basename(target)
+
+        response = self.get_archive(container, source)
+        with tarfile.open(fileobj=response, mode="r|") as tar:
+            def members():
+                for member in tar:
+                    if rename:
+                        root, _, rest = member.name.partition("/")
+                        member.name = f"{rename}/{rest}" if rest else rename
+                    yield member
+            tar.extractall(dest, members=members(), **_tar_filter())
+
+    def exec_run(self, container, command, env=None, workdir=None, user=None, stdin=None,
+                 stdout=None, stderr=None):
+        """Runs command in the container without a TTY, returns its exit code
+
+        stdin is an optional binary file object sent to the process. The process output is
+        written to the stdout/stderr binary streams as it arrives.
+        """
+        if isinstance(command, str):
+            command = shlex.split(command)
+        config = {"Cmd": command, "AttachStdout": True, "AttachStderr": True,
+                  "AttachStdin": stdin is not None, "Tty": False,
+                  "Env": [f"{k}={v}" for k, v in (env or {}).items()]}
+        if workdir:
+            config["WorkingDir"] = workdir
+        if user:
+            config["User"] = user
+        exec_id = self.request("POST", f"/containers/{quote(container)}/exec", body=config)["Id"]
+
+        # The start request hijacks the connection, so it doesn't use the keep-alive one
+        conn = UnixHTTPConnection(self.socket_path, self.timeout)
+        try:
+            conn.request("POST", f"/exec/{exec_id}/start",
+                         body=json.dumps({"Detach": False, "Tty": False}).encode("utf-8"),
+                         headers={"Content-Type": "application/json", "Connection": "Upgrade",
+                                  "Upgrade": "tcp"})
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise DockerEngineError(response.status, response.read().decode("utf-8"))
+            # 101 Switching Protocols leaves the raw stream in the response buffer
+            raw = response.fp if response.status == 101 else response
+            writer = None
+            if stdin is not None and conn.sock is not None:
+                writer = threading.Thread(target=_send_stdin, args=(conn.sock, stdin), daemon=True)
+                writer.start()
+            _demux(raw, stdout or sys.stdout.buffer, stderr or sys.stderr.buffer)
+            if writer is not None:
+                writer.join()
+        finally:
+            conn.close()
+        return self.request("GET", f"/exec/{exec_id}/json")["ExitCode"]
+
+
+def _send_stdin(sock, stdin):
+    try:
+        for chunk in iter(lambda: stdin.read(65536), b""):
+            sock.sendall(chunk)
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass  # The process exited without reading all its input
+
+
+def _demux(raw, stdout, stderr):
+    """Splits the multiplexed exec stream (8 bytes header per frame) into stdout and stderr"""
+    streams = {1: stdout, 2: stderr}
+    while True:
+        header = raw.read(8)
+        if len(header) < 8:
+            break
+        stream_type, size = struct.unpack(">BxxxL", header)
+        payload = raw.read(size)
+        out = streams.get(stream_type, stdout)
+        out.write(payload)
+        out.flush()
+
+
+_engines = {}
+
+
+def engine_for(socket_path=DOCKER_SOCKET):
+    if socket_path not in _engines:
+        _engines[socket_path] = DockerEngine(socket_path)
+    return _engines[socket_path]
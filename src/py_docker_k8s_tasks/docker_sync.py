@@ -0,0 +1,120 @@
+"""Content-hash directory sync between the host and a container
+
+Both sides compute a manifest ({relative path: sha256}) and only the files that differ travel,
+as a single tar stream optionally compressed with gzip or zstd.
+"""
+import os
+import shlex
+import hashlib
+import tarfile
+from .docker_engine import _tar_filter
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Prints "<sha256>  ./<relative path>" for every file under the directory, nothing if missing
+MANIFEST_COMMAND = "cd {path} 2>/dev/null && find . -type f -exec sha256sum {{}} + || true"
+
+# (decompress, compress) shell filters used inside the container
+COMPRESSION_FILTERS = {
+    None: ("", ""),
+    "gzip": ("gzip -dc | ", " | gzip -c"),
+    "zstd": ("zstd -dc | ", " | zstd -c"),
+}
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def host_manifest(directory):
+    manifest = {}
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            path = os.path.join(root, filename)
+            if os.path.isfile(path):
+                manifest[os.path.relpath(path, directory)] = file_hash(path)
+    return manifest
+
+
+def parse_manifest(output):
+    """Parses sha256sum output into a manifest
+
+    >>> parse_manifest("e3b0  ./a.txt\\nd41d  ./sub/b c.txt\\n")
+    {'a.txt': 'e3b0', 'sub/b c.txt': 'd41d'}
+    """
+    manifest = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        digest, path = line.split(None, 1)
+        path = path.lstrip("*")
+        manifest[path[2:] if path.startswith("./") else path] = digest
+    return manifest
+
+
+def changed_files(source, target):
+    """Returns the paths of source manifest missing or with another hash in the target one"""
+    return sorted(path for path, digest in source.items() if target.get(path) != digest)
+
+
+def manifest_command(path):
+    return MANIFEST_COMMAND.format(path=shlex.quote(path))
+
+
+def extract_command(path, compression=None):
+    """Shell command that extracts a tar from stdin into path, inside the container"""
+    decompress, _ = COMPRESSION_FILTERS[compression]
+    path = shlex.quote(path)
+    return f"mkdir -p {path} && {decompress}tar xf - -C {path}"
+
+
+def archive_command(path, compression=None):
+    """Shell command that writes to stdout a tar of the files listed in stdin, inside the container"""
+    _, compress = COMPRESSION_FILTERS[compression]
+    return f"tar cf - -C {shlex.quote(path)} -T -{compress}"
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd compression requires the zstandard package, "
+                           "install inv-py-docker-k8s-tasks[zstd]")
+    return zstandard
+
+
+def write_tar(fileobj, directory, files, compression=None):
+    """Streams a tar with files (relative to directory) into the binary fileobj"""
+    check_compression(compression)
+    if compression == "zstd":
+        writer = _zstandard().ZstdCompressor().stream_writer(fileobj, closefd=False)
+        with writer, tarfile.open(fileobj=writer, mode="w|") as tar:
+            for path in files:
+                tar.add(os.path.join(directory, path), arcname=path, recursive=False)
+        return
+    mode = "w|gz" if compression == "gzip" else "w|"
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for path in files:
+            tar.add(os.path.join(directory, path), arcname=path, recursive=False)
+
+
+def read_tar(fileobj, directory, compression=None):
+    """Extracts a tar stream read from the binary fileobj into directory"""
+    check_compression(compression)
+    os.makedirs(directory, exist_ok=True)
+    if compression == "zstd":
+        fileobj = _zstandard().ZstdDecompressor().stream_reader(fileobj)
+    mode = "r|gz" if compression == "gzip" else "r|"
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        tar.extractall(directory, **_tar_filter())
+
+
+def check_compression(compression):
+    if compression not in COMPRESSION_FILTERS:
+        raise ValueError(f"Unsupported compression {compression}")
+    if compression == "zstd":
+        _zstandard()
@@ -1,21 +1,129 @@
+import io
 import os
 import re
-import requests
-from invoke import task
+import json
+import time
+import base64
+import shlex
+import threading
+import subprocess
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin, urlsplit
+from invoke import task, Result, UnexpectedExit
+from . import cache, profiling
+from .lazy import lazy_import
+
+requests = lazy_import("requests")
+docker_engine = lazy_import(f"{__package__}.docker_engine")
+docker_sync = lazy_import(f"{__package__}.docker_sync")
+
+TAGS_PAGE_SIZE = 1000
+TAGS_CACHE_TTL = 300  # seconds
+REGISTRY_POOL_SIZE = 16
+
+
+# Used when the CLI output has no expiry: ECR tokens last 12 hours, gcloud ones one hour
+TOKEN_LIFETIMES = {"aws": 12 * 3600, "googlecloud": 3600}
+TOKEN_REFRESH_MARGIN = 300  # seconds
+TOKEN_COMMANDS = {
+    "aws": "aws ecr get-authorization-token --output json --query 'authorizationData[0]'",
+    "googlecloud": "gcloud config config-helper --format json",
+}
+# Environment variables that change which credentials the CLI returns, part of the cache key
+TOKEN_ENV_VARS = {
+    "aws": ("AWS_PROFILE", "AWS_REGION", "AWS_DEFAULT_REGION", "AWS_ACCESS_KEY_ID",
+            "AWS_SHARED_CREDENTIALS_FILE", "AWS_CONFIG_FILE"),
+    "googlecloud": ("CLOUDSDK_CONFIG", "CLOUDSDK_CORE_ACCOUNT", "CLOUDSDK_ACTIVE_CONFIG_NAME"),
+}
+# Environment variables with a token to use instead of the CLI
+TOKEN_OVERRIDE_VARS = {"aws": "AWS_TOKEN", "googlecloud": "GCLOUD_TOKEN"}
+
+_tokens = {}
+_tokens_lock = threading.Lock()
+_logged_in = set()
+_login_lock = threading.Lock()
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _parse_expiry(value):
+    """Converts an expiry, as epoch seconds or an ISO 8601 date, to epoch seconds
+
+    >>> _parse_expiry(1700000000.5)
+    1700000000.5
+    >>> _parse_expiry("2023-11-14T22:13:20Z")
+    1700000000.0
+    >>> _parse_expiry("2023-11-14T23:13:20.000000+01:00")
+    1700000000.0
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    expiry = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if expiry.tzinfo is None:
+        expiry = expiry.replace(tzinfo=timezone.utc)
+    return expiry.timestamp()
+
+
+def _parse_token(provider, output):
+    """Returns (token, expiry) from the output of TOKEN_COMMANDS[provider]"""
+    data = json.loads(output)
+    if provider == "aws":
+        token, expiry = data["authorizationToken"], data.get("expiresAt")
+    else:
+        credential = data["credential"]
+        token, expiry = credential["access_token"], credential.get("token_expiry")
+    try:
+        return token, _parse_expiry(expiry)
+    except (TypeError, ValueError):
+        return token, time.time() + TOKEN_LIFETIMES[provider]
+
+
+def _token_key(provider):
+    return (provider, ) + tuple(os.getenv(var, "") for var in TOKEN_ENV_VARS[provider])
+
+
+def _get_cached_token(c, provider):
+    key = _token_key(provider)
+    with _tokens_lock:
+        entry = _tokens.get(key) or cache.load("tokens", *key)
+        if entry is None or entry["expires_at"] - TOKEN_REFRESH_MARGIN < time.time():
+            token, expires_at = _parse_token(
+                provider, c.run(TOKEN_COMMANDS[provider], hide=True).stdout)
+            entry = {"token": token, "expires_at": expires_at}
+            cache.store("tokens", entry, *key)
+        _tokens[key] = entry
+    return entry["token"]
+
+
+def _drop_cached_token(registry):
+    """Forgets the token of the registry after it was rejected, returns if there was one
+
+    Tokens given in AWS_TOKEN or GCLOUD_TOKEN are not cached, so they are not dropped.
+    """
+    provider = _registry_type(registry)
+    if provider not in TOKEN_ENV_VARS or os.getenv(TOKEN_OVERRIDE_VARS[provider]):
+        return False
+    key = _token_key(provider)
+    with _tokens_lock:
+        _tokens.pop(key, None)
+        cache.delete("tokens", *key)
+    with _login_lock:
+        _logged_in.discard(registry)
+    return True
 
 
 def _get_aws_token(c):
-    token = os.getenv("AWS_TOKEN")
+    token = os.getenv(TOKEN_OVERRIDE_VARS["aws"])
     if not token:
-        token = c.run("aws ecr get-authorization-token --output text "
-                      "--query 'authorizationData[].authorizationToken'", hide=True).stdout.strip()
+        token = _get_cached_token(c, "aws")
     return token
 
 
 def _get_gcloud_token(c):
-    token = os.getenv("GCLOUD_TOKEN")
+    token = os.getenv(TOKEN_OVERRIDE_VARS["googlecloud"])
     if not token:
-        token = c.run("gcloud auth print-access-token", hide=True).stdout.strip()
+        token = _get_cached_token(c, "googlecloud")
     return token
 
 
@@ -72,29 +180,170 @@ def _auth_headers(c, registry):
         return {}
 
 
+def _docker_login(c, registry):
+    """Logs docker into the registry once per run, reusing the cached registry token"""
+    if _registry_type(registry) != "aws":
+        return
+    with _login_lock:
+        if registry in _logged_in:
+            return
+        username, password = base64.b64decode(_get_aws_token(c)).decode().split(":", 1)
+        c.run(f"docker login --username {username} --password-stdin {registry}",
+              in_stream=io.StringIO(password), hide=True)
+        _logged_in.add(registry)
+
+
+def _docker_context():
+    """Name of the docker context the CLI uses, from DOCKER_CONTEXT or the CLI config"""
+    if os.getenv("DOCKER_CONTEXT"):
+        return os.getenv("DOCKER_CONTEXT")
+    config_dir = os.getenv("DOCKER_CONFIG") or os.path.join(os.path.expanduser("~"), ".docker")
+    try:
+        with open(os.path.join(config_dir, "config.json"), "rt") as f:
+            return json.load(f).get("currentContext") or "default"
+    except (OSError, ValueError, AttributeError):
+        return "default"
+
+
+def _docker_engine(c):
+    """Returns the Docker Engine API client if the daemon socket is reachable, None to use the CLI
+
+    Disabled with config.docker_engine = False, when DOCKER_HOST points to a remote daemon, or
+    when a docker context other than the default one is active, as it may be remote too.
+    """
+    if not c.config.get("docker_engine", True):
+        return None
+    docker_host = os.getenv("DOCKER_HOST", "")
+    if docker_host and not docker_host.startswith("unix://"):
+        return None
+    if not docker_host and _docker_context() != "default":
+        return None
+    socket_path = docker_host[len("unix://"):] or c.config.get("docker_socket") or \
+        docker_engine.DOCKER_SOCKET
+    if not os.path.exists(socket_path):
+        return None
+    return docker_engine.engine_for(socket_path)
+
+
 def _get_last_version_from_local_docker(c, registry, image):
     registry_image = _join(registry, image)
+    engine = _docker_engine(c)
+    if engine is not None:
+        prefix = f"{registry_image}:"
+        tags = (tag[len(prefix):] for img in engine.images(registry_image)
+                for tag in img.get("RepoTags") or [] if tag.startswith(prefix))
+        return max(tags, key=_version_to_int)
     output = c.run(f"docker image ls {registry_image}", hide="out")
     # Black magic explanation: skips first line (header), 2nd field is version
     tags = [re.split(" +", lin)[1] for lin in output.stdout.splitlines()[1:]]
     return sorted(tags, key=_version_to_int)[-1]
 
 
+def _registry_url(c, registry, path):
+    scheme = c.config.get("registry_scheme", "https")
+    return f"{scheme}://{registry}{path}"
+
+
+def _registry_session(registry):
+    """Returns the keep-alive session shared by all the requests to a registry host"""
+    with _sessions_lock:
+        if registry not in _sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=REGISTRY_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[registry] = session
+        return _sessions[registry]
+
+
+def _registry_call(session, url, *args, **kwargs):
+    parts = urlsplit(url)
+    return f"GET {parts.netloc}{parts.path}"
+
+
+@profiling.instrumented("registry", _registry_call)
+def _conditional_get(c, session, url, auth, etag=None):
+    kwargs = dict(auth)
+    if etag:
+        kwargs["headers"] = dict(kwargs.get("headers", {}), **{"If-None-Match": etag})
+    return session.get(url, **kwargs)
+
+
+def _iter_tag_pages(c, registry, image, cached_pages=(), page_size=TAGS_PAGE_SIZE):
+    """Walks the Registry v2 tag pagination, yielding a summary of each page
+
+    Uses the Link header when the registry sends it, otherwise the ?n=&last= cursor. Pages
+    found in cached_pages are revalidated with their ETag, so unchanged pages are not
+    downloaded nor parsed again.
+    """
+    auth = _auth_headers(c, registry)
+    session = _registry_session(registry)
+    base_url = _registry_url(c, registry, f"/v2/{image}/tags/list")
+    url = f"{base_url}?n={page_size}"
+    last = None
+    index = 0
+    retried = False
+    while url:
+        cached = cached_pages[index] if index < len(cached_pages) else None
+        index += 1
+        if cached and cached["url"] != url:
+            cached = None
+        r = _conditional_get(c, session, url, auth, cached and cached.get("etag"))
+        if r.status_code == 401 and not retried and _drop_cached_token(registry):
+            # The cached token was revoked or expired early, retry once with a new one
+            retried = True
+            auth = _auth_headers(c, registry)
+            r = _conditional_get(c, session, url, auth, cached and cached.get("etag"))
+        if cached and r.status_code == 304:
+            yield cached
+            url = cached["next"]
+            continue
+        r.raise_for_status()
+        tags = r.json().get("tags") or []
+        page = {
+            "url": url,
+            "etag": r.headers.get("ETag"),
+            "last_version": max(tags, key=_version_to_int, default=None),
+        }
+        next_link = r.links.get("next", {}).get("url")
+        if next_link:
+            url = urljoin(url, next_link)
+        elif len(tags) >= page_size and tags[-1] != last:
+            last = tags[-1]
+            url = f"{base_url}?n={page_size}&last={last}"
+        else:
+            url = None
+        page["next"] = url
+        yield page
+
+
+def _max_version(versions):
+    return max((v for v in versions if v is not None), key=_version_to_int)
+
+
 def _get_last_version(c, registry, image):
     if _registry_type(registry) in ("ibmcloud", "dockerhub"):
         # fallback, don't know how to get tabs from ibmcloud registry
         return _get_last_version_from_local_docker(c, registry, image)
 
-    url = 'https://{}/v2/{}/tags/list'.format(registry, image)
-    r = requests.get(url, **_auth_headers(c, registry))
-    r.raise_for_status()
-    tags = r.json()['tags']
-    if len(tags) == 100:
-        raise RuntimeError(
-            "Error, the response has 100 tags, we hit the limit and paging not supported, "
-            "you should remove some tags in ECR console"
-        )
-    return sorted(tags, key=_version_to_int)[-1]
+    entry = cache.load("tags", registry, image)
+    if cache.is_fresh(entry, c.config.get("tags_cache_ttl", TAGS_CACHE_TTL)):
+        return entry["last_version"]
+
+    pages = list(_iter_tag_pages(c, registry, image, entry["pages"] if entry else ()))
+    entry = {
+        "fetched_at": time.time(),
+        "last_version": _max_version(p["last_version"] for p in pages),
+        "pages": pages,
+    }
+    return cache.store("tags", entry, registry, image)["last_version"]
+
+
+def _remember_pushed_version(registry, image, version):
+    entry = cache.load("tags", registry, image) or {"pages": []}
+    entry["last_version"] = _max_version([entry.get("last_version"), version])
+    entry["fetched_at"] = time.time()
+    cache.store("tags", entry, registry, image)
 
 
 def _get_next_version(c, registry, image):
@@ -127,8 +376,75 @@ def next_version(c, registry=None, image=None):
     print(_get_next_version(c, registry, image))
 
 
+def _resolve_versions(c, get_version, registry, images, workers):
+    """Resolves the version of each image concurrently, returns {image: version or exception}"""
+    registry = registry or c.config.registry
+
+    def resolve(image):
+        try:
+            return get_version(c, registry, image)
+        except Exception as err:
+            return err
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(images, executor.map(resolve, images)))
+
+
+def _print_versions(versions):
+    width = max(len(image) for image in versions)
+    print("{}  {}".format("IMAGE".ljust(width), "VERSION"))
+    for image, version in versions.items():
+        if isinstance(version, Exception):
+            version = f"ERROR: {version}"
+        print("{}  {}".format(image.ljust(width), version))
+    failed = [image for image, version in versions.items() if isinstance(version, Exception)]
+    if failed:
+        raise RuntimeError("Failed to resolve the version of {}".format(", ".join(failed)))
+
+
+def _split_images(images):
+    return [i.strip() for image in images for i in image.split(",") if i.strip()]
+
+
+@task(iterable=["images"])
+def last_versions(c, images, registry=None, workers=8):
+    """Prints the last version of several images, resolved concurrently"""
+    images = _split_images(images)
+    _print_versions(_resolve_versions(c, _get_last_version, registry, images, workers))
+
+
+@task(iterable=["images"])
+def next_versions(c, images, registry=None, workers=8):
+    """Prints the next version of several images, resolved concurrently"""
+    images = _split_images(images)
+    _print_versions(_resolve_versions(c, _get_next_version, registry, images, workers))
+
+
+def _docker_exec_envs(envs):
+    envs = dict(envs)
+    for k, env_value in os.environ.items():
+        if k.startswith("DOCKEREXEC_"):
+            envs[k.split('_', 1)[1]] = env_value
+    return envs
+
+
+def _exec_call(command, *args, **kwargs):
+    return " ".join(command.split()[:2])
+
+
+@profiling.instrumented("docker exec", _exec_call)
 def docker_exec(c, command, container=None, pty=True, envs={}, workdir=None, user=None):
     container = container or c.config.container
+    engine = None if pty else _docker_engine(c)
+    if engine is not None:
+        # Interactive (pty) sessions still go through the CLI, that handles the terminal
+        exit_code = engine.exec_run(container, command, env=_docker_exec_envs(envs),
+                                    workdir=workdir, user=user)
+        result = Result(command=command, exited=exit_code)
+        if exit_code != 0:
+            raise UnexpectedExit(result)
+        return result
+
     run_command = "docker exec "
     if pty:
         run_command += "-it "
@@ -136,26 +452,140 @@ def docker_exec(c, command, container=None, pty=True, envs={}, workdir=None, use
         run_command += f"-u {user} "
     if workdir:
         run_command += f"-w {workdir} "
-    for env_var, env_value in envs.items():
+    for env_var, env_value in _docker_exec_envs(envs).items():
         run_command += f"--env {env_var}={env_value} "
 
-    for k, env_value in os.environ.items():
-        if k.startswith("DOCKEREXEC_"):
-            env_var = k.split('_', 1)[1]
-            run_command += f"--env {env_var}={env_value} "
+    return c.run("{} {} {}".format(run_command, container, command), pty=pty)
 
-    c.run("{} {} {}".format(run_command, container, command), pty=pty)
+
+def _docker_exec_stream(c, container, command, stdin=None, stdout=None):
+    """Runs a shell command in the container wiring binary stdin/stdout file objects to it"""
+    engine = _docker_engine(c)
+    if engine is not None:
+        exit_code = engine.exec_run(container, ["sh", "-c", command], stdin=stdin, stdout=stdout)
+    else:
+        # c.run streams stdin as text, binary tar data goes through subprocess
+        args = ["docker", "exec", "-i", container, "sh", "-c", command]
+        exit_code = subprocess.run(args, stdin=stdin, stdout=stdout).returncode
+    if exit_code != 0:
+        raise UnexpectedExit(Result(command=command, exited=exit_code))
+
+
+def _in_thread(function, *args):
+    """Runs function in a thread, join() re-raises its exception"""
+    errors = []
+
+    def run():
+        try:
+            function(*args)
+        except BaseException as err:
+            errors.append(err)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def join():
+        thread.join()
+        if errors:
+            raise errors[0]
+    return join
+
+
+def _pipe_from(write):
+    """Returns the read end of a pipe fed by write(fileobj) from a thread, and its join"""
+    read_fd, write_fd = os.pipe()
+
+    def feed():
+        with os.fdopen(write_fd, "wb") as pipe:
+            write(pipe)
+    return os.fdopen(read_fd, "rb"), _in_thread(feed)
+
+
+def _container_manifest(c, container, path):
+    engine = _docker_engine(c)
+    if engine is not None:
+        output = io.BytesIO()
+        engine.exec_run(container, ["sh", "-c", docker_sync.manifest_command(path)], stdout=output)
+        return docker_sync.parse_manifest(output.getvalue().decode("utf-8"))
+    command = shlex.quote(docker_sync.manifest_command(path))
+    return docker_sync.parse_manifest(c.run(f"docker exec {container} sh -c {command}",
+                                            hide=True).stdout)
+
+
+def _sync_put(c, container, source, target, compression=None):
+    """Sends to the container target directory the files of source that changed, as a single tar"""
+    if not os.path.isdir(source):
+        raise RuntimeError(f"{source} must be a directory to sync it")
+    docker_sync.check_compression(compression)
+    changed = docker_sync.changed_files(docker_sync.host_manifest(source),
+                                        _container_manifest(c, container, target))
+    if changed:
+        tar_in, join_writer = _pipe_from(
+            lambda out: docker_sync.write_tar(out, source, changed, compression))
+        with tar_in:
+            _docker_exec_stream(c, container, docker_sync.extract_command(target, compression),
+                                stdin=tar_in)
+        join_writer()
+    return changed
+
+
+def _sync_get(c, container, source, target, compression=None):
+    """Copies to the target directory the files of the container source that changed"""
+    docker_sync.check_compression(compression)
+    host = docker_sync.host_manifest(target) if os.path.isdir(target) else {}
+    changed = docker_sync.changed_files(_container_manifest(c, container, source), host)
+    if changed:
+        file_list = "".join(f"{path}\n" for path in changed).encode("utf-8")
+        list_in, join_list = _pipe_from(lambda out: out.write(file_list))
+        tar_in, join_archive = _pipe_from(
+            lambda out: _docker_exec_stream(c, container,
+                                            docker_sync.archive_command(source, compression),
+                                            stdin=list_in, stdout=out))
+        with list_in:
+            try:
+                with tar_in:
+                    docker_sync.read_tar(tar_in, target, compression)
+            finally:
+                join_archive()  # A failed exec explains a broken tar stream better
+        join_list()
+    return changed
+
+
+def _print_synced(changed):
+    for path in changed:
+        print(path)
+    print(f"{len(changed)} files changed")
 
 
 @task
-def docker_put(c, source, target, container=None):
+def docker_put(c, source, target, container=None, sync=False, compress=None):
+    """Copies source into the container
+
+    With --sync source and target are directories, and only the files whose content changed
+    are sent, as a single tar stream (optionally --compress gzip or zstd).
+    """
     container = container or c.config.container
+    if sync:
+        return _print_synced(_sync_put(c, container, source, target, compress))
+    engine = _docker_engine(c)
+    if engine is not None:
+        return engine.put_path(container, source, target)
     c.run(f"docker cp {source} {container}:{target}")
 
 
 @task
-def docker_get(c, source, target, container=None):
+def docker_get(c, source, target, container=None, sync=False, compress=None):
+    """Copies source from the container
+
+    With --sync source and target are directories, and only the files whose content changed
+    are received, as a single tar stream (optionally --compress gzip or zstd).
+    """
     container = container or c.config.container
+    if sync:
+        return _print_synced(_sync_get(c, container, source, target, compress))
+    engine = _docker_engine(c)
+    if engine is not None:
+        return engine.get_path(container, source, target)
     c.run(f"docker cp {container}:{source} {target}")
 
 
@@ -199,12 +629,110 @@ def pyshell(c):
     docker_exec(c, pyshell)
 
 
-@task
-def build(c, registry=None, image=None, version=None):
+BUILDKIT_STEP_RE = re.compile(r"^#(\d+) \[[^\]]*\d+/\d+\]", re.MULTILINE)
+BUILDKIT_CACHED_RE = re.compile(r"^#(\d+) CACHED", re.MULTILINE)
+CLASSIC_STEP_RE = re.compile(r"^Step \d+/\d+ :", re.MULTILINE)
+CLASSIC_CACHED_RE = re.compile(r"^ ---> Using cache", re.MULTILINE)
+
+
+def _cache_hits(output):
+    """Returns (cached, total) build steps parsed from BuildKit plain or classic build output
+
+    >>> _cache_hits("#5 [1/2] FROM python\\n#5 CACHED\\n#6 [2/2] RUN make\\n#6 DONE 1.2s")
+    (1, 2)
+    >>> _cache_hits("Step 1/2 : FROM python\\nStep 2/2 : RUN make\\n ---> Using cache")
+    (1, 2)
+    """
+    steps = set(BUILDKIT_STEP_RE.findall(output))
+    if steps:
+        return len(steps & set(BUILDKIT_CACHED_RE.findall(output))), len(steps)
+    return len(CLASSIC_CACHED_RE.findall(output)), len(CLASSIC_STEP_RE.findall(output))
+
+
+def _cache_spec(spec, direction, registry_image):
+    """Expands a cache shorthand: paths are local-dir caches, anything else a registry ref"""
+    spec = spec.format(registry_image=registry_image)
+    if "type=" in spec:
+        return spec
+    if spec.startswith(("/", ".", "~")):
+        path = os.path.expanduser(spec)
+        return f"type=local,src={path}" if direction == "from" else f"type=local,dest={path},mode=max"
+    return f"type=registry,ref={spec}" + (",mode=max" if direction == "to" else "")
+
+
+def _as_list(value):
+    if not value:
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+
+def _docker_build(c, registry_image, version, context=".", dockerfile=None, options=None, **kargs):
+    """Runs docker build, or docker buildx build with cache import/export if options.buildx
+
+    options defaults to config.build, with keys buildx, cache_from, cache_to, build_args and
+    target. Returns the run result and the (cached, total) build steps.
+    """
+    if options is None:
+        options = c.config.get("build", {})
+    params = [f"-t {registry_image}:{version}"]
+    if dockerfile:
+        params.append(f"-f {dockerfile}")
+    for arg, value in options.get("build_args", {}).items():
+        params.append(f"--build-arg {arg}={value}")
+    if options.get("target"):
+        params.append(f"--target {options['target']}")
+
+    if options.get("buildx"):
+        command = "docker buildx build --progress=plain --load"
+        for spec in _as_list(options.get("cache_from")):
+            params.append(f"--cache-from {_cache_spec(spec, 'from', registry_image)}")
+        for spec in _as_list(options.get("cache_to")):
+            params.append(f"--cache-to {_cache_spec(spec, 'to', registry_image)}")
+    else:
+        command = "docker build"
+
+    params = " ".join(params)
+    ret = c.run(f"{command} {params} {context}", **kargs)
+    return ret, _cache_hits(ret.stdout + ret.stderr)
+
+
+def _print_cache_hits(cached, total):
+    if total:
+        print("Layer cache hits: {}/{} ({:.0%})".format(cached, total, cached / total))
+
+
+def _docker_push(c, registry, image, version, **kargs):
+    _docker_login(c, registry)
+    ret = c.run("docker push {}:{}".format(_join(registry, image), version), **kargs)
+    if _registry_type(registry) not in ("ibmcloud", "dockerhub"):
+        _remember_pushed_version(registry, image, version)
+    return ret
+
+
+def _flag_value(value):
+    """Value of an optional boolean flag: True when given alone, else its "true"/"false" text"""
+    if isinstance(value, bool):
+        return value
+    if value.lower() in ("true", "yes", "on", "1"):
+        return True
+    if value.lower() in ("false", "no", "off", "0"):
+        return False
+    raise ValueError(f"Expected true or false, got {value!r}")
+
+
+@task(optional=["buildx"])
+def build(c, registry=None, image=None, version=None, buildx=None, target=None):
+    """Builds the image, --buildx (or --buildx false) overrides config.build.buildx"""
     registry, image = _default_registry_image(c, registry, image)
     registry_image = _join(registry, image)
     version = version or _get_next_version(c, registry, image)
-    c.run("docker build -t {}:{} .".format(registry_image, version))
+    options = dict(c.config.get("build", {}))
+    if buildx is not None:
+        options["buildx"] = _flag_value(buildx)
+    if target:
+        options["target"] = target
+    _, cache_hits = _docker_build(c, registry_image, version, options=options)
+    _print_cache_hits(*cache_hits)
 
 
 @task
@@ -215,8 +743,94 @@ def push_image(c, registry=None, image=None, version=None):
             version = _get_last_version_from_local_docker(c, registry, image)
         else:
             version = _get_next_version(c, registry, image)
-    if _registry_type(registry) == "aws":
-        docker_login_cmd = c.run("aws ecr get-login --no-include-email", hide=True).stdout
-        c.run(docker_login_cmd)
-    registry_image = _join(registry, image)
-    c.run("docker push {}:{}".format(registry_image, version))
+    _docker_push(c, registry, image, version)
+
+
+def _timed(timings, stage, function, *args, **kargs):
+    start = time.perf_counter()
+    try:
+        return function(*args, **kargs)
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+def _print_release_report(report):
+    width = max([len(image) for image in report] + [len("IMAGE")])
+    print("{}  {:<12} {:>8} {:>8} {:>8} {:>7}  {}".format(
+        "IMAGE".ljust(width), "VERSION", "RESOLVE", "BUILD", "PUSH", "CACHE", "STATUS"))
+    for image, row in report.items():
+        timings = ["{:.1f}s".format(row[stage]) if stage in row else "-"
+                   for stage in ("resolve", "build", "push")]
+        cached, total = row.get("cache", (0, 0))
+        cache_ratio = "{:.0%}".format(cached / total) if total else "-"
+        print("{}  {:<12} {:>8} {:>8} {:>8} {:>7}  {}".format(
+            image.ljust(width), row.get("version", "-"), *timings, cache_ratio,
+            row.get("status", "-")))
+
+
+@task(iterable=["images"])
+def release(c, images, registry=None, workers=None):
+    """Builds and pushes the images in config.release.images, pushing each one as soon as it's built
+
+    Each entry of config.release.images has an image name and optionally its registry, context
+    directory and Dockerfile. Pass --images to release only some of them.
+    """
+    release_config = c.config.get("release", {})
+    workers = int(workers or release_config.get("workers", 4))
+    only = _split_images(images)
+    entries = [e for e in release_config.get("images", []) if not only or e["image"] in only]
+    if not entries:
+        raise RuntimeError("No images to release, check config.release.images")
+
+    report = {entry["image"]: {} for entry in entries}
+
+    def resolve(entry):
+        entry_registry = entry.get("registry") or registry or c.config.registry
+        row = report[entry["image"]]
+        try:
+            row["version"] = entry.get("version") or _timed(
+                row, "resolve", _get_next_version, c, entry_registry, entry["image"])
+        except Exception as err:
+            row["status"] = f"resolve failed: {err}"
+            return None
+        return entry, entry_registry
+
+    def build_one(entry, entry_registry):
+        row = report[entry["image"]]
+        options = dict(c.config.get("build", {}), **entry.get("build", {}))
+        try:
+            _, row["cache"] = _timed(
+                row, "build", _docker_build, c, _join(entry_registry, entry["image"]),
+                row["version"], entry.get("context", "."), entry.get("dockerfile"), options,
+                hide=True)
+        except Exception as err:
+            row["status"] = f"build failed: {err}"
+            return None
+        return entry, entry_registry
+
+    def push_one(entry, entry_registry):
+        row = report[entry["image"]]
+        try:
+            _timed(row, "push", _docker_push, c, entry_registry, entry["image"], row["version"],
+                   hide=True)
+        except Exception as err:
+            row["status"] = f"push failed: {err}"
+        else:
+            row["status"] = "ok"
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        targets = [target for target in executor.map(resolve, entries) if target is not None]
+
+    with ThreadPoolExecutor(max_workers=workers) as builders, \
+            ThreadPoolExecutor(max_workers=workers) as pushers:
+        builds = [builders.submit(build_one, *target) for target in targets]
+        for future in as_completed(builds):
+            if future.result() is not None:
+                pushers.submit(push_one, *future.result())
+
+    _print_release_report(report)
+    print("Released {} images in {:.1f}s".format(len(report), time.perf_counter() - start))
+    failed = [image for image, row in report.items() if row["status"] != "ok"]
+    if failed:
+        raise RuntimeError("Failed to release {}".format(", ".join(failed)))
@@ -0,0 +1,395 @@
+"""Kubernetes API client, to run kubectl get/apply/delete without a kubectl process per call
+
+The kubeconfig is read once, requests go through one pooled (keep-alive) session and the API
+discovery is cached on disk like kubectl does, so each operation is just its HTTP request.
+"""
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import base64
+import codecs
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import cache, k8s_query
+from .k8s_diff import LAST_APPLIED
+
+DISCOVERY_TTL = 600
+POOL_SIZE = 16
+REQUEST_TIMEOUT = 60
+FIELD_MANAGER = "py-docker-k8s-tasks"
+TABLE_ACCEPT = "application/json;as=Table;v=v1;g=meta.k8s.io, application/json"
+VERSION_RE = re.compile(r"^v\d+((alpha|beta)\d+)?$")
+
+
+class KubeApiError(Exception):
+    def __init__(self, status, message, reason=None):
+        super().__init__(f"{message} ({status})")
+        self.status = status
+        self.message = message
+        self.reason = reason
+
+
+def load_kubeconfig(path=None, context=None):
+    """Reads the kubeconfig (path, $KUBECONFIG or ~/.kube/config, merged like kubectl does) and
+    returns the settings of context, the current one by default"""
+    path = path or os.getenv("KUBECONFIG") or os.path.join(os.path.expanduser("~"), ".kube",
+                                                           "config")
+    merged = {"clusters": {}, "users": {}, "contexts": {}}
+    current = None
+    for filename in filter(None, path.split(os.pathsep)):
+        if not os.path.exists(filename):
+            continue
+        with open(filename) as f:
+            config = yaml.safe_load(f) or {}
+        base_dir = os.path.dirname(os.path.abspath(filename))
+        current = current or config.get("current-context")
+        for section in merged:
+            for entry in config.get(section) or []:
+                settings = dict(entry.get(section[:-1]) or {}, _base_dir=base_dir)
+                merged[section].setdefault(entry["name"], settings)
+
+    context = context or current
+    if context not in merged["contexts"]:
+        raise ValueError(f"context {context} not found in {path}")
+    settings = merged["contexts"][context]
+    if settings.get("cluster") not in merged["clusters"]:
+        raise ValueError(f"cluster of context {context} not found in {path}")
+    return {
+        "context": context,
+        "cluster": merged["clusters"][settings["cluster"]],
+        "user": merged["users"].get(settings.get("user"), {}),
+        "namespace": settings.get("namespace") or "default",
+    }
+
+
+def _file_setting(entry, name):
+    """Path of the file setting name, writing name-data to a temporary file if needed"""
+    if entry.get(f"{name}-data"):
+        fd, path = tempfile.mkstemp(prefix="kube-", suffix=".pem")
+        with os.fdopen(fd, "wb") as f:
+            f.write(base64.b64decode(entry[f"{name}-data"]))
+        atexit.register(os.unlink, path)
+        return path
+    if entry.get(name):
+        return os.path.join(entry["_base_dir"], os.path.expanduser(entry[name]))
+    return None
+
+
+def _parse_timestamp(timestamp):
+    return datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()
+
+
+def _cell(value):
+    if value is None or value == "":
+        return "<none>"
+    if isinstance(value, list):
+        return ",".join(str(v) for v in value)
+    return str(value)
+
+
+class KubeClient:
+    def __init__(self, kubeconfig):
+        cluster, user = kubeconfig["cluster"], kubeconfig["user"]
+        if "auth-provider" in user:
+            raise ValueError("auth-provider users aren't supported, use an exec plugin")
+        self.server = cluster["server"].rstrip("/")
+        self.namespace = kubeconfig["namespace"]
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if cluster.get("insecure-skip-tls-verify"):
+            self.session.verify = False
+        else:
+            self.session.verify = _file_setting(cluster, "certificate-authority") or True
+        cert = _file_setting(user, "client-certificate")
+        if cert:
+            self.session.cert = (cert, _file_setting(user, "client-key"))
+        if user.get("username"):
+            self.session.auth = (user["username"], user.get("password", ""))
+        self._user = user
+        self._token = None
+        self._token_expires = None
+        self._token_lock = threading.Lock()
+        self._resources = None
+        self._resources_lock = threading.Lock()
+
+    def _exec_token(self):
+        spec = self._user["exec"]
+        env = dict(os.environ, **{var["name"]: var["value"] for var in spec.get("env") or []})
+        env["KUBERNETES_EXEC_INFO"] = json.dumps({
+            "apiVersion": spec.get("apiVersion"), "kind": "ExecCredential",
+            "spec": {"interactive": False}})
+        out = subprocess.run([spec["command"]] + (spec.get("args") or []), env=env,
+                             stdout=subprocess.PIPE, check=True).stdout
+        status = json.loads(out).get("status") or {}
+        if not status.get("token"):
+            raise ValueError(f"{spec['command']} didn't return a token")
+        expires = status.get("expirationTimestamp")
+        return status["token"], expires and _parse_timestamp(expires)
+
+    def _bearer(self):
+        if self._user.get("token"):
+            return self._user["token"]
+        if self._user.get("tokenFile"):
+            with open(_file_setting(self._user, "tokenFile")) as f:
+                return f.read().strip()
+        if self._user.get("exec"):
+            with self._token_lock:
+                if self._token is None or self._token_expires and \
+                        self._token_expires - 60 < time.time():
+                    self._token, self._token_expires = self._exec_token()
+                return self._token
+        return None
+
+    def request(self, method, path, params=None, body=None, content_type="application/json",
+                accept="application/json", stream=False):
+        headers = {"Accept": accept}
+        token = self._bearer()
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        if body is not None:
+            headers["Content-Type"] = content_type
+            if not isinstance(body, (str, bytes)):
+                body = json.dumps(body)
+        response = self.session.request(method, self.server + path, params=params, data=body,
+                                        headers=headers, stream=stream,
+                                        timeout=None if stream else REQUEST_TIMEOUT)
+        if response.status_code >= 400:
+            try:
+                status = response.json()
+            except ValueError:
+                status = {"message": response.text}
+            response.close()
+            raise KubeApiError(response.status_code, status.get("message") or response.reason,
+                               status.get("reason"))
+        return response
+
+    def _discover(self):
+        group_versions = [("", "v1")]
+        for group in self.request("GET", "/apis").json().get("groups") or []:
+            group_versions.append((group["name"], group["preferredVersion"]["version"]))
+
+        def fetch(group_version):
+            group, version = group_version
+            path = f"/apis/{group}/{version}" if group else f"/api/{version}"
+            try:
+                return self.request("GET", path).json().get("resources") or []
+            except (KubeApiError, requests.RequestException):
+                return []  # Aggregated APIs that are down, like kubectl skip them
+
+        resources = []
+        with ThreadPoolExecutor(POOL_SIZE) as executor:
+            for (group, version), found in zip(group_versions,
+                                               executor.map(fetch, group_versions)):
+                resources.extend({
+                    "name": resource["name"], "kind": resource["kind"],
+                    "singular": resource.get("singularName") or resource["kind"].lower(),
+                    "shortNames": resource.get("shortNames") or [],
+                    "namespaced": resource["namespaced"], "group": group, "version": version,
+                } for resource in found if "/" not in resource["name"])
+        return resources
+
+    def resources(self, refresh=False):
+        """Discovery of the server resources, cached on disk DISCOVERY_TTL seconds"""
+        with self._resources_lock:
+            if self._resources is None or refresh:
+                entry = None if refresh else cache.load("discovery", self.server)
+                if not cache.is_fresh(entry, DISCOVERY_TTL):
+                    entry = cache.store("discovery", {"fetched_at": time.time(),
+                                                      "resources": self._discover()},
+                                        self.server)
+                self._resources = entry["resources"]
+            return self._resources
+
+    def _find(self, name, group=None, version=None):
+        name = name.lower()
+        for refresh in (False, True):  # Refreshed once, for resources created after the cache
+            for info in self.resources(refresh):
+                if name not in (info["name"], info["singular"], info["kind"].lower()) and \
+                        name not in info["shortNames"]:
+                    continue
+                if group is not None and info["group"] != group:
+                    continue
+                return dict(info, version=version or info["version"])
+        raise KubeApiError(404, f'the server doesn\'t have a resource type "{name}"')
+
+    def resource(self, resource):
+        """Discovery info of resource, written like kubectl get takes it: pods, po,
+        deployments.apps, Deployment.v1.apps..."""
+        name, _, group = resource.partition(".")
+        version = None
+        first, _, rest = group.partition(".")
+        if VERSION_RE.match(first):
+            version, group = first, rest
+        return self._find(name, group or None, version)
+
+    def object_resource(self, obj):
+        group, _, version = obj["apiVersion"].rpartition("/")
+        return self._find(obj["kind"], group, version)
+
+    def _namespace(self, namespace):
+        """None is the namespace of the context, "all" every namespace"""
+        if namespace == "all":
+            return None
+        return namespace or self.namespace
+
+    def path(self, info, namespace=None, name=None):
+        if info["group"]:
+            path = f"/apis/{info['group']}/{info['version']}"
+        else:
+            path = f"/api/{info['version']}"
+        if info["namespaced"] and namespace:
+            path += f"/namespaces/{namespace}"
+        path += f"/{info['name']}"
+        if name:
+            path += f"/{name}"
+        return path
+
+    def list(self, resource, namespace=None, label_selector=None, field_selector=None):
+        """Yields the objects of resource, parsed as they arrive"""
+        info = self.resource(resource)
+        params = {"labelSelector": label_selector, "fieldSelector": field_selector}
+        response = self.request("GET", self.path(info, self._namespace(namespace)),
+                                params={k: v for k, v in params.items() if v}, stream=True)
+        api_version = f"{info['group']}/{info['version']}" if info["group"] else info["version"]
+        with response:
+            response.raw.decode_content = True
+            for item in k8s_query.iter_items(codecs.getreader("utf-8")(response.raw)):
+                item.setdefault("apiVersion", api_version)
+                item.setdefault("kind", info["kind"])
+                yield item
+
+    def watch(self, resource, namespace=None, timeout=None):
+        """Yields the objects of resource as they are added or changed, from a single watch
+        request the server ends after timeout seconds"""
+        info = self.resource(resource)
+        params = {"watch": "1"}
+        if timeout:
+            params["timeoutSeconds"] = str(int(timeout))
+        response = self.request("GET", self.path(info, self._namespace(namespace)),
+                                params=params, stream=True)
+        with response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event.get("type") == "ERROR":
+                    status = event.get("object") or {}
+                    raise KubeApiError(status.get("code"), status.get("message"),
+                                       status.get("reason"))
+                if event.get("type") in ("ADDED", "MODIFIED"):
+                    yield event["object"]
+
+    def table(self, resource, namespace=None, label_selector=None, field_selector=None,
+              name=None, wide=False):
+        """(headers, rows) as kubectl get shows them, the server renders the columns"""
+        info = self.resource(resource)
+        params = {"labelSelector": label_selector, "fieldSelector": field_selector}
+        table = self.request("GET", self.path(info, self._namespace(namespace), name),
+                             params={k: v for k, v in params.items() if v},
+                             accept=TABLE_ACCEPT).json()
+        columns = [i for i, column in enumerate(table.get("columnDefinitions") or [])
+                   if wide or not column.get("priority")]
+        headers = [table["columnDefinitions"][i]["name"].upper() for i in columns]
+        rows = [[_cell(row["cells"][i]) for i in columns] for row in table.get("rows") or []]
+        if namespace == "all" and info["namespaced"]:
+            headers.insert(0, "NAMESPACE")
+            for row, source in zip(rows, table.get("rows") or []):
+                row.insert(0, ((source.get("object") or {}).get("metadata") or {})
+                           .get("namespace", ""))
+        return headers, rows
+
+    def get(self, resource, name, namespace=None, ignore_not_found=False):
+        info = self.resource(resource)
+        try:
+            return self.request("GET", self.path(info, self._namespace(namespace), name)).json()
+        except KubeApiError as err:
+            if ignore_not_found and err.status == 404:
+                return None
+            raise
+
+    def get_object(self, obj):
+        """Live version of the object of a manifest, None if it doesn't exist"""
+        metadata = obj["metadata"]
+        path = self.path(self.object_resource(obj), metadata.get("namespace") or self.namespace,
+                         metadata["name"])
+        try:
+            return self.request("GET", path).json()
+        except KubeApiError as err:
+            if err.status == 404:
+                return None
+            raise
+
+    def apply(self, obj, field_manager=FIELD_MANAGER):
+        """Server side apply of obj, forcing conflicts like kubectl apply --server-side
+        --force-conflicts
+
+        The last-applied-configuration annotation is set as kubectl apply does, so client side
+        applies and diffs keep working on the objects.
+        """
+        metadata = obj["metadata"]
+        annotations = {k: v for k, v in (metadata.get("annotations") or {}).items()
+                       if k != LAST_APPLIED}
+        if annotations:
+            manifest = dict(obj, metadata=dict(metadata, annotations=annotations))
+        else:
+            manifest = dict(obj, metadata={k: v for k, v in metadata.items() if k != "annotations"})
+        last_applied = json.dumps(manifest, separators=(",", ":"), sort_keys=True) + "\n"
+        body = dict(manifest, metadata=dict(manifest["metadata"], annotations=dict(
+            annotations, **{LAST_APPLIED: last_applied})))
+        path = self.path(self.object_resource(obj), metadata.get("namespace") or self.namespace,
+                         metadata["name"])
+        return self.request("PATCH", path, params={"fieldManager": field_manager, "force": "true"},
+                            body=body, content_type="application/apply-patch+yaml").json()
+
+    def _delete(self, path, grace_period=None):
+        options = {"kind": "DeleteOptions", "apiVersion": "v1",
+                   "propagationPolicy": "Background"}
+        if grace_period is not None:
+            options["gracePeriodSeconds"] = int(grace_period)
+        return self.request("DELETE", path, body=options).json()
+
+    def delete(self, resource, name, namespace=None, grace_period=None):
+        info = self.resource(resource)
+        return self._delete(self.path(info, self._namespace(namespace), name), grace_period)
+
+    def delete_object(self, obj, grace_period=None):
+        metadata = obj["metadata"]
+        path = self.path(self.object_resource(obj), metadata.get("namespace") or self.namespace,
+                         metadata["name"])
+        return self._delete(path, grace_period)
+
+    def patch(self, resource, name, patch, namespace=None, patch_type="strategic-merge-patch"):
+        info = self.resource(resource)
+        return self.request("PATCH", self.path(info, self._namespace(namespace), name),
+                            body=patch, content_type=f"application/{patch_type}+json").json()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def client_for(path=None, context=None):
+    """Shared KubeClient for the kubeconfig, None if this client can't use it (kubectl then)"""
+    key = (path or os.getenv("KUBECONFIG", ""), context)
+    with _clients_lock:
+        if key not in _clients:
+            try:
+                _clients[key] = KubeClient(load_kubeconfig(path, context))
+            except (OSError, ValueError, KeyError) as err:
+                print(f"Using kubectl, the kubeconfig isn't supported by the API client: {err}",
+                      file=sys.stderr)
+                _clients[key] = None
+        return _clients[key]
@@ -0,0 +1,110 @@
+"""Streaming ConfigMap/Secret manifests built from the files of a directory
+
+The manifest is written piece by piece (secrets base64 encoded in chunks, large files read
+through mmap), so memory use doesn't depend on the size of the files.
+"""
+import os
+import json
+import mmap
+import base64
+import codecs
+import fnmatch
+
+# etcd rejects objects over 1 MiB, leave some room for the metadata
+MAX_OBJECT_SIZE = 1024 * 1024
+METADATA_ALLOWANCE = 16 * 1024
+MMAP_THRESHOLD = 256 * 1024
+CHUNK_SIZE = 3 * 64 * 1024  # Multiple of 3 so base64 chunks concatenate without padding
+NESTED_KEY_SEPARATOR = "__"
+
+
+def collect_files(directory, include=(), exclude=(), recursive=False):
+    """Returns [(key, path)] for the files in directory, filtered with include/exclude globs
+
+    Globs match the path relative to directory. Keys of nested files join their path with
+    NESTED_KEY_SEPARATOR, as configmap keys can't have slashes.
+    """
+    files = []
+    for root, dirs, filenames in os.walk(directory):
+        dirs.sort()
+        if not recursive:
+            dirs.clear()
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            relpath = os.path.relpath(path, directory)
+            if include and not any(fnmatch.fnmatch(relpath, glob) for glob in include):
+                continue
+            if any(fnmatch.fnmatch(relpath, glob) for glob in exclude):
+                continue
+            files.append((relpath.replace(os.sep, NESTED_KEY_SEPARATOR), path))
+    return files
+
+
+def data_size(path, secret=False):
+    """Size the file takes in the object data, without reading it"""
+    size = os.path.getsize(path)
+    return 4 * ((size + 2) // 3) if secret else size
+
+
+def shard(files, secret=False, limit=MAX_OBJECT_SIZE - METADATA_ALLOWANCE):
+    """Splits [(key, path)] in groups that fit in one object each, keeping the file order"""
+    shards, current, current_size = [], [], 0
+    for key, path in files:
+        size = data_size(path, secret) + len(key)
+        if size > limit:
+            raise ValueError(f"{path} alone is over the {limit} bytes limit of an object")
+        if current and current_size + size > limit:
+            shards.append(current)
+            current, current_size = [], 0
+        current.append((key, path))
+        current_size += size
+    if current or not shards:
+        shards.append(current)
+    return shards
+
+
+def _chunks(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            data = f.read()
+            for i in range(0, len(data), CHUNK_SIZE):
+                yield data[i:i + CHUNK_SIZE]
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for i in range(0, len(mapped), CHUNK_SIZE):
+                yield mapped[i:i + CHUNK_SIZE]
+
+
+def _write_value(out, path, secret):
+    out.write('"')
+    if secret:
+        for chunk in _chunks(path):
+            out.write(base64.b64encode(chunk).decode("ascii"))
+    else:
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for chunk in _chunks(path):
+            out.write(json.dumps(decoder.decode(chunk), ensure_ascii=False)[1:-1])
+        out.write(json.dumps(decoder.decode(b"", final=True), ensure_ascii=False)[1:-1])
+    out.write('"')
+
+
+def write_manifest(out, name, annotations, files, secret=False):
+    """Writes to the text stream out the ConfigMap (or Secret) YAML with the data of files
+
+    Strings are written JSON-quoted, which is valid YAML.
+    """
+    out.write("apiVersion: v1\n")
+    if secret:
+        out.write("kind: Secret\ntype: Opaque\n")
+    else:
+        out.write("kind: ConfigMap\n")
+    out.write(f"metadata:\n  name: {json.dumps(name)}\n  annotations:")
+    lines = [f"\n    {json.dumps(k)}: {json.dumps(v)}" for k, v in annotations.items()]
+    out.write("".join(lines) or " {}")
+    out.write("\ndata:")
+    if not files:
+        out.write(" {}")
+    for key, path in files:
+        out.write(f"\n  {json.dumps(key)}: ")
+        _write_value(out, path, secret)
+    out.write("\n")
@@ -0,0 +1,98 @@
+"""Client side comparison of rendered manifests against the live objects
+
+An object is unchanged when the manifest matches the last configuration applied with kubectl
+and every field it sets has the same value in the live object. Fields the server adds or
+manages (status, defaults, managedFields, uid...) are ignored because they aren't in the
+manifest.
+"""
+import json
+import base64
+
+LAST_APPLIED = "kubectl.kubernetes.io/last-applied-configuration"
+
+
+def object_key(obj):
+    metadata = obj.get("metadata") or {}
+    return obj.get("kind"), metadata.get("namespace"), metadata.get("name")
+
+
+def resource_name(obj):
+    """Name kubectl get understands, with version and group to avoid ambiguous kinds
+
+    >>> resource_name({"apiVersion": "apps/v1", "kind": "Deployment", "metadata": {"name": "x"}})
+    'Deployment.v1.apps/x'
+    >>> resource_name({"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": "x"}})
+    'ConfigMap/x'
+    """
+    group, _, version = obj["apiVersion"].rpartition("/")
+    kind = f"{obj['kind']}.{version}.{group}" if group else obj["kind"]
+    return f"{kind}/{obj['metadata']['name']}"
+
+
+def _normalize(obj):
+    """Applies the conversions the API server does on write, so they don't look like changes"""
+    if obj.get("kind") == "Secret" and obj.get("stringData"):
+        obj = dict(obj)
+        data = dict(obj.get("data") or {})
+        for key, value in obj.pop("stringData").items():
+            data[key] = base64.b64encode(str(value).encode("utf-8")).decode("ascii")
+        obj["data"] = data
+    return obj
+
+
+def is_subset(desired, live):
+    """True if every field set in desired has the same value in live"""
+    if isinstance(desired, dict):
+        return isinstance(live, dict) and all(
+            key in live and is_subset(value, live[key]) for key, value in desired.items())
+    if isinstance(desired, list):
+        if not isinstance(live, list) or len(desired) != len(live):
+            return False
+        return all(is_subset(item, live_item) for item, live_item in zip(desired, live))
+    if desired is None:
+        return live in (None, {}, [])
+    return desired == live or str(desired) == str(live)
+
+
+def differs(desired, live):
+    desired = _normalize(desired)
+    annotations = (live.get("metadata") or {}).get("annotations") or {}
+    if LAST_APPLIED in annotations:
+        try:
+            last_applied = _normalize(json.loads(annotations[LAST_APPLIED]))
+        except ValueError:
+            return True
+        # Compared both ways so fields removed from the manifest count as changes
+        if not (is_subset(desired, last_applied) and is_subset(last_applied, desired)):
+            return True
+    return not is_subset(_without_last_applied(desired), live)
+
+
+def _without_last_applied(obj):
+    annotations = (obj.get("metadata") or {}).get("annotations") or {}
+    if LAST_APPLIED not in annotations:
+        return obj
+    obj = dict(obj, metadata=dict(obj["metadata"]))
+    obj["metadata"]["annotations"] = {k: v for k, v in annotations.items() if k != LAST_APPLIED}
+    return obj
+
+
+def classify(desired_objects, live_objects, default_namespace=None):
+    """Splits desired_objects in (changed, unchanged, new) comparing them with live_objects"""
+    live_by_key = {}
+    for live in live_objects:
+        kind, namespace, name = object_key(live)
+        live_by_key[(kind, namespace, name)] = live
+        live_by_key.setdefault((kind, None, name), live)  # Manifests without namespace
+
+    changed, unchanged, new = [], [], []
+    for desired in desired_objects:
+        kind, namespace, name = object_key(desired)
+        live = live_by_key.get((kind, namespace or default_namespace, name))
+        if live is None:
+            new.append(desired)
+        elif differs(desired, live):
+            changed.append(desired)
+        else:
+            unchanged.append(desired)
+    return changed, unchanged, new
@@ -0,0 +1,194 @@
+"""Follows the logs of several pods/containers at once, one kubectl logs per container
+
+Every follower puts its lines in its own bounded queue and the printer takes a few lines from
+each queue in turn, so a chatty pod blocks on its full queue (and kubectl on its pipe) instead
+of starving the others.
+"""
+import re
+import sys
+import queue
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+COLORS = ["\033[32m", "\033[33m", "\033[34m", "\033[35m", "\033[36m", "\033[91m", "\033[92m",
+          "\033[93m", "\033[94m", "\033[95m", "\033[96m"]
+RESET = "\033[0m"
+QUEUE_SIZE = 1000
+LINES_PER_TURN = 100
+DISCOVER_INTERVAL = 5
+MAX_FOLLOWERS = 16
+
+_DONE = object()
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+def _pod_key(target):
+    return target[:1] + target[2:]
+
+
+class LogMultiplexer:
+    """Prints the logs of the containers list_targets() returns as [(pod, container, ...)]
+
+    log_command(*target) gives the argv of the process that outputs the logs, the items after
+    the container (like the pod namespace) tell pods with the same name apart. When
+    follow is set, list_targets is called again every discover_interval seconds to pick up new
+    pods, and run() goes on until stop() or Ctrl-C. Each follower takes a worker until its pod
+    goes away, so like kubectl --max-log-requests, run() raises TooManyStreams if there are
+    more than max_followers targets to follow at the start, and the pods that show up later
+    wait (with a warning) until a worker is free.
+    """
+
+    def __init__(self, list_targets, log_command, include=None, exclude=None, follow=False,
+                 max_followers=MAX_FOLLOWERS, color=None, out=None, env=None,
+                 discover_interval=DISCOVER_INTERVAL):
+        self.list_targets = list_targets
+        self.log_command = log_command
+        self.include = include and re.compile(include)
+        self.exclude = exclude and re.compile(exclude)
+        self.follow = follow
+        self.max_followers = max_followers
+        self.out = out or sys.stdout
+        self.color = self.out.isatty() if color is None else color
+        self.env = env
+        self.discover_interval = discover_interval
+        self._queues = {}
+        self._prefixes = {}
+        self._seen = set()
+        self._waiting = set()
+        self._following = 0
+        self._procs = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def _prefix(self, target, pod_containers):
+        pod, container = target[:2]
+        label = pod if pod_containers[_pod_key(target)] == 1 else f"{pod}/{container}"
+        if not self.color:
+            return f"{label} "
+        return f"{COLORS[len(self._prefixes) % len(COLORS)]}{label}{RESET} "
+
+    def _discover(self, pool, initial=False):
+        targets = self.list_targets()
+        pod_containers = {}
+        for target in targets:
+            pod_containers[_pod_key(target)] = pod_containers.get(_pod_key(target), 0) + 1
+        new = [target for target in targets if target not in self._seen]
+        if self.follow:
+            with self._lock:
+                room = self.max_followers - self._following
+            if initial and len(new) > room:
+                raise TooManyStreams(
+                    f"Following {len(new)} log streams is over the limit of "
+                    f"{self.max_followers}, use --max-log-requests to raise it")
+            for target in new[room:]:
+                if target not in self._waiting:
+                    self._waiting.add(target)
+                    pod, container = target[:2]
+                    print(f"Not following {pod}/{container} yet, already following "
+                          f"{self.max_followers} log streams", file=sys.stderr)
+            new = new[:room]
+        for target in new:
+            self._seen.add(target)
+            self._waiting.discard(target)
+            self._prefixes[target] = self._prefix(target, pod_containers)
+            lines = queue.Queue(QUEUE_SIZE)
+            with self._lock:
+                self._queues[target] = lines
+                self._following += 1
+            pool.submit(self._follow, target, lines)
+
+    def _discover_loop(self, pool):
+        while not self._stopped.wait(self.discover_interval):
+            try:
+                self._discover(pool)
+            except Exception as err:  # Transient API errors shouldn't stop the logs
+                print(f"Error listing pods: {err}", file=sys.stderr)
+
+    def _put(self, lines, item):
+        while not self._stopped.is_set():
+            try:
+                lines.put(item, timeout=0.1)
+                self._wakeup.set()
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _follow(self, target, lines):
+        try:
+            if self._stopped.is_set():
+                return
+            proc = subprocess.Popen(self.log_command(*target), stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, env=self.env,
+                                    universal_newlines=True, errors="replace")
+            with self._lock:
+                self._procs.append(proc)
+            for line in proc.stdout:
+                if self.include and not self.include.search(line):
+                    continue
+                if self.exclude and self.exclude.search(line):
+                    continue
+                if not self._put(lines, line):
+                    break
+            proc.stdout.close()
+            proc.wait()
+        finally:
+            with self._lock:
+                self._following -= 1
+            self._put(lines, _DONE)
+
+    def _print_turn(self):
+        """Prints up to LINES_PER_TURN lines of each queue, returns if anything was printed"""
+        printed = False
+        with self._lock:
+            queues = list(self._queues.items())
+        for target, lines in queues:
+            for _ in range(LINES_PER_TURN):
+                try:
+                    line = lines.get_nowait()
+                except queue.Empty:
+                    break
+                if line is _DONE:
+                    with self._lock:
+                        del self._queues[target]
+                    break
+                self.out.write(self._prefixes[target] + line)
+                printed = True
+        if printed:
+            self.out.flush()
+        return printed
+
+    def run(self):
+        pool = ThreadPoolExecutor(self.max_followers)
+        try:
+            self._discover(pool, initial=True)
+            if self.follow:
+                threading.Thread(target=self._discover_loop, args=(pool,), daemon=True).start()
+            while True:
+                if self._print_turn():
+                    continue
+                with self._lock:
+                    finished = not self._queues
+                if self._stopped.is_set() or finished and not self.follow:
+                    break
+                self._wakeup.wait(0.1)
+                self._wakeup.clear()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            with self._lock:
+                procs = list(self._procs)
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.terminate()
+            pool.shutdown(wait=False)
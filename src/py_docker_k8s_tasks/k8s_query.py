@@ -0,0 +1,261 @@
+"""Helpers to query kubectl -o json output: incremental parsing, JSONPath columns and filters"""
+import re
+import json
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+
+
+def iter_items(stream, chunk_size=STREAM_CHUNK_SIZE):
+    """Yields the elements of the "items" list of a kubectl -o json List read from stream
+
+    Parses one item at a time, so memory depends on the biggest item, not on the whole list.
+    Only a top level "items" list counts, an object without one (not a List) is yielded as is.
+
+    >>> import io
+    >>> list(iter_items(io.StringIO('{"kind": "List", "items": [{"a": 1}, {"b": 2}]}'), 4))
+    [{'a': 1}, {'b': 2}]
+    >>> list(iter_items(io.StringIO('{"kind": "Pod", "spec": {"items": [1]}}'), 4))
+    [{'kind': 'Pod', 'spec': {'items': [1]}}]
+    """
+    buf = ""
+    eof = False
+
+    def fill():
+        nonlocal buf, eof
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+        buf += chunk
+
+    def next_char():
+        """Takes the next non blank character"""
+        nonlocal buf
+        while True:
+            buf = buf.lstrip()
+            if buf:
+                char, buf = buf[0], buf[1:]
+                return char
+            if eof:
+                raise ValueError("Unexpected end of the JSON document")
+            fill()
+
+    def next_value():
+        """Takes the next JSON value, reading until it's complete"""
+        nonlocal buf
+        while True:
+            buf = buf.lstrip()
+            try:
+                value, end = _decoder.raw_decode(buf)
+            except ValueError:
+                if eof:
+                    raise
+                fill()
+                continue
+            if end == len(buf) and not eof:
+                fill()  # A number or literal could go on in the next chunk
+                continue
+            buf = buf[end:]
+            return value
+
+    while not eof and not buf.strip():
+        fill()
+    if not buf.strip():
+        return
+    if next_char() != "{":
+        raise ValueError("Expected a JSON object")
+
+    # Walk the top level keys, so the "items" of a nested object (like the projected volumes
+    # of a Pod) aren't taken for the List items
+    obj = {}
+    while True:
+        char = next_char()
+        if char == "}":
+            break
+        if char == ",":
+            continue
+        buf = char + buf
+        key = next_value()
+        if next_char() != ":":
+            raise ValueError(f"Expected ':' after {key!r}")
+        if key == "items":
+            char = next_char()
+            if char == "[":
+                break
+            buf = char + buf
+        obj[key] = next_value()
+
+    if char == "}":
+        if obj.get("kind", "").endswith("List"):
+            yield from obj.get("items") or []
+        else:
+            yield obj
+        return
+
+    while True:
+        char = next_char()
+        if char == "]":
+            return
+        if char == ",":
+            continue
+        buf = char + buf
+        yield next_value()
+
+
+def iter_objects(lines):
+    """Yields the JSON objects of a stream of concatenated ones (like kubectl get --watch -o json
+    outputs) as soon as each one is complete
+
+    >>> list(iter_objects(['{"a": 1}\\n', '{\\n', '  "b": 2\\n', '}\\n']))
+    [{'a': 1}, {'b': 2}]
+    """
+    buf = ""
+    for line in lines:
+        buf += line
+        # Lines of pretty printed objects are indented, only the last one can end it
+        if line[:1].isspace() or not buf.strip():
+            continue
+        try:
+            obj, end = _decoder.raw_decode(buf.lstrip())
+        except ValueError:
+            continue
+        yield obj
+        buf = buf.lstrip()[end:]
+
+
+def path_tokens(path):
+    r"""Splits a simple JSONPath into keys and indexes
+
+    >>> path_tokens(r"{.metadata.labels.app\.kubernetes\.io/name}")
+    ['metadata', 'labels', 'app.kubernetes.io/name']
+    >>> path_tokens(".spec.containers[*].image")
+    ['spec', 'containers', '*', 'image']
+    """
+    path = path.strip()
+    if path.startswith("{") and path.endswith("}"):
+        path = path[1:-1]
+    tokens = []
+    for part in re.split(r"(?<!\\)\.", path.lstrip(".")):
+        part = part.replace("\\.", ".")
+        key, *indexes = re.split(r"\[", part)
+        if key:
+            tokens.append(key)
+        tokens.extend(index.rstrip("]") for index in indexes)
+    return tokens
+
+
+def jsonpath(obj, path):
+    """Evaluates a simple JSONPath (.keys, [n] and [*]), returns the list of values found"""
+    values = [obj]
+    for token in path_tokens(path):
+        found = []
+        for value in values:
+            if token == "*" and isinstance(value, list):
+                found.extend(value)
+            elif isinstance(value, list) and re.fullmatch(r"-?\d+", token):
+                index = int(token)
+                if -len(value) <= index < len(value):
+                    found.append(value[index])
+            elif isinstance(value, dict) and token in value:
+                found.append(value[token])
+        values = found
+    return values
+
+
+def pod_status(pod):
+    """The STATUS kubectl get pods shows: Terminating, a container waiting/terminated reason or
+    the pod phase"""
+    if pod.get("metadata", {}).get("deletionTimestamp"):
+        return "Terminating"
+    status = pod.get("status") or {}
+    containers = [*(status.get("initContainerStatuses") or []),
+                  *(status.get("containerStatuses") or [])]
+    for container in containers:
+        state = container.get("state") or {}
+        for key in ("waiting", "terminated"):
+            reason = (state.get(key) or {}).get("reason")
+            if reason and reason != "Completed":
+                return reason
+    return status.get("reason") or status.get("phase") or ""
+
+
+COMPUTED_FIELDS = {"status": pod_status}
+
+
+def field(obj, path):
+    """Value of a column: a computed field name (see COMPUTED_FIELDS) or a JSONPath"""
+    if path in COMPUTED_FIELDS:
+        return COMPUTED_FIELDS[path](obj)
+    return ",".join(str(v) for v in jsonpath(obj, path))
+
+
+def label_matcher(selector):
+    """Returns a function telling if an object matches a selector like "app=web,tier!=db,canary"
+    """
+    checks = []
+    for term in filter(None, (t.strip() for t in selector.split(","))):
+        if "!=" in term:
+            key, value = term.split("!=", 1)
+            checks.append(lambda labels, k=key, v=value: labels.get(k) != v)
+        elif "=" in term:
+            key, value = term.split("=", 1)
+            checks.append(lambda labels, k=key, v=value.lstrip("="): labels.get(k) == v)
+        elif term.startswith("!"):
+            checks.append(lambda labels, k=term[1:]: k not in labels)
+        else:
+            checks.append(lambda labels, k=term: k in labels)
+
+    def matches(obj):
+        labels = obj.get("metadata", {}).get("labels") or {}
+        return all(check(labels) for check in checks)
+    return matches
+
+
+def regex_matcher(expression):
+    """Returns a function matching "path=regex" (or a bare regex against the name) on objects"""
+    path, sep, regex = expression.partition("=")
+    if not sep or not path.startswith((".", "{")) and path not in COMPUTED_FIELDS:
+        path, regex = ".metadata.name", expression
+    compiled = re.compile(regex)
+    return lambda obj: compiled.search(field(obj, path)) is not None
+
+
+QUANTITY_SUFFIXES = {
+    "n": 1e-9, "u": 1e-6, "m": 1e-3, "": 1, "k": 1e3, "M": 1e6, "G": 1e9, "T": 1e12, "P": 1e15,
+    "E": 1e18, "Ki": 2 ** 10, "Mi": 2 ** 20, "Gi": 2 ** 30, "Ti": 2 ** 40, "Pi": 2 ** 50,
+    "Ei": 2 ** 60,
+}
+QUANTITY_RE = re.compile(r"^([+-]?[\d.]+(?:[eE][+-]?\d+)?)([a-zA-Z]*)$")
+
+
+def parse_quantity(quantity):
+    """Converts a Kubernetes quantity to a float in base units (cores, bytes)
+
+    >>> parse_quantity("250m"), parse_quantity("2"), parse_quantity("512Ki"), parse_quantity("1G")
+    (0.25, 2.0, 524288.0, 1000000000.0)
+    """
+    match = QUANTITY_RE.match(quantity.strip())
+    if not match or match.group(2) not in QUANTITY_SUFFIXES:
+        raise ValueError(f"Invalid quantity {quantity!r}")
+    return float(match.group(1)) * QUANTITY_SUFFIXES[match.group(2)]
+
+
+POD_SUFFIX_RES = [
+    re.compile(r"^(.+)-[a-z0-9]{6,10}-[a-z0-9]{5}$"),  # Deployment: template hash and random suffix
+    re.compile(r"^(.+)-[a-z0-9]{5}$"),  # DaemonSet, Job
+    re.compile(r"^(.+)-\d+$"),  # StatefulSet ordinal
+]
+
+
+def pod_base_name(name):
+    """Name of the workload that created the pod, removing the suffixes controllers add
+
+    >>> pod_base_name("web-7d9f8c6b5d-x2k4q"), pod_base_name("agent-8xk2p"), pod_base_name("db-0")
+    ('web', 'agent', 'db')
+    """
+    for suffix_re in POD_SUFFIX_RES:
+        match = suffix_re.match(name)
+        if match:
+            return match.group(1)
+    return name
@@ -1,12 +1,31 @@
+import io
 import os
 import re
 import sys
-import tempfile
+import shlex
+import subprocess
+import json
+import time
 import base64
-import yaml
-from invoke import task, Failure
+import hashlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from invoke import task, Failure, Result, UnexpectedExit
+from . import cache, k8s_configdir, k8s_diff, k8s_logs, k8s_query, profiling
+from .lazy import lazy_import
 
+yaml = lazy_import("yaml")
+tempfile = lazy_import("tempfile")
+k8s_api = lazy_import(f"{__package__}.k8s_api")
 
+
+def _kubectl_call(command, *args, **kwargs):
+    """kubectl and its subcommand, to group the calls in the profiling summary"""
+    return " ".join(["kubectl"] + [word for word in command.split() if word[0] != "-"][:1])
+
+
+@profiling.instrumented("kubectl", _kubectl_call)
 def kubectl(c, command, **kargs):
     env = getattr(c.config, "env", {})
     if "KUBECONFIG" not in env and "KUBECONFIG" in os.environ:
@@ -14,24 +33,323 @@ def kubectl(c, command, **kargs):
     return c.run(f"kubectl {command}", env=env, **kargs)
 
 
+@profiling.instrumented("kubectl", _kubectl_call)
+def kubectl_stdin(c, command, write, hide=None, warn=False):
+    """Runs kubectl feeding its stdin with write(text_stream)
+
+    invoke's in_stream copies stdin one byte at a time with a sleep between reads, too slow for
+    manifests, so this goes through a subprocess pipe.
+    """
+    env = dict(os.environ, **getattr(c.config, "env", {}))
+    capture_out = hide in (True, "both", "out", "stdout")
+    capture_err = hide in (True, "both", "err", "stderr")
+    proc = subprocess.Popen(["kubectl"] + shlex.split(command), stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE if capture_out else None,
+                            stderr=subprocess.PIPE if capture_err else None,
+                            env=env, universal_newlines=True)
+    try:
+        write(proc.stdin)
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass  # kubectl exited early, its exit code tells why
+    stdout, stderr = proc.communicate()
+    result = Result(stdout=stdout or "", stderr=stderr or "", command=f"kubectl {command}",
+                    exited=proc.returncode)
+    if proc.returncode != 0 and not warn:
+        raise UnexpectedExit(result)
+    return result
+
+
+@contextmanager
+def kubectl_stream(c, command):
+    """Runs kubectl and yields its stdout as a text stream, to parse output as it arrives"""
+    env = dict(os.environ, **getattr(c.config, "env", {}))
+    profiling.profiler.configure(c.config)
+    with profiling.profiler.measure("kubectl", _kubectl_call(command), command) as call:
+        proc = subprocess.Popen(["kubectl"] + shlex.split(command), stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env, universal_newlines=True)
+        try:
+            yield proc.stdout
+            stderr = proc.stderr.read()
+        except BaseException:
+            proc.terminate()  # Stopped before the end, kubectl could be waiting on a watch
+            raise
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        if call is not None:  # The output went to the caller, its size isn't known
+            call.update(exited=proc.returncode, failed=proc.returncode != 0)
+        if proc.returncode != 0:
+            raise UnexpectedExit(Result(stderr=stderr, command=f"kubectl {command}",
+                                        exited=proc.returncode))
+
+
+def kube_client(c):
+    """The Kubernetes API client, if kube_api is enabled in the config and it supports the
+    kubeconfig. None means using kubectl"""
+    if not c.config.get("kube_api", False):
+        return None
+    env = getattr(c.config, "env", {})
+    return k8s_api.client_for(env.get("KUBECONFIG") or os.getenv("KUBECONFIG"))
+
+
+def _get_items(c, resource, namespace=None, selectors=()):
+    """Yields the objects of kubectl get resource -o json, namespace "all" for every namespace
+    """
+    client = kube_client(c)
+    if client is not None:
+        yield from client.list(resource, namespace, label_selector=",".join(selectors))
+        return
+    if namespace is None:
+        scope = ""
+    elif namespace == "all":
+        scope = "--all-namespaces"
+    else:
+        scope = f"-n={namespace}"
+    labels = f" -l {','.join(selectors)}" if selectors else ""
+    with kubectl_stream(c, f"get {resource} {scope}{labels} -o json") as out:
+        yield from k8s_query.iter_items(out)
+
+
 def get_annotation(c, resource, name, annotation):
     command = f"get {resource} {name} -o=jsonpath='{{.metadata.annotations.{annotation}}}'"
     ret = kubectl(c, command, hide=True)
     return ret.stdout
 
 
+_annotation_indexes = {}
+
+
+def annotation_index(c, resource, annotation, refresh=False):
+    """Maps each value of annotation to the name of the (first) resource that has it
+
+    Lists all the resources in a single kubectl call. The index is kept for the rest of the run.
+    """
+    env = getattr(c.config, "env", {})
+    key = (resource, annotation, env.get("KUBECONFIG", os.getenv("KUBECONFIG", "")))
+    if refresh or key not in _annotation_indexes:
+        client = kube_client(c)
+        if client is not None:
+            items = client.list(resource)
+        else:
+            items = json.loads(kubectl(c, f"get {resource} -o json", hide=True).stdout)["items"]
+        index = {}
+        for item in items:
+            value = (item["metadata"].get("annotations") or {}).get(annotation)
+            if value is not None:
+                index.setdefault(value, item["metadata"]["name"])
+        _annotation_indexes[key] = index
+    return _annotation_indexes[key]
+
+
 def _normalize(dirname):
     if not dirname.endswith("/"):
         return dirname + "/"
     return dirname
 
 
-def _applydelete(c, manifest, action="apply", extra_params=""):
+# Kinds other manifests may depend on, applied before (and deleted after) the rest
+FIRST_KINDS_RE = re.compile(r"^kind:\s*[\"']?(Namespace|CustomResourceDefinition)[\"']?\s*$",
+                            re.MULTILINE)
+
+
+def _manifest_tier(mfile):
+    with open(mfile, "rt") as f:
+        return 0 if FIRST_KINDS_RE.search(f.read()) else 1
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _failed_files(stderr, files):
+    """Finds which of files kubectl complained about, all of them if it doesn't say"""
+    failed = [f for f in files if f'"{f}"' in stderr]
+    return failed or files
+
+
+def _manifest_tiers(action, manifests):
+    """Returns (pods, tiers) with the Namespaces and CRDs in the first tier (last for delete)
+
+    Names that aren't files are pods to delete, or reported as missing when applying.
+    """
+    tiers = ([], [])
+    pods = []
+    for mfile in manifests:
+        if os.path.isfile(mfile):
+            tiers[_manifest_tier(mfile)].append(mfile)
+        elif action == "apply":
+            print(f"{mfile} does not exists!", file=sys.stderr)
+        else:
+            # Assume it's pod to delete - To support multiple delete from stdin
+            pods.append(mfile)
+    if action != "apply":
+        tiers = tiers[::-1]
+    return pods, tiers
+
+
+def _run_rounds(run, rounds, workers):
+    """Calls run(*job) for the jobs of each round in parallel workers, round after round"""
+    with ThreadPoolExecutor(max_workers=int(workers)) as executor:
+        for jobs in rounds:
+            for future in [executor.submit(run, *job) for job in jobs]:
+                future.result()  # Waits for the whole round before the next one
+
+
+def _check_failures(action, failures):
+    """Reports the {file: error} failures and raises Failure if there are any"""
+    if failures:
+        for mfile, error in failures.items():
+            print(f"{mfile}: {error}", file=sys.stderr)
+        raise Failure(f"{len(failures)} manifests failed to {action}")
+    return failures
+
+
+def _applydelete_batched(c, action, extra_params, manifests, batch, workers):
+    """Applies/deletes the manifests with up to batch files per kubectl call, in parallel workers
+
+    Namespaces and CRDs go in a first round (last one for delete). Returns {file: error}.
+    """
+    batch = max(int(batch), 1)
+    pods, tiers = _manifest_tiers(action, manifests)
+    failures = {}
+    print_lock = threading.Lock()
+
+    def run(command, files):
+        try:
+            ret = kubectl(c, command, hide=True)
+        except UnexpectedExit as err:
+            error = err.result.stderr.strip()
+            with print_lock:
+                print(err.result.stdout, end="")
+                for mfile in _failed_files(error, files):
+                    failures[mfile] = error
+            return
+        with print_lock:
+            print(ret.stdout, end="")
+
+    pod_jobs = [(f"{action} {extra_params} pod {' '.join(pods)}", pods)] if pods else []
+    tier_jobs = [[(f"{action} {extra_params} " + " ".join(f"-f {f}" for f in chunk), chunk)
+                  for chunk in _chunks(tier, batch)] for tier in tiers]
+    _run_rounds(run, [pod_jobs] + tier_jobs, workers)
+    return failures
+
+
+def _live_objects(c, objects):
+    """Fetches the live version of objects, with one kubectl get per namespace"""
+    client = kube_client(c)
+    if client is not None:
+        with ThreadPoolExecutor(k8s_api.POOL_SIZE) as executor:
+            return [obj for obj in executor.map(client.get_object, objects) if obj is not None]
+
+    by_namespace = {}
+    for obj in objects:
+        namespace = (obj.get("metadata") or {}).get("namespace")
+        by_namespace.setdefault(namespace, []).append(k8s_diff.resource_name(obj))
+    live = []
+    for namespace, names in by_namespace.items():
+        namespace = f" -n {namespace}" if namespace else ""
+        names = " ".join(names)
+        out = kubectl(c, f"get {names}{namespace} -o json --ignore-not-found", hide=True).stdout
+        if out.strip():
+            data = json.loads(out)
+            live.extend(data["items"] if data.get("kind") == "List" else [data])
+    return live
+
+
+def apply_changed(c, objects, **kargs):
+    """Applies only the objects that are new or differ from the live ones, printing a summary"""
+    objects = [obj for obj in objects if obj]
+    changed, unchanged, new = k8s_diff.classify(objects, _live_objects(c, objects))
+    for label, group in (("changed", changed), ("new", new)):
+        for obj in group:
+            print("{:8} {}/{}".format(label, obj["kind"].lower(), obj["metadata"]["name"]))
+    print(f"{len(changed)} changed, {len(unchanged)} unchanged, {len(new)} new")
+    to_apply = changed + new
+    client = kube_client(c)
+    if to_apply and client is not None:
+        for obj in to_apply:
+            client.apply(obj)
+    elif to_apply:
+        return kubectl_stdin(c, "apply -f -", lambda out: yaml.safe_dump_all(to_apply, out),
+                             **kargs)
+
+
+def _load_manifests(manifests):
+    objects = []
+    for mfile in manifests:
+        if not os.path.isfile(mfile):
+            print(f"{mfile} does not exists!", file=sys.stderr)
+            continue
+        with open(mfile, "rt") as f:
+            objects.extend(yaml.safe_load_all(f))
+    return objects
+
+
+def _object_ref(obj):
+    group = obj["apiVersion"].rpartition("/")[0]
+    kind = f"{obj['kind'].lower()}.{group}" if group else obj["kind"].lower()
+    return f"{kind}/{obj['metadata']['name']}"
+
+
+def _applydelete_api(client, action, manifests, workers=1, grace_period=None):
+    """Applies/deletes the objects of the manifests through the API client, files in parallel
+    workers. Namespaces and CRDs go in a first round (last one for delete). Returns
+    {file: error}"""
+    pods, tiers = _manifest_tiers(action, manifests)
+    failures = {}
+    print_lock = threading.Lock()
+
+    def run(mfile):
+        try:
+            if mfile in pods:
+                client.delete("pods", mfile, grace_period=grace_period)
+                done = [f"pod/{mfile} deleted"]
+            else:
+                with open(mfile) as f:
+                    objects = [obj for obj in yaml.safe_load_all(f) if obj]
+                done = []
+                for obj in objects:
+                    if action == "apply":
+                        client.apply(obj)
+                        done.append(f"{_object_ref(obj)} serverside-applied")
+                    else:
+                        client.delete_object(obj, grace_period=grace_period)
+                        done.append(f"{_object_ref(obj)} deleted")
+        except (k8s_api.KubeApiError, yaml.YAMLError, KeyError) as err:
+            with print_lock:
+                failures[mfile] = str(err)
+            return
+        with print_lock:
+            print("\n".join(done))
+
+    _run_rounds(run, [[(pod, ) for pod in pods]] + [[(f, ) for f in tier] for tier in tiers],
+                workers)
+    return failures
+
+
+def _manifest_list(manifest):
     if manifest == "-":
-        manifests = [f.strip() for f in sys.stdin.readlines()]
-    else:
-        manifests = [f.strip() for f in re.split(r",| |\n", manifest)
-                     if f.strip()]
+        return [f.strip() for f in sys.stdin.readlines()]
+    return [f.strip() for f in re.split(r",| |\n", manifest) if f.strip()]
+
+
+def _applydelete(c, manifest, action="apply", extra_params="", batch=0, workers=1, diff=False,
+                 grace_period=None):
+    manifests = _manifest_list(manifest)
+
+    if diff and action == "apply":
+        return apply_changed(c, _load_manifests(manifests))
+
+    client = kube_client(c)
+    if client is not None:
+        return _check_failures(
+            action, _applydelete_api(client, action, manifests, workers, grace_period))
+
+    if int(batch) > 1 or int(workers) > 1:
+        return _check_failures(
+            action, _applydelete_batched(c, action, extra_params, manifests, batch, workers))
+
     ret = None
     for mfile in manifests:
         is_file = os.path.isfile(mfile)
@@ -46,22 +364,56 @@ def _applydelete(c, manifest, action="apply", extra_params=""):
 
 
 @task
-def apply(c, manifest):
-    return _applydelete(c, manifest, "apply")
+def apply(c, manifest, batch=0, workers=1, diff=False):
+    """Applies the manifest files (comma or space separated, - reads them from stdin)
+
+    --batch N sends up to N files per kubectl call and --workers N runs N calls in parallel,
+    applying Namespaces and CRDs first. Failures are reported per file at the end.
+    --diff fetches the live objects first and only applies the new or changed ones.
+    """
+    return _applydelete(c, manifest, "apply", batch=batch, workers=workers, diff=diff)
 
 
 @task
-def kdelete(c, manifest, resource=None, force=False):
+def kdelete(c, manifest, resource=None, force=False, batch=0, workers=1):
+    grace_period = 0 if force else None
     force = "--force --grace-period=0" if force else ""
     if manifest == "-" or os.path.isfile(manifest):
-        return _applydelete(c, manifest, "delete", force)
+        return _applydelete(c, manifest, "delete", force, batch=batch, workers=workers,
+                            grace_period=grace_period)
+    client = kube_client(c)
+    resource = resource or "pod"
+    if client is not None:
+        client.delete(resource, manifest, grace_period=grace_period)
+        print(f"{resource}/{manifest} deleted")
     else:
-        resource = resource or "pod"
         kubectl(c, f"delete {resource} {force} {manifest}")
 
 
+def _describe_api(client, resource, name, namespace=None):
+    """Prints the object as YAML (without managedFields) followed by its events"""
+    obj = client.get(resource, name, namespace)
+    obj["metadata"].pop("managedFields", None)
+    print(yaml.safe_dump(obj, sort_keys=False), end="")
+    selector = f"involvedObject.name={name},involvedObject.kind={obj['kind']}"
+    events = client.list("events", obj["metadata"].get("namespace") or namespace,
+                         field_selector=selector)
+    rows = [[event.get("type", ""), event.get("reason", ""),
+             event.get("lastTimestamp") or event.get("eventTime") or "",
+             (event.get("source") or {}).get("component", ""), event.get("message", "").strip()]
+            for event in events]
+    print("Events:")
+    if rows:
+        _print_table(["TYPE", "REASON", "LAST SEEN", "FROM", "MESSAGE"], rows)
+    else:
+        print("  <none>")
+
+
 @task
 def kdescribe(c, resource, name, namespace=None):
+    client = kube_client(c)
+    if client is not None:
+        return _describe_api(client, resource, name, namespace)
     if namespace:
         namespace = f" -n {namespace}"
     else:
@@ -69,17 +421,157 @@ def kdescribe(c, resource, name, namespace=None):
     kubectl(c, f"describe {resource} {name}{namespace}")
 
 
-@task
-def krollout(c, name, action="restart", namespace=None):
+ROLLOUT_PATCHES = {
+    "restart": (lambda: {"spec": {"template": {"metadata": {"annotations": {
+        "kubectl.kubernetes.io/restartedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }}}}}, "restarted"),
+    "pause": (lambda: {"spec": {"paused": True}}, "paused"),
+    "resume": (lambda: {"spec": {"paused": False}}, "resumed"),
+}
+
+
+def _rollout_action(c, name, action, namespace=None):
+    client = kube_client(c)
+    if client is not None and action in ROLLOUT_PATCHES:
+        resource, name = name.split("/", 1)
+        patch, done = ROLLOUT_PATCHES[action]
+        client.patch(resource, name, patch(), namespace=namespace)
+        print(f"{resource}/{name} {done}")
+        return
     if namespace:
         namespace = f" -n {namespace}"
     else:
         namespace = ""
-    if "/" not in name:
-        name = "deployment/" + name
     kubectl(c, f"rollout {action} {name}{namespace}")
 
 
+def _watch_objects(c, resource, namespace=None, timeout=None):
+    """Yields the objects of resource as they change, from a single watch stream"""
+    client = kube_client(c)
+    if client is not None:
+        yield from client.watch(resource, namespace, timeout=timeout)
+        return
+    scope = f" -n={namespace}" if namespace else ""
+    request_timeout = f" --request-timeout={int(timeout)}s" if timeout else ""
+    with kubectl_stream(c, f"get {resource}{scope} -o json --watch{request_timeout}") as out:
+        yield from k8s_query.iter_objects(out)
+
+
+def _rollout_progress(obj):
+    """(desired, updated, ready, available, new_ready, state) of a Deployment or StatefulSet
+
+    state is "progressing", "done" or "failed" (progress deadline exceeded). new_ready is
+    the ready pods beyond the old ones, assuming these stay ready until replaced.
+    """
+    spec, status = obj.get("spec") or {}, obj.get("status") or {}
+    desired = spec.get("replicas", 1)
+    updated = status.get("updatedReplicas", 0)
+    ready = status.get("readyReplicas", 0)
+    available = status.get("availableReplicas", ready)
+    new_ready = ready - (status.get("replicas", 0) - updated)
+    observed = status.get("observedGeneration", 0) >= obj["metadata"].get("generation", 0)
+    if any(condition.get("reason") == "ProgressDeadlineExceeded"
+           for condition in status.get("conditions") or []):
+        state = "failed"
+    elif obj.get("kind") == "StatefulSet":
+        state = "done" if observed and updated >= desired and ready >= desired and \
+            status.get("currentRevision") == status.get("updateRevision") else "progressing"
+    else:
+        state = "done" if observed and updated >= desired and available >= desired and \
+            status.get("replicas", 0) == updated else "progressing"
+    return desired, updated, ready, available, new_ready, state
+
+
+ROLLOUT_STATES = {"done": "rolled out", "failed": "progress deadline exceeded",
+                  "timeout": "timed out"}
+
+
+def _wait_rollouts(c, names, namespace=None, timeout=300):
+    """Follows the rollouts of names ("kind/name") with a watch per kind, printing a combined
+    progress line on every change and a summary with the time to the first new pod ready and
+    to the end of each rollout"""
+    start = time.perf_counter()
+    rollouts = {}
+    for name in names:
+        resource, _, rollout_name = name.partition("/")
+        rollouts[(resource, rollout_name)] = {"state": "progressing", "progress": "waiting",
+                                              "first_ready": None, "done": None}
+    lock = threading.Lock()
+    last_line = [None]
+
+    def update(resource, obj):
+        rollout = rollouts.get((resource, obj["metadata"]["name"]))
+        if rollout is None or rollout["state"] != "progressing":
+            return
+        desired, updated, ready, available, new_ready, state = _rollout_progress(obj)
+        elapsed = time.perf_counter() - start
+        if rollout["first_ready"] is None and (new_ready > 0 or state == "done"):
+            rollout["first_ready"] = elapsed
+        rollout["state"] = state
+        if state == "done":
+            rollout["done"] = elapsed
+        rollout["progress"] = ROLLOUT_STATES.get(state) or (
+            f"{updated}/{desired} updated, {ready}/{desired} ready, "
+            f"{available}/{desired} available")
+        line = " | ".join(f"{resource}/{name} {rollout['progress']}"
+                          for (resource, name), rollout in rollouts.items())
+        if line != last_line[0]:
+            print(f"{elapsed:6.1f}s {line}")
+            last_line[0] = line
+
+    def watch(resource):
+        mine = [rollouts[key] for key in rollouts if key[0] == resource]
+        try:
+            for obj in _watch_objects(c, resource, namespace, timeout):
+                with lock:
+                    update(resource, obj)
+                    if all(rollout["state"] != "progressing" for rollout in mine):
+                        return
+        except (UnexpectedExit, k8s_api.KubeApiError) as err:
+            # kubectl exits with an error when --request-timeout ends the watch
+            if time.perf_counter() - start < timeout:
+                print(f"Watch of {resource} failed: {err}", file=sys.stderr)
+
+    watchers = [threading.Thread(target=watch, args=(resource,), daemon=True)
+                for resource in {resource for resource, _ in rollouts}]
+    for watcher in watchers:
+        watcher.start()
+    for watcher in watchers:
+        watcher.join(max(timeout - (time.perf_counter() - start), 0) + 5)
+
+    rows = []
+    with lock:
+        for (resource, name), rollout in rollouts.items():
+            if rollout["state"] == "progressing":
+                rollout["state"] = "timeout"
+            rows.append([f"{resource}/{name}", ROLLOUT_STATES[rollout["state"]]] + [
+                "-" if rollout[phase] is None else f"{rollout[phase]:.1f}s"
+                for phase in ("first_ready", "done")])
+    _print_table(["ROLLOUT", "STATUS", "FIRST READY", "ROLLED OUT"], rows)
+    failed = [row[0] for row in rows if row[1] != ROLLOUT_STATES["done"]]
+    if failed:
+        raise Failure(f"Rollout of {', '.join(failed)} didn't finish")
+
+
+@task
+def krollout(c, name, action="restart", namespace=None, wait=False, timeout=300):
+    """Runs kubectl rollout action on name, or on several comma separated names in parallel
+
+    --wait follows the rollouts (a single watch per resource type) showing the updated, ready
+    and available replicas until they finish or --timeout seconds pass. With --action status
+    it only waits.
+    """
+    names = [n if "/" in n else f"deployment/{n}" for n in name.split(",") if n]
+    if not names:
+        return
+    if not (wait and action == "status"):
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            for job in [executor.submit(_rollout_action, c, n, action, namespace) for n in names]:
+                job.result()
+    if wait:
+        _wait_rollouts(c, names, namespace, float(timeout))
+
+
 @task
 def kc(c, command):
     return kubectl(c, command)
@@ -106,19 +598,25 @@ data: #@ data.values.files
 """
 
 
-@task
-def config_from_dir(c, name, directory=None, secret=False):
+@task(iterable=["include", "exclude"])
+def config_from_dir(c, name, directory=None, secret=False, include=None, exclude=None,
+                    recursive=False, shard=False, diff=False):
+    """Creates or updates a configmap (or --secret) with the files of a directory
+
+    --include/--exclude take globs matched against the paths relative to the directory, and
+    --recursive adds the files of subdirectories (with "__" instead of "/" in the key). The
+    manifest is streamed to kubectl. Directories over the 1 MiB object limit fail, unless --shard
+    splits them in objects named <name>, <name>-1, <name>-2... --diff skips the apply when the
+    live objects already have the same data.
+    """
     config = "secret" if secret else "configmap"
 
     if "/" in name and os.path.isdir(name) and not directory:
         # name parameter is the directory, find the name of the configmap/secret
         name = _normalize(name)
-        names = kubectl(c, f"get {config} -o=name", hide=True).stdout.splitlines()
-        for n in names:
-            n = n.split("/")[1]  # removes resource prefix
-            if name == get_annotation(c, config, n, "config-from-dir"):
-                directory, name = name, n
-                break
+        existing = annotation_index(c, config, "config-from-dir").get(name)
+        if existing:
+            directory, name = name, existing
         if not directory:
             raise Failure(f"No existing {config} found with config-from-dir={name}")
 
@@ -128,48 +626,205 @@ def config_from_dir(c, name, directory=None, secret=False):
             raise Failure(f"Missing directory parameter and annotation not found")
 
     directory = _normalize(directory)
+    files = k8s_configdir.collect_files(directory, include or (), exclude or (), recursive)
+    annotations = {"config-from-dir": directory}
+
+    if not c.config.get("native_render", True):
+        values = {"name": name, "annotations": annotations, "files": {}}
+        for key, path in files:
+            file_str = open(path, "rb" if secret else "rt").read()
+            if secret:
+                values["files"][key] = base64.b64encode(file_str).decode("ascii")
+            else:
+                values["files"][key] = file_str
+        return render_template(c, YTT_CREATE_SECRET if secret else YTT_CREATE_CONFIGMAP, values,
+                               apply=True)
+
+    try:
+        shards = k8s_configdir.shard(files, secret)
+    except ValueError as err:
+        raise Failure(str(err))
+    if len(shards) > 1 and not shard:
+        raise Failure(f"{directory} doesn't fit in the 1 MiB limit of a {config}, "
+                      f"use --shard to split it in {len(shards)} objects")
+
+    def write(out):
+        for i, shard_files in enumerate(shards):
+            if i == 0:
+                k8s_configdir.write_manifest(out, name, annotations, shard_files, secret)
+            else:
+                out.write("---\n")
+                k8s_configdir.write_manifest(out, f"{name}-{i}", {"config-from-dir-shard-of": name},
+                                             shard_files, secret)
+
+    if diff:
+        rendered = io.StringIO()
+        write(rendered)
+        ret = apply_changed(c, yaml.safe_load_all(rendered.getvalue()))
+    else:
+        ret = kubectl_stdin(c, "apply -f -", write)
+    if shard:
+        _delete_stale_shards(c, config, name, len(shards))
+    return ret
 
-    template_file = tempfile.NamedTemporaryFile(suffix=".yaml", mode="wt")
-    template_file.write(YTT_CREATE_SECRET if secret else YTT_CREATE_CONFIGMAP)
-    template_file.flush()
 
-    values = {"name": name, "annotations": {"config-from-dir": directory}, "files": {}}
+def _delete_stale_shards(c, config, name, count):
+    """Deletes the shards of name over count, left by a run when the directory was bigger"""
+    current = {f"{name}-{i}" for i in range(1, count)}
+    stale = []
+    for item in _get_items(c, config):
+        metadata = item["metadata"]
+        if (metadata.get("annotations") or {}).get("config-from-dir-shard-of") != name:
+            continue
+        if metadata["name"] not in current:
+            stale.append(metadata["name"])
+    if not stale:
+        return
+    client = kube_client(c)
+    if client is not None:
+        for shard_name in stale:
+            client.delete(config, shard_name)
+            print(f"{config}/{shard_name} deleted")
+    else:
+        kubectl(c, f"delete {config} {' '.join(stale)}")
 
-    for filename in os.listdir(directory):
-        file_str = open(os.path.join(directory, filename), "rb" if secret else "rt").read()
-        if secret:
-            values["files"][filename] = base64.b64encode(file_str)
-        else:
-            values["files"][filename] = file_str
 
-    return run_ytt(c, template_file.name, values, apply=True)
+POD_INDEX_TTL = 5
 
 
-def _fuzzy_find_pod(c, podname):
-    pods = kubectl(c, "get pods", hide="out")
-    podnames = [re.split(" +", l)[0] for l in pods.stdout.splitlines()[1:]]
-    if podname not in podnames:
-        aux = [p for p in podnames if podname in p]
-        if aux and len(aux) == 1:
-            podname = aux[0]
-        elif len(aux) > 1:
-            podnames = ", ".join(aux)
-            raise Failure(f"More than one pod matching {podname}: {podnames}!")
-        else:
-            podnames = ", ".join(podnames)
-            raise Failure(f"{podname} not found in pods: {podnames}!")
-    return podname
+def _pod_index(c, namespace=None):
+    """[{name, namespace, status, created}] of the pods in namespace ("all" for every
+    namespace), cached pod_index_ttl seconds"""
+    scope = "" if namespace is None else \
+        "--all-namespaces" if namespace == "all" else f"-n={namespace}"
+    ttl = float(c.config.get("pod_index_ttl", POD_INDEX_TTL))
+    env = getattr(c.config, "env", {})
+    key = (env.get("KUBECONFIG") or os.getenv("KUBECONFIG", ""), scope)
+    entry = cache.load("pods", *key) if ttl > 0 else None
+    if cache.is_fresh(entry, ttl):
+        return entry["pods"]
+
+    pods = []
+    for pod in _get_items(c, "pods", namespace):
+        metadata = pod.get("metadata") or {}
+        pods.append({"name": metadata.get("name"), "namespace": metadata.get("namespace"),
+                     "status": k8s_query.pod_status(pod),
+                     "created": metadata.get("creationTimestamp") or ""})
+    if ttl > 0:
+        cache.store("pods", {"fetched_at": time.time(), "pods": pods}, *key)
+    return pods
+
+
+def _pod_matches(pods, podname):
+    """Pods matching podname, from the best ranked match: exact name, workload name (without
+    the suffixes controllers add), prefix and substring
+
+    The workload name goes before the prefix, as it's always a prefix too.
+    """
+    rankings = [
+        lambda pod: pod["name"] == podname,
+        lambda pod: k8s_query.pod_base_name(pod["name"]) == podname,
+        lambda pod: pod["name"].startswith(podname),
+        lambda pod: podname in pod["name"],
+    ]
+    for matches in rankings:
+        found = [pod for pod in pods if matches(pod)]
+        if found:
+            return found
+    return []
+
+
+def _fuzzy_find_pod(c, podname, namespace=None):
+    """Finds the pod matching podname, choosing the newest Running one if there are many
+
+    Returns the kubectl arguments for the pod, with -n when a namespace scope was given.
+    """
+    pods = _pod_index(c, namespace)
+    found = _pod_matches(pods, podname)
+    if not found:
+        podnames = ", ".join(pod["name"] for pod in pods)
+        raise Failure(f"{podname} not found in pods: {podnames}!")
+    if len(found) > 1:
+        running = [pod for pod in found if pod["status"] == "Running"] or found
+        pod = max(running, key=lambda pod: pod["created"])
+        others = ", ".join(p["name"] for p in found if p is not pod)
+        print(f"Using {pod['name']}, the newest Running pod matching {podname} "
+              f"(also matching: {others})", file=sys.stderr)
+    else:
+        pod = found[0]
+    if namespace is None:
+        return pod["name"]
+    return f"{pod['name']} -n={pod['namespace']}"
+
+
+def _log_targets(c, selector, container=None):
+    """[(pod, container, namespace)] of the pods matching selector (a pod name or -l label=value)
+    that have logs to show"""
+    targets = []
+    with kubectl_stream(c, f"get pods {selector} -o json") as out:
+        for pod in k8s_query.iter_items(out):
+            if (pod.get("status") or {}).get("phase") not in ("Running", "Succeeded", "Failed"):
+                continue
+            for spec in (pod.get("spec") or {}).get("containers") or []:
+                if container is None or spec["name"] == container:
+                    targets.append((pod["metadata"]["name"], spec["name"],
+                                    pod["metadata"].get("namespace")))
+    return targets
+
+
+def _multiplex_logs(c, selector, follow, tail, container, max_log_requests, include, exclude):
+    def log_command(pod, pod_container, namespace=None):
+        command = ["kubectl", "logs", pod, "-c", pod_container]
+        if namespace:
+            command += ["-n", namespace]
+        if follow:
+            command.append("--follow")
+        if tail:
+            command += ["--tail", str(tail)]
+        return command
+
+    multiplexer = k8s_logs.LogMultiplexer(
+        lambda: _log_targets(c, selector, container), log_command, include=include,
+        exclude=exclude, follow=follow, env=dict(os.environ, **getattr(c.config, "env", {})),
+        max_followers=int(max_log_requests or k8s_logs.MAX_FOLLOWERS),
+        discover_interval=float(c.config.get("logs_discover_interval",
+                                             k8s_logs.DISCOVER_INTERVAL)),
+    )
+    try:
+        multiplexer.run()
+    except k8s_logs.TooManyStreams as err:
+        raise Failure(str(err))
 
 
 @task
 def logs(c, podname, zfuzzy=False, app=False, name=False, follow=False, tail=None,
-         container=None, max_log_requests=None):
+         container=None, max_log_requests=None, multiplex=False, include=None, exclude=None,
+         namespace=None):
+    """Shows the logs of a pod, or of the pods with label app/name=podname
+
+    --multiplex (implied by --include/--exclude) runs one kubectl logs per pod and container,
+    prefixing the lines with the pod name, at most --max-log-requests at a time. --include and
+    --exclude are regexes on the lines. With --follow new pods are added as they show up.
+    --namespace all makes --zfuzzy look for the pod in every namespace, and --multiplex show
+    the logs of the matching pods of every namespace.
+    """
+    if include or exclude:
+        multiplex = True
+
     if zfuzzy:
-        podname = _fuzzy_find_pod(c, podname)
+        podname = _fuzzy_find_pod(c, podname, namespace)
     elif app:
         podname = f"-l app={podname}"
     elif name:
         podname = f"-l name={podname}"
+    if namespace not in (None, "all") and not zfuzzy:
+        podname += f" -n={namespace}"
+    elif namespace == "all" and not zfuzzy and multiplex:
+        podname += " --all-namespaces"
+
+    if multiplex:
+        return _multiplex_logs(c, podname, follow, tail, container, max_log_requests, include,
+                               exclude)
 
     if max_log_requests:
         max_log_requests = f"--max-log-requests {max_log_requests}"
@@ -183,49 +838,264 @@ def logs(c, podname, zfuzzy=False, app=False, name=False, follow=False, tail=Non
 
 
 @task
-def kshell(c, podname, zfuzzy=False, shell="sh"):
+def kshell(c, podname, zfuzzy=False, shell="sh", namespace=None):
     if zfuzzy:
-        podname = _fuzzy_find_pod(c, podname)
+        podname = _fuzzy_find_pod(c, podname, namespace)
+    elif namespace not in (None, "all"):
+        podname += f" -n={namespace}"
     return kubectl(c, f"exec -it {podname} -- {shell}", pty=True)
 
 
+TOP_GROUPS = ("namespace", "app", "node")
+APP_LABELS = ("app", "app.kubernetes.io/name")
+
+
+def _top_sample(c, resource, namespace):
+    """Runs kubectl top, returns (header, key_columns, rows) with cpu in millicores and memory
+    in MiB, whatever the units kubectl used"""
+    lines = kubectl(c, f"top {resource} {namespace}", hide=True).stdout.splitlines()
+    header = lines[0].split() if lines else []
+    if "CPU(cores)" not in header:
+        return lines[0] if lines else "", header, []
+    cpu_col, memory_col = header.index("CPU(cores)"), header.index("MEMORY(bytes)")
+    rows = []
+    for line in lines[1:]:
+        fields = line.split()
+        try:
+            cpu = k8s_query.parse_quantity(fields[cpu_col]) * 1000
+            memory = k8s_query.parse_quantity(fields[memory_col]) / 2 ** 20
+        except (IndexError, ValueError):
+            continue  # NotReady nodes show <unknown>
+        rows.append({"key": fields[:cpu_col], "line": line, "cpu": cpu, "memory": memory})
+    return lines[0], header[:cpu_col], rows
+
+
+def _pod_groups(c, namespace):
+    """Maps pod (namespace, name) and name to its namespace, app label and node, for grouping"""
+    groups = {}
+    with kubectl_stream(c, f"get pods {namespace} -o json") as out:
+        for pod in k8s_query.iter_items(out):
+            metadata = pod.get("metadata") or {}
+            labels = metadata.get("labels") or {}
+            group = {
+                "namespace": metadata.get("namespace", ""),
+                "app": next((labels[label] for label in APP_LABELS if label in labels), "<none>"),
+                "node": (pod.get("spec") or {}).get("nodeName") or "<none>",
+            }
+            groups[(group["namespace"], metadata.get("name"))] = group
+            groups.setdefault(metadata.get("name"), group)
+    return groups
+
+
+def _group_rows(c, rows, key_columns, group, resource, namespace):
+    if resource.startswith("no"):
+        return rows  # Nodes only group by node, their name
+    name_col = key_columns.index("POD" if "POD" in key_columns else "NAME")
+    ns_col = key_columns.index("NAMESPACE") if "NAMESPACE" in key_columns else None
+    pods = _pod_groups(c, namespace) if group != "namespace" or ns_col is None else {}
+
+    grouped = {}
+    for row in rows:
+        pod_namespace = row["key"][ns_col] if ns_col is not None else None
+        pod = pods.get((pod_namespace, row["key"][name_col])) or \
+            pods.get(row["key"][name_col]) or {}
+        value = pod_namespace if group == "namespace" and ns_col is not None else \
+            pod.get(group, "<none>")
+        summed = grouped.setdefault(value, {"key": [value], "cpu": 0, "memory": 0, "count": 0})
+        summed["cpu"] += row["cpu"]
+        summed["memory"] += row["memory"]
+        summed["count"] += 1
+    return list(grouped.values())
+
+
+def _top_table(key_columns, rows, previous=None):
+    headers = key_columns + ["CPU(m)", "MEMORY(Mi)"]
+    if rows and "count" in rows[0]:
+        headers.append("COUNT")
+    if previous is not None:
+        headers += ["CPU-DELTA", "MEMORY-DELTA"]
+    table = []
+    for row in rows:
+        line = row["key"] + [f"{row['cpu']:.0f}", f"{row['memory']:.0f}"]
+        if "count" in row:
+            line.append(str(row["count"]))
+        if previous is not None:
+            before = previous.get(tuple(row["key"]))
+            if before is None:
+                line += ["new", "new"]
+            else:
+                line += [f"{row['cpu'] - before['cpu']:+.0f}",
+                         f"{row['memory'] - before['memory']:+.0f}"]
+        table.append(line)
+    _print_table(headers, table)
+
+
+def _within(value, limit):
+    """limit > 0 keeps values over it, limit < 0 keeps values under -limit"""
+    return limit is None or (value >= limit if limit > 0 else value <= -limit)
+
+
 @task
-def ktop(c, resource="nodes", cpu=None, memory=None):
-    command =f"top {resource}"
-    if cpu is None and memory is None:
-        return kubectl(c, command)
+def ktop(c, resource="nodes", cpu=None, memory=None, sort=None, group=None, top=None,
+         namespace=None, watch=False, interval=5, samples=0):
+    """Runs kubectl top
+
+    --cpu (millicores) and --memory (MiB) keep the lines using more than the value, or less
+    if negative. --sort cpu|memory sorts descending and --top N keeps the first N.
+    --group namespace|app|node sums pods by namespace, app label or node. --watch samples every
+    --interval seconds (--samples times, or until interrupted) showing the change since the
+    previous sample.
+    """
+    if group is not None and group not in TOP_GROUPS:
+        raise Failure(f"--group must be one of {', '.join(TOP_GROUPS)}")
+    if sort is not None and sort not in ("cpu", "memory"):
+        raise Failure("--sort must be cpu or memory")
+
+    if namespace is None:
+        namespace = ""
+    elif namespace == "all":
+        namespace = "--all-namespaces"
+    else:
+        namespace = f"-n={namespace}"
+
+    parsed = any(option is not None for option in (cpu, memory, sort, group, top)) or watch
+    if not parsed:
+        return kubectl(c, f"top {resource} {namespace}")
 
     cpu = cpu and int(cpu)
-    memory = memory and int(memory)
-
-    out = kubectl(c, command, hide=True)
-    lines = out.stdout.splitlines()
-
-    for line in lines:
-        line_cpu = re.findall(r"\s(\d+)m", line)
-        line_memory = re.findall(r"\s(\d+)Mi", line)
-        if cpu and line_cpu:
-            line_cpu = int(line_cpu[0])
-            if cpu > 0 and line_cpu < cpu:
-                # Skip lines with LESS than CPU parameter
-                continue
-            if cpu < 0 and line_cpu > -cpu:
-                # Skip lines with MORE than CPU parameter
-                continue
-        if memory and line_memory:
-            line_memory = int(line_memory[0])
-            if memory > 0 and line_memory < memory:
-                # Skip lines with LESS than memory parameter
-                continue
-            if memory < 0 and line_memory > -memory:
-                # Skip lines with MORE than memory parameter
-                continue
-        print(line.rstrip("\n"))
+    memory = memory and float(memory)
+    if (group or watch) and sort is None:
+        sort = "cpu"
+
+    previous = None
+    sample = 0
+    try:
+        while True:
+            header, key_columns, rows = _top_sample(c, resource, namespace)
+            rows = [row for row in rows if _within(row["cpu"], cpu or None)]
+            rows = [row for row in rows if _within(row["memory"], memory or None)]
+            if group:
+                rows = _group_rows(c, rows, key_columns, group, resource, namespace)
+                key_columns = [group.upper()] if not resource.startswith("no") else key_columns
+            if sort:
+                rows.sort(key=lambda row: row[sort], reverse=True)
+            if top:
+                rows = rows[:int(top)]
+
+            if watch:
+                if previous is not None:
+                    print()
+                print(time.strftime("%H:%M:%S"))
+                _top_table(key_columns, rows, previous)
+            elif group:
+                _top_table(key_columns, rows)
+            else:
+                print(header)
+                for row in rows:
+                    print(row["line"].rstrip("\n"))
+            if not watch:
+                return
+
+            previous = {tuple(row["key"]): row for row in rows}
+            sample += 1
+            if samples and sample >= int(samples):
+                return
+            time.sleep(float(interval))
+    except KeyboardInterrupt:
+        pass
+
+
+KGET_CACHE_TTL = 5
+KGET_COLUMNS = "NAME=.metadata.name"
+KGET_POD_COLUMNS = "NAME=.metadata.name,STATUS=status,NODE=.spec.nodeName"
+
+
+def _parse_columns(columns):
+    """Parses "HEADER=path,path2" in [(header, path)], the header defaults to the last key"""
+    parsed = []
+    for column in columns.split(","):
+        header, sep, path = column.partition("=")
+        if not sep:
+            path = header
+            header = k8s_query.path_tokens(path)[-1].upper()
+        parsed.append((header, path))
+    return parsed
+
+
+def _query_rows(c, resource, namespace, selectors, filters, columns, filter_key):
+    """Rows of the objects of kubectl get that pass all filters, cached a few seconds"""
+    ttl = float(c.config.get("kget_cache_ttl", KGET_CACHE_TTL))
+    env = getattr(c.config, "env", {})
+    key = (env.get("KUBECONFIG") or os.getenv("KUBECONFIG", ""), resource, str(namespace),
+           ",".join(selectors), filter_key, json.dumps(columns))
+    entry = cache.load("kget", *key) if ttl > 0 else None
+    if cache.is_fresh(entry, ttl):
+        return entry["rows"]
+
+    rows = []
+    for item in _get_items(c, resource, namespace, selectors):
+        if all(check(item) for check in filters):
+            rows.append([k8s_query.field(item, path) for _, path in columns])
+    if ttl > 0:
+        cache.store("kget", {"fetched_at": time.time(), "rows": rows}, *key)
+    return rows
+
+
+def _table_lines(headers, rows):
+    widths = [max([len(h)] + [len(row[i]) for row in rows]) for i, h in enumerate(headers)]
+    return ["   ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
+            for row in [headers] + rows]
+
+
+def _print_table(headers, rows, keep_header=True):
+    for line in _table_lines(headers, rows)[0 if keep_header else 1:]:
+        print(line)
+
+
+def _kget_structured(c, resource, namespace, selectors, grep, status, node, label, match,
+                     columns, keep_header, llist):
+    if columns is None:
+        columns = KGET_POD_COLUMNS if resource in ("po", "pod", "pods") else KGET_COLUMNS
+        if namespace == "all":
+            columns = f"NAMESPACE=.metadata.namespace,{columns}"
+    columns = _parse_columns(columns)
+
+    filters = []
+    if status:
+        filters.append(lambda obj: k8s_query.pod_status(obj).lower() == status.lower())
+    if node:
+        filters.append(lambda obj: (obj.get("spec") or {}).get("nodeName") == node)
+    if label:
+        filters.append(k8s_query.label_matcher(label))
+    filters.extend(k8s_query.regex_matcher(expression) for expression in match or [])
+    filter_key = json.dumps([status, node, label, match or []])
+
+    rows = _query_rows(c, resource, namespace, selectors, filters, columns, filter_key)
+    if grep:
+        rows = [row for row in rows if any(grep in value for value in row)]
 
+    if llist:
+        names = [i for i, (_, path) in enumerate(columns) if path == ".metadata.name"] or [0]
+        for row in rows:
+            print(row[names[0]])
+        return
+    _print_table([header for header, _ in columns], rows, keep_header)
 
-@task
+
+@task(iterable=["match"])
 def kget(c, resource="pods", grep=None, status=None, keep_header=True, namespace=None,
-         name=None, app=None, llist=False, wide=False, node=None):
+         name=None, app=None, llist=False, wide=False, node=None, structured=False,
+         columns=None, label=None, match=None):
+    """Runs kubectl get
+
+    --structured reads -o json and does the filtering in Python: --status (the STATUS kubectl
+    shows for pods), --node, --label (a selector like "app=web,tier!=db") and --match
+    ("path=regex", or a regex on the name, repeatable). --columns picks what to show as
+    "HEADER=.json.path,..." (status is also a column). Results are cached kget_cache_ttl seconds.
+    """
+    if columns or label or match:
+        structured = True
+
     if grep:
         hide = "out"
     else:
@@ -234,30 +1104,40 @@ def kget(c, resource="pods", grep=None, status=None, keep_header=True, namespace
     if llist:
         keep_header = False
 
-    if namespace is None:
-        namespace = ""
-    elif namespace == "all":
-        namespace = "--all-namespaces"
-    else:
-        namespace = f"-n={namespace}"
-
-    label_filter = ""
+    selectors = []
     if app:
-        label_filter += f" -l app={app}"
+        selectors.append(f"app={app}")
     if name:
-        label_filter += f" -l name={name}"
+        selectors.append(f"name={name}")
 
-    options = ""
-    if wide:
-        options += " -o wide"
-    if node:
-        options += f" --field-selector spec.nodeName={node}"
+    if structured:
+        return _kget_structured(c, resource, namespace, selectors, grep, status, node, label,
+                                match, columns, keep_header, llist)
 
-    out = kubectl(c, f"get {resource} {namespace}{label_filter}{options}", hide=hide)
-    if hide is None:
-        return
+    client = kube_client(c)
+    if client is not None:
+        headers, rows = client.table(resource, namespace, label_selector=",".join(selectors),
+                                     field_selector=node and f"spec.nodeName={node}", wide=wide)
+        lines = _table_lines(headers, rows)
+    else:
+        if namespace is None:
+            namespace = ""
+        elif namespace == "all":
+            namespace = "--all-namespaces"
+        else:
+            namespace = f"-n={namespace}"
 
-    lines = out.stdout.splitlines()
+        label_filter = "".join(f" -l {selector}" for selector in selectors)
+        options = ""
+        if wide:
+            options += " -o wide"
+        if node:
+            options += f" --field-selector spec.nodeName={node}"
+
+        out = kubectl(c, f"get {resource} {namespace}{label_filter}{options}", hide=hide)
+        if hide is None:
+            return
+        lines = out.stdout.splitlines()
 
     if grep:
         lines = [l for i, l in enumerate(lines) if grep in l or keep_header and i == 0]
@@ -271,7 +1151,58 @@ def kget(c, resource="pods", grep=None, status=None, keep_header=True, namespace
             print(l.rstrip("\n"))
 
 
+NATIVE_TEMPLATES = {YTT_CREATE_CONFIGMAP: "ConfigMap", YTT_CREATE_SECRET: "Secret"}
+
+
+def render_native(template, values):
+    """Renders the templates defined in this module without ytt, returns None for any other"""
+    kind = NATIVE_TEMPLATES.get(template)
+    if kind is None:
+        return None
+    manifest = {"apiVersion": "v1", "kind": kind}
+    if kind == "Secret":
+        manifest["type"] = "Opaque"
+    manifest["metadata"] = {"name": values["name"], "annotations": values["annotations"]}
+    manifest["data"] = values["files"]
+    return yaml.safe_dump(manifest, sort_keys=False)
+
+
+def _output_rendered(c, rendered, output_file=None, apply=False, **kargs):
+    if output_file:
+        with open(output_file, "wt") as f:
+            f.write(rendered)
+        if apply:
+            return kubectl(c, f"apply -f {output_file}", **kargs)
+        return Result(stdout=rendered)
+    if apply:
+        return kubectl_stdin(c, "apply -f -", lambda out: out.write(rendered), **kargs)
+    print(rendered, end="")
+    return Result(stdout=rendered)
+
+
+def render_template(c, template, values, output_file=None, apply=False, **kargs):
+    """Renders the template text natively if possible (see NATIVE_TEMPLATES), else with ytt"""
+    rendered = render_native(template, values) if c.config.get("native_render", True) else None
+    if rendered is not None:
+        return _output_rendered(c, rendered, output_file, apply, **kargs)
+    with tempfile.NamedTemporaryFile(suffix=".yaml", mode="wt") as template_file:
+        template_file.write(template)
+        template_file.flush()
+        return run_ytt(c, template_file.name, values, output_file, apply, **kargs)
+
+
+def _ytt_call(template, *args, **kwargs):
+    return f"ytt {os.path.basename(template)}"
+
+
+@profiling.instrumented("ytt", _ytt_call)
 def run_ytt(c, template, values=None, output_file=None, apply=False, **kargs):
+    if values is not None and c.config.get("native_render", True):
+        with open(template, "rt") as f:
+            rendered = render_native(f.read(), values)
+        if rendered is not None:
+            return _output_rendered(c, rendered, output_file, apply, **kargs)
+
     f_param = [f"-f {template}"]
 
     if values is not None:
@@ -308,8 +1239,8 @@ def ytt(c, template, values=[], output_file=None, apply=False):
     return run_ytt(c, template, values=values_dict, apply=apply)
 
 
-@task
-def generate_templates(c, template_file=None, output_file=None, apply=False):
+def _template_outputs(c, template_file=None, output_file=None):
+    """Yields (template, output file, values) for each output configured in config.templates"""
     templates = c.config.templates
 
     for template_filename, params in templates.items():
@@ -322,5 +1253,96 @@ def generate_templates(c, template_file=None, output_file=None, apply=False):
                 continue  # Only generate specific output
             values = dict(default_values)
             values.update(out_file_config.get("values", {}))
+            yield template_filename, out_file, values
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _generate_incremental(c, outputs, incremental, workers, apply=False):
+    """Renders the outputs whose template or values changed since the last run, in parallel
+
+    Returns the output files to apply: the generated ones and, with apply, the ones not applied
+    yet. The hashes of the inputs and of the generated file are kept in the user cache, per
+    working directory, with whether the file was applied (see _mark_applied).
+    """
+    state_key = os.path.abspath(".")
+    state = (cache.load("templates", state_key) or {}) if incremental else {}
+    template_digests = {}
+    stale = []
+    unapplied = []
+    for template_filename, out_file, values in outputs:
+        if template_filename not in template_digests:
+            template_digests[template_filename] = _file_digest(template_filename)
+        inputs = hashlib.sha256("\0".join([
+            template_digests[template_filename], out_file,
+            json.dumps(values, sort_keys=True, default=str)]).encode("utf-8")).hexdigest()
+        previous = state.get(out_file, {})
+        unchanged = previous.get("inputs") == inputs and os.path.exists(out_file)
+        if unchanged and previous.get("output") == _file_digest(out_file):
+            if apply and not previous.get("applied", True):
+                unapplied.append(out_file)
+            continue
+        stale.append((template_filename, out_file, values, inputs))
+
+    def render(job):
+        template_filename, out_file, values, inputs = job
+        try:
+            run_ytt(c, template_filename, values=values, output_file=out_file)
+        except Exception as err:
+            return err
+        state[out_file] = {"inputs": inputs, "output": _file_digest(out_file), "applied": False}
+
+    with ThreadPoolExecutor(max_workers=int(workers)) as executor:
+        errors = {job[1]: err for job, err in zip(stale, executor.map(render, stale)) if err}
+    if incremental:
+        cache.store("templates", state, state_key)
+    print(f"{len(stale) - len(errors)} of {len(outputs)} outputs generated", file=sys.stderr)
+    if errors:
+        for out_file, err in errors.items():
+            print(f"{out_file}: {err}", file=sys.stderr)
+        raise Failure(f"{len(errors)} outputs failed to generate")
+    return [job[1] for job in stale] + unapplied
+
+
+def _mark_applied(out_files):
+    """Records in the incremental state that the output files were applied"""
+    state_key = os.path.abspath(".")
+    state = cache.load("templates", state_key) or {}
+    for out_file in out_files:
+        if out_file in state:
+            state[out_file]["applied"] = True
+    cache.store("templates", state, state_key)
+
+
+@task
+def generate_templates(c, template_file=None, output_file=None, apply=False, incremental=False,
+                       workers=1, diff=False):
+    """Generates the outputs of config.templates with ytt
+
+    --incremental skips the outputs whose template, values and generated file didn't change
+    since the last run, and with --apply only the regenerated outputs, and those whose apply
+    didn't succeed yet, are applied.
+    --workers N renders N outputs at a time. --diff applies only the objects that differ from
+    the live ones.
+    """
+    outputs = list(_template_outputs(c, template_file, output_file))
+    if not incremental and int(workers) <= 1:
+        for template_filename, out_file, values in outputs:
             run_ytt(c, template_filename, values=values,
-                    output_file=out_file, apply=apply)
+                    output_file=out_file, apply=apply and not diff)
+        generated = [out_file for _, out_file, _ in outputs]
+    else:
+        generated = _generate_incremental(c, outputs, incremental, workers, apply)
+        if apply and generated and not diff:
+            _applydelete(c, ",".join(generated), "apply", batch=len(generated))
+
+    if apply and generated and diff:
+        apply_changed(c, _load_manifests(generated))
+    if apply and generated and incremental:
+        _mark_applied(generated)  # Only reached when the apply succeeded
@@ -0,0 +1,36 @@
+"""Deferred imports, so loading the tasks doesn't pay for modules only some tasks use"""
+import sys
+import importlib
+
+
+class LazyModule:
+    """Stands for a module that is imported the first time one of its attributes is used
+
+    importlib.import_module takes the import lock, so concurrent first uses from several
+    threads are safe.
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name):
+    """The module if it's already imported, a LazyModule otherwise"""
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
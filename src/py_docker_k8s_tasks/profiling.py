@@ -0,0 +1,151 @@
+"""Opt-in timing of the subprocesses and HTTP calls the tasks make
+
+Enabled with config.profile = true, or with config.profile_trace = "trace.json" that also
+writes the calls in Chrome trace format (open it in chrome://tracing or ui.perfetto.dev). When
+the run ends, a table of the calls grouped by kind and command is printed to stderr.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+
+class Profiler:
+    """Collects the calls measured in this process, does nothing until configure() enables it"""
+
+    def __init__(self):
+        self.active = False
+        self.trace_file = None
+        self.calls = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def configure(self, config):
+        """Enables profiling if the invoke config asks for it, returns if it's enabled"""
+        if not self.active and (config.get("profile", False) or config.get("profile_trace")):
+            self.active = True
+            self.trace_file = config.get("profile_trace")
+            atexit.register(self.report)
+        return self.active
+
+    @contextmanager
+    def measure(self, kind, name, command=None):
+        """Times the block, yielding a dict where the caller can set exited and stdout_bytes
+
+        Yields None when profiling isn't enabled.
+        """
+        if not self.active:
+            yield None
+            return
+        call = {"kind": kind, "name": name, "command": command or name, "exited": None,
+                "stdout_bytes": None, "failed": False, "thread": threading.get_ident()}
+        start = time.perf_counter()
+        try:
+            yield call
+        except BaseException as err:
+            # Results and Responses of failed calls are falsy, so no "or" between them
+            result = getattr(err, "result", None)
+            set_result(call, result if result is not None else getattr(err, "response", None))
+            if call["exited"] is None:
+                call["exited"] = type(err).__name__
+            call["failed"] = True
+            raise
+        finally:
+            call["start"] = start - self._origin
+            call["duration"] = time.perf_counter() - start
+            with self._lock:
+                self.calls.append(call)
+
+    def summary(self):
+        """[(kind, name, calls, total, max, failed, stdout bytes)], slowest total first"""
+        groups = {}
+        with self._lock:
+            calls = list(self.calls)
+        for call in calls:
+            group = groups.setdefault((call["kind"], call["name"]), [0, 0.0, 0.0, 0, 0])
+            group[0] += 1
+            group[1] += call["duration"]
+            group[2] = max(group[2], call["duration"])
+            group[3] += call["failed"]
+            group[4] += call["stdout_bytes"] or 0
+        rows = [key + tuple(values) for key, values in groups.items()]
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+
+    def print_summary(self, out=None):
+        out = out or sys.stderr
+        rows = [(kind, name, str(calls), f"{total:.3f}s", f"{total / calls:.3f}s",
+                 f"{longest:.3f}s", str(failed), str(stdout_bytes))
+                for kind, name, calls, total, longest, failed, stdout_bytes in self.summary()]
+        headers = ("KIND", "COMMAND", "CALLS", "TOTAL", "MEAN", "MAX", "FAILED", "STDOUT")
+        widths = [max(len(str(cell)) for cell in column) for column in zip(headers, *rows)]
+        for row in [headers] + rows:
+            print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip(),
+                  file=out)
+
+    def trace(self):
+        """The calls as a Chrome trace, complete ("X") events in microseconds"""
+        with self._lock:
+            calls = list(self.calls)
+        events = [{
+            "name": call["name"],
+            "cat": call["kind"],
+            "ph": "X",
+            "ts": round(call["start"] * 1e6),
+            "dur": round(call["duration"] * 1e6),
+            "pid": os.getpid(),
+            "tid": call["thread"],
+            "args": {"command": call["command"], "exited": call["exited"],
+                     "stdout_bytes": call["stdout_bytes"]},
+        } for call in calls]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def report(self):
+        if not self.calls:
+            return
+        self.print_summary()
+        if self.trace_file:
+            with open(self.trace_file, "wt") as f:
+                json.dump(self.trace(), f)
+            print(f"Trace written to {self.trace_file}", file=sys.stderr)
+
+
+def set_result(call, result):
+    """Fills exited and stdout_bytes from an invoke Result or a requests Response"""
+    if call is None or result is None:
+        return
+    if hasattr(result, "status_code"):
+        call["exited"] = result.status_code
+        call["failed"] = result.status_code >= 400
+        call["stdout_bytes"] = len(result.content)
+    else:
+        call["exited"] = getattr(result, "exited", 0)
+        call["failed"] = call["exited"] != 0
+        stdout = getattr(result, "stdout", "") or ""
+        call["stdout_bytes"] = len(stdout.encode(errors="replace"))
+
+
+profiler = Profiler()
+
+
+def instrumented(kind, name):
+    """Decorator for fn(c, ...) returning a Result or Response, times it if profiling is enabled
+
+    name(*args, **kwargs), with the arguments after c, gives the command the call is grouped
+    under in the summary. The first of them, if a string, is kept whole in the trace.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(c, *args, **kwargs):
+            if not profiler.configure(c.config):
+                return fn(c, *args, **kwargs)
+            command = args[0] if args and isinstance(args[0], str) else None
+            with profiler.measure(kind, name(*args, **kwargs), command) as call:
+                result = fn(c, *args, **kwargs)
+                set_result(call, result)
+                return result
+        return wrapper
+    return decorator
@@ -1,6 +1,7 @@
 import time
 import re
-from invoke import task
+import fnmatch
+from invoke import task, Collection
 from invoke.tasks import Task
 
 REGEX_TYPE = type(re.compile('hello, world'))
@@ -38,29 +39,112 @@ def ramdisk(c, path="/mnt/memdisk", size="300m", sudo=True):
     c.run(mount_ramdisk.format(**locals()))
 
 
-def _filter_task(task, filter):
+GLOB_CHARS = "*?["
+
+
+def _compile_specs(specs):
+    """(names, regexes) matching any of specs, the globs are joined in a single regex
+
+    The compiled regexes are kept apart, as their inline flags like (?i) can't be joined.
+    """
+    names = set()
+    regexes = []
+    globs = []
+    for spec in specs:
+        if isinstance(spec, REGEX_TYPE):
+            regexes.append(spec)
+        elif any(char in spec for char in GLOB_CHARS):
+            globs.append(f"(?:{fnmatch.translate(spec)})")
+        else:
+            names.add(spec)
+    if globs:
+        regexes.append(re.compile("|".join(globs)))
+    return names, regexes
+
+
+def compile_filter(filter):
+    """Compiles a task filter into a function that takes a task name and returns a bool
+
+    The filter can be None (every task), a task name, a glob ("k*"), a compiled regex (matched
+    at the start of the name), a "!"-prefixed name or glob to exclude, or a list mixing them.
+    A name passes if it matches any of the inclusions (or there are only exclusions) and no
+    exclusion, so an empty list lets no task through.
+    """
     if filter is None:
-        return True
-    elif isinstance(filter, str):
-        return task.name == filter
-    elif isinstance(filter, REGEX_TYPE):
-        return filter.match(task.name) is not None
-    elif isinstance(filter, list):
-        # List of task names
-        for f in filter:
-            if _filter_task(task):
-                return True
-        return False
-    raise NotImplementedError("Unrecognized filter: {}".format(filter))
-
-
-def add_tasks(namespace, module, filter=None):
-    for var_name in dir(module):
-        task_ = getattr(module, var_name)
-        if not isinstance(task_, Task):
-            continue
-
-        if not _filter_task(task_, filter):
-            continue
-
-        namespace.add_task(task_)
+        return lambda name: True
+    specs = filter if isinstance(filter, (list, tuple)) else [filter]
+    include, exclude = [], []
+    for spec in specs:
+        if isinstance(spec, str) and spec.startswith("!"):
+            exclude.append(spec[1:])
+        elif isinstance(spec, (str, REGEX_TYPE)):
+            include.append(spec)
+        else:
+            raise NotImplementedError("Unrecognized filter: {}".format(spec))
+
+    include_names, include_res = _compile_specs(include)
+    exclude_names, exclude_res = _compile_specs(exclude)
+    include_all = not include and bool(exclude)
+
+    def matches(name):
+        if name in exclude_names or any(regex.match(name) for regex in exclude_res):
+            return False
+        if include_all or name in include_names:
+            return True
+        return any(regex.match(name) for regex in include_res)
+
+    return matches
+
+
+def _filter_task(task, filter):
+    return compile_filter(filter)(task.name)
+
+
+_task_registries = {}
+
+
+def task_registry(module):
+    """Tasks defined in module, collected once per module"""
+    tasks = _task_registries.get(module.__name__)
+    if tasks is None:
+        tasks = tuple(value for value in vars(module).values() if isinstance(value, Task))
+        _task_registries[module.__name__] = tasks
+    return tasks
+
+
+def _sub_collection(namespace, collection):
+    """The sub-collection of namespace named collection, added under every alias if a list"""
+    names = [collection] if isinstance(collection, str) else list(collection)
+    sub = next((namespace.collections[namespace.transform(name)] for name in names
+                if namespace.transform(name) in namespace.collections), None)
+    if sub is None:
+        sub = Collection(names[0])
+    for name in names:
+        if namespace.transform(name) not in namespace.collections:
+            namespace.add_collection(sub, name=name)
+    return sub
+
+
+def add_tasks(namespace, module, filter=None, aliases=None, collection=None):
+    """Adds the tasks of module, or of a list of modules, that pass filter to namespace
+
+    The filter is compiled once (see compile_filter). aliases maps task names to an alias or a
+    list of aliases. With collection, a name or a list of names, the tasks go in a
+    sub-collection of namespace reachable under each of them.
+    """
+    matches = compile_filter(filter)
+    modules = module if isinstance(module, (list, tuple)) else [module]
+    if collection is not None:
+        namespace = _sub_collection(namespace, collection)
+    aliases = aliases or {}
+
+    added = set()
+    for module_ in modules:
+        for task_ in task_registry(module_):
+            if id(task_) in added or not matches(task_.name):
+                continue
+            added.add(id(task_))
+            task_aliases = aliases.get(task_.name, ())
+            if isinstance(task_aliases, str):
+                task_aliases = [task_aliases]
+            namespace.add_task(task_, aliases=task_aliases)
@@ -0,0 +1,26 @@
+import os
+import threading
+
+import pytest
+
+from .stubs import FakeRegistry
+
+
+@pytest.fixture
+def bin_dir(tmp_path, monkeypatch):
+    """A directory first in PATH, for the stubs of the tools the tasks run"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    return bin_dir
+
+
+@pytest.fixture
+def registry(request):
+    tags = [f"1.{i // 1000}.{i % 1000}" for i in range(50000)] + ["latest"]
+    server = FakeRegistry(tags, use_link=getattr(request, "param", True))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,118 @@
+"""Stand-ins for the tools and services the tasks talk to"""
+import json
+import stat
+import hashlib
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+# Logs "<tool> <args>" to $STUB_LOG and sleeps $STUB_<TOOL>_LATENCY, or $STUB_LATENCY, seconds
+TOOL_STUB = """#!/bin/sh
+echo "{tool} $*" >> "$STUB_LOG"
+sleep "${{STUB_{variable}_LATENCY:-${{STUB_LATENCY:-0}}}}"
+{body}"""
+
+TOOL_BODIES = {
+    "kubectl": """case "$1" in
+  apply)
+    for arg in "$@"; do
+      case "$arg" in
+        -) cat > /dev/null;;
+        *.yaml) echo "configured $arg";;
+      esac
+    done;;
+  get)
+    if [ -n "$STUB_KUBECTL_OUTPUT" ]; then
+      cat "$STUB_KUBECTL_OUTPUT"
+    else
+      echo '{"kind": "List", "items": []}'
+    fi;;
+esac
+""",
+    "ytt": "printf 'apiVersion: v1\\nkind: ConfigMap\\n'\n",
+    "docker": "",
+    "aws": "echo '{\"authorizationToken\": \"QVdTOnNlY3JldA==\", "  # AWS:secret
+           "\"expiresAt\": \"2100-01-01T00:00:00+00:00\"}'\n",
+    "gcloud": "echo '{\"credential\": {\"access_token\": \"gcloud-token\", "
+              "\"token_expiry\": \"2100-01-01T00:00:00Z\"}}'\n",
+}
+
+
+def install_stub(bin_dir, name, script):
+    path = bin_dir / name
+    path.write_text(script)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+
+def install_tool_stubs(bin_dir):
+    """Installs the stubs of TOOL_BODIES, the calls go to the file in $STUB_LOG"""
+    for tool, body in TOOL_BODIES.items():
+        install_stub(bin_dir, tool, TOOL_STUB.format(tool=tool, variable=tool.upper(), body=body))
+
+
+class FakeRegistry(ThreadingHTTPServer):
+    """Minimal stand-in for the Registry v2 tags API, paginated with Link headers"""
+
+    def __init__(self, tags, use_link=True):
+        super().__init__(("127.0.0.1", 0), FakeRegistryHandler)
+        self.tags = tags
+        self.use_link = use_link
+        self.requests = 0
+        self.not_modified = 0
+        self.delay = 0
+        self.inflight = 0
+        self.max_inflight = 0  # Most requests served at the same time
+        self.lock = threading.Lock()
+        self.authorization = None  # When set, requests with another Authorization get a 401
+
+    @property
+    def address(self):
+        return "{}:{}".format(*self.server_address)
+
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.inflight += 1
+            self.server.max_inflight = max(self.server.max_inflight, self.server.inflight)
+        try:
+            self._get()
+        finally:
+            with self.server.lock:
+                self.server.inflight -= 1
+
+    def _get(self):
+        time.sleep(self.server.delay)
+        if self.server.authorization not in (None, self.headers.get("Authorization")):
+            self.send_response(401)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        n = int(query.get("n", ["100"])[0])
+        start = 0
+        if "last" in query:
+            start = self.server.tags.index(query["last"][0]) + 1
+        page = self.server.tags[start:start + n]
+        body = json.dumps({"name": "image", "tags": page}).encode()
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.server.not_modified += 1
+            self.send_response(304)
+        else:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        if self.server.use_link and start + n < len(self.server.tags):
+            self.send_header("Link", f'<{url.path}?n={n}&last={page[-1]}>; rel="next"')
+        self.end_headers()
+        if self.headers.get("If-None-Match") != etag:
+            self.wfile.write(body)
@@ -0,0 +1,156 @@
+"""End to end timings and subprocess counts of the slow tasks, checked against benchmarks.json
+
+The tools are stubs that sleep BENCH_LATENCY seconds per call (0.05 by default) and the
+registry is a local server, reached through HTTP_PROXY so the registry names keep their cloud
+provider. A benchmark fails if it runs more subprocesses or registry requests than its
+baseline, or takes longer than BENCH_TOLERANCE times the baseline time plus BENCH_SLACK
+seconds, when the baseline was taken with the same latency. A benchmark without a baseline
+fails, run with BENCH_UPDATE=1 to record it (and to replace the existing ones).
+"""
+import os
+import json
+import time
+from collections import Counter
+from pathlib import Path
+
+import pytest
+from invoke import Config, Context
+
+from py_docker_k8s_tasks import docker_tasks, k8s_tasks
+from .stubs import install_tool_stubs
+
+BASELINES_FILE = Path(__file__).with_name("benchmarks.json")
+LATENCY = os.getenv("BENCH_LATENCY", "0.05")
+TOLERANCE = float(os.getenv("BENCH_TOLERANCE", "2"))
+SLACK = float(os.getenv("BENCH_SLACK", "0.25"))
+UPDATE = os.getenv("BENCH_UPDATE", "") not in ("", "0")
+
+
+@pytest.fixture(scope="module")
+def baselines():
+    """(saved baselines, results measured in this run), with BENCH_UPDATE=1 the results are
+    stored at the end"""
+    saved = json.loads(BASELINES_FILE.read_text()) if BASELINES_FILE.exists() else {}
+    measured = {}
+    yield saved, measured
+    if UPDATE and measured:
+        BASELINES_FILE.write_text(
+            json.dumps(dict(saved, **measured), indent=2, sort_keys=True) + "\n")
+
+
+@pytest.fixture
+def bench(bin_dir, tmp_path, monkeypatch, registry, baselines):
+    """Returns bench(name, function, *args, **kargs), that times the call and counts the
+    subprocesses it runs by tool, and the registry requests as "http"
+    """
+    install_tool_stubs(bin_dir)
+    log = tmp_path / "stubs.log"
+    monkeypatch.setenv("STUB_LOG", str(log))
+    monkeypatch.setenv("STUB_LATENCY", LATENCY)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv("HTTP_PROXY", f"http://{registry.address}")
+    for var in ("NO_PROXY", "no_proxy", "http_proxy", "AWS_TOKEN", "GCLOUD_TOKEN", "KUBECONFIG"):
+        monkeypatch.delenv(var, raising=False)
+    monkeypatch.setattr(docker_tasks, "_tokens", {})
+    monkeypatch.setattr(docker_tasks, "_logged_in", set())
+    monkeypatch.setattr(docker_tasks, "_sessions", {})
+    monkeypatch.setattr(k8s_tasks, "_annotation_indexes", {})
+    saved, measured = baselines
+
+    def run(name, function, *args, **kargs):
+        log.write_text("")
+        registry.requests = 0
+        start = time.perf_counter()
+        function(*args, **kargs)
+        seconds = time.perf_counter() - start
+
+        calls = Counter(line.split()[0] for line in log.read_text().splitlines())
+        calls["http"] = registry.requests
+        calls = {tool: count for tool, count in sorted(calls.items()) if count}
+        measured[name] = {"seconds": round(seconds, 3), "latency": float(LATENCY), "calls": calls}
+        if UPDATE:
+            return
+        baseline = saved.get(name)
+        assert baseline is not None, \
+            f"No baseline for {name} in {BASELINES_FILE.name}, record it with BENCH_UPDATE=1"
+
+        more = {tool: f"{count} > {baseline['calls'].get(tool, 0)}"
+                for tool, count in calls.items() if count > baseline["calls"].get(tool, 0)}
+        assert not more, f"{name} runs more subprocesses or requests than its baseline: {more}"
+        if baseline["latency"] != float(LATENCY):
+            return
+        limit = baseline["seconds"] * TOLERANCE + SLACK
+        assert seconds <= limit, \
+            f"{name} took {seconds:.2f}s, its baseline is {baseline['seconds']:.2f}s"
+
+    return run
+
+
+def _context(**config):
+    return Context(Config(overrides=dict({
+        "run": {"hide": True, "in_stream": False},
+        "registry_scheme": "http",
+        "docker_engine": False,
+    }, **config)))
+
+
+def test_bench_config_from_dir(bench, tmp_path, monkeypatch):
+    config_dir = tmp_path / "config"
+    config_dir.mkdir()
+    for i in range(50):
+        (config_dir / f"{i}.ini").write_text(f"key = {i}\n" * 100)
+    items = [{"metadata": {"name": f"cm{i}", "annotations": {"config-from-dir": f"/other/{i}/"}}}
+             for i in range(500)]
+    items.append({"metadata": {"name": "app-config",
+                               "annotations": {"config-from-dir": f"{config_dir}/"}}})
+    configmaps = tmp_path / "configmaps.json"
+    configmaps.write_text(json.dumps({"kind": "List", "items": items}))
+    monkeypatch.setenv("STUB_KUBECTL_OUTPUT", str(configmaps))
+
+    bench("config_from_dir", k8s_tasks.config_from_dir, _context(), str(config_dir))
+
+
+def test_bench_apply_many(bench, tmp_path):
+    manifests = []
+    for i in range(200):
+        kind = "Namespace" if i % 50 == 0 else "Deployment"
+        path = tmp_path / f"manifest-{i:03}.yaml"
+        path.write_text(f"apiVersion: v1\nkind: {kind}\nmetadata:\n  name: obj{i}\n")
+        manifests.append(str(path))
+
+    bench("apply_many", k8s_tasks.apply, _context(), ",".join(manifests), batch=50, workers=4)
+
+
+def test_bench_generate_templates(bench, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "deployment.yaml").write_text("#@ load('@ytt:data', 'data')\n")
+    (tmp_path / "out").mkdir()
+    files = [{"name": f"out/app{i}.yaml", "values": {"replicas": i}} for i in range(20)]
+    templates = {"deployment.yaml": {"values": {"image": "app:1.0"}, "files": files}}
+
+    bench("generate_templates", k8s_tasks.generate_templates, _context(templates=templates),
+          apply=True, workers=4)
+
+
+def test_bench_native_render(bench, tmp_path):
+    template = tmp_path / "configmap.yaml"
+    template.write_text(k8s_tasks.YTT_CREATE_CONFIGMAP)
+    values = {"name": "app", "annotations": {"config-from-dir": "conf/"},
+              "files": {f"{i}.ini": f"key = {i}\n" for i in range(10)}}
+
+    def render_many(c):
+        for i in range(500):
+            k8s_tasks.run_ytt(c, str(template), values, output_file=str(tmp_path / "out.yaml"))
+
+    bench("native_render", render_many, _context())
+
+
+def test_bench_last_version(bench, capsys):
+    bench("last_version", docker_tasks.last_version, _context(), registry="gcr.io",
+          image="project/app")
+    assert capsys.readouterr().out == "1.49.999\n"
+
+
+def test_bench_push_image(bench):
+    bench("push_image", docker_tasks.push_image, _context(),
+          registry="123.dkr.ecr.us-east-1.amazonaws.com", image="app")
@@ -0,0 +1,63 @@
+import sys
+
+import pytest
+from invoke import Config, Context
+
+from py_docker_k8s_tasks import django_tasks
+from .stubs import install_stub
+
+# Runs the command after "docker exec [options] container" on the host
+FAKE_DOCKER = """#!/bin/sh
+echo "docker $1" >> "$FAKE_DOCKER_LOG"
+shift
+while [ "${1#-}" != "$1" ]; do
+  case "$1" in --env) shift;; esac
+  shift
+done
+shift
+exec "$@"
+"""
+
+# Counts the "Django" boots, one per process, and fails for the "broken" language
+FAKE_MANAGE = """import sys
+import boot
+if "broken" in sys.argv:
+    sys.exit(3)
+print("boots", boot.count, "ran", *sys.argv[1:], end="")
+"""
+
+
+@pytest.fixture
+def project(bin_dir, tmp_path, monkeypatch):
+    install_stub(bin_dir, "docker", FAKE_DOCKER)
+    monkeypatch.setenv("FAKE_DOCKER_LOG", str(tmp_path / "docker.log"))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "manage.py").write_text(FAKE_MANAGE)
+    (tmp_path / "boot.py").write_text("count = 1\n")
+    return tmp_path
+
+
+def _context(**config):
+    return Context(Config(overrides=dict({"container": "app", "django_python": sys.executable,
+                                          "docker_engine": False}, **config)))
+
+
+def test_makemessages_one_process(project, capsys):
+    c = _context(translations={"languages": ["es", "fr", "pt"], "extra_params": ["--no-wrap"]})
+    django_tasks.makemessages(c)
+    out = capsys.readouterr().out.splitlines()
+    assert out[:3] == [f"boots 1 ran makemessages -l {lang} --no-wrap"
+                       for lang in ("es", "fr", "pt")]
+    assert out[3].split() == ["COMMAND", "EXIT"]
+    assert out[4].split() == ["./manage.py", "makemessages", "-l", "es", "--no-wrap", "0"]
+    assert (project / "docker.log").read_text() == "docker exec\n"
+
+
+def test_manage_batch_statuses(project, capsys):
+    commands = [["./manage.py", "compilemessages", "-l", "broken"],
+                ["sh", "-c", "echo sh; exit 2"], ["./manage.py", "migrate"]]
+    with pytest.raises(RuntimeError, match="broken, sh -c echo sh; exit 2$"):
+        django_tasks.manage_batch(_context(), commands)
+    out = capsys.readouterr().out.splitlines()
+    assert out[:2] == ["sh", "boots 1 ran migrate"]
+    assert [line.split()[-1] for line in out[3:]] == ["3", "2", "0"]
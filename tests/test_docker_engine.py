@@ -0,0 +1,250 @@
+import io
+import os
+import json
+import base64
+import struct
+import tarfile
+import threading
+import subprocess
+import socketserver
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+from invoke import Config, MockContext, UnexpectedExit
+
+from py_docker_k8s_tasks import docker_tasks
+from py_docker_k8s_tasks.docker_engine import DockerEngine, DIRECTORY_MODE
+
+
+class FakeDockerd(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Stand-in for the Docker daemon socket, the container filesystem is a host directory"""
+    daemon_threads = True
+
+    def __init__(self, socket_path, root):
+        super().__init__(socket_path, FakeDockerdHandler)
+        self.root = root
+        self.connections = 0
+        self.images = []
+        self.execs = {}
+        self.exit_code = 0
+        self.run_execs = False  # Run exec commands on the host instead of echoing them
+
+
+class FakeDockerdHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _path(self):
+        url = urlparse(self.path)
+        return url.path, {k: v[0] for k, v in parse_qs(url.query).items()}
+
+    def _send(self, status, body=b"", headers=None, content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            data = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)[:size]
+                if not size:
+                    return data
+                data += chunk
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _host_path(self, container_path):
+        return os.path.join(self.server.root, container_path.lstrip("/"))
+
+    def do_HEAD(self):
+        path, query = self._path()
+        host_path = self._host_path(query["path"])
+        if not os.path.exists(host_path):
+            return self._send(404, {"message": "not found"})
+        mode = DIRECTORY_MODE if os.path.isdir(host_path) else 0o644
+        stat = base64.b64encode(json.dumps({"name": query["path"], "mode": mode}).encode())
+        self._send(200, headers={"X-Docker-Container-Path-Stat": stat.decode()})
+
+    def do_GET(self):
+        path, query = self._path()
+        if path == "/images/json":
+            return self._send(200, self.server.images)
+        if path.endswith("/archive"):
+            host_path = self._host_path(query["path"])
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode="w") as tar:
+                tar.add(host_path, arcname=os.path.basename(host_path))
+            return self._send(200, buf.getvalue(), content_type="application/x-tar")
+        if path.startswith("/exec/"):
+            return self._send(200, {"ExitCode": self.server.exit_code})
+        self._send(404, {"message": f"unknown {path}"})
+
+    def do_PUT(self):
+        path, query = self._path()
+        with tarfile.open(fileobj=io.BytesIO(self._read_body()), mode="r:*") as tar:
+            tar.extractall(self._host_path(query["path"]))
+        self._send(200)
+
+    def do_POST(self):
+        path, query = self._path()
+        body = json.loads(self._read_body() or b"{}")
+        if path.endswith("/exec"):
+            exec_id = str(len(self.server.execs))
+            self.server.execs[exec_id] = body
+            return self._send(201, {"Id": exec_id})
+        exec_config = self.server.execs[path.split("/")[2]]
+        self.send_response(101)
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Upgrade", "tcp")
+        self.end_headers()
+        stdin = self.rfile.read() if exec_config["AttachStdin"] else b""
+        if self.server.run_execs:
+            proc = subprocess.run(exec_config["Cmd"], input=stdin, capture_output=True)
+            frames = ((1, proc.stdout), (2, proc.stderr))
+            self.server.exit_code = proc.returncode
+        else:
+            frames = ((1, " ".join(exec_config["Cmd"]).encode() + b"\n"), (1, stdin),
+                      (2, b"warning\n"))
+        for stream, payload in frames:
+            self.wfile.write(struct.pack(">BxxxL", stream, len(payload)) + payload)
+        self.close_connection = True
+
+
+@pytest.fixture
+def dockerd(tmp_path):
+    root = tmp_path / "container"
+    root.mkdir()
+    server = FakeDockerd(str(tmp_path / "docker.sock"), str(root))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def docker_env(tmp_path, monkeypatch):
+    """Isolates the tests from the DOCKER_* variables and the docker CLI config of the user"""
+    for var in ("DOCKER_HOST", "DOCKER_CONTEXT"):
+        monkeypatch.delenv(var, raising=False)
+    config_dir = tmp_path / "docker-config"
+    config_dir.mkdir()
+    monkeypatch.setenv("DOCKER_CONFIG", str(config_dir))
+    return config_dir
+
+
+@pytest.fixture
+def context(dockerd):
+    config = Config(overrides={"docker_socket": dockerd.server_address, "container": "app"})
+    return MockContext(config=config)
+
+
+def test_last_version_from_engine(dockerd, context):
+    dockerd.images = [{"RepoTags": ["icr.io/ns/app:1.9", "icr.io/ns/app:1.10"]},
+                      {"RepoTags": ["icr.io/ns/app:latest"]}]
+    for i in range(3):
+        assert docker_tasks._get_last_version_from_local_docker(context, "icr.io/ns", "app") == "1.10"
+    assert dockerd.connections == 1
+
+
+def test_engine_follows_docker_context(dockerd, context, docker_env, monkeypatch):
+    assert docker_tasks._docker_engine(context) is not None
+
+    (docker_env / "config.json").write_text('{"currentContext": "remote"}')
+    assert docker_tasks._docker_engine(context) is None
+    monkeypatch.setenv("DOCKER_CONTEXT", "default")
+    assert docker_tasks._docker_engine(context) is not None
+    # DOCKER_HOST goes before the context, like in the CLI
+    monkeypatch.setenv("DOCKER_CONTEXT", "remote")
+    monkeypatch.setenv("DOCKER_HOST", f"unix://{dockerd.server_address}")
+    assert docker_tasks._docker_engine(context) is not None
+    monkeypatch.setenv("DOCKER_HOST", "tcp://build-server:2376")
+    assert docker_tasks._docker_engine(context) is None
+
+
+def test_put_get_roundtrip(dockerd, context, tmp_path):
+    source = tmp_path / "fixtures"
+    (source / "sub").mkdir(parents=True)
+    (source / "sub" / "data.json").write_text('{"a": 1}')
+    os.mkdir(os.path.join(dockerd.root, "srv"))
+
+    docker_tasks.docker_put(context, str(source), "/srv")
+    assert open(os.path.join(dockerd.root, "srv/fixtures/sub/data.json")).read() == '{"a": 1}'
+
+    docker_tasks.docker_put(context, str(source / "sub" / "data.json"), "/srv/renamed.json")
+    assert os.path.exists(os.path.join(dockerd.root, "srv/renamed.json"))
+
+    docker_tasks.docker_get(context, "/srv/fixtures", str(tmp_path / "copy"))
+    assert (tmp_path / "copy" / "sub" / "data.json").read_text() == '{"a": 1}'
+
+
+def test_put_path_writer_error(dockerd, tmp_path):
+    engine = DockerEngine(dockerd.server_address)
+    with pytest.raises(FileNotFoundError):
+        engine.put_path("app", str(tmp_path / "missing"), "/srv/missing")
+
+
+def test_exec_run_demuxes_output(dockerd):
+    engine = DockerEngine(dockerd.server_address)
+    stdout, stderr = io.BytesIO(), io.BytesIO()
+    exit_code = engine.exec_run("app", "cat -", stdin=io.BytesIO(b"hello"), stdout=stdout,
+                                stderr=stderr)
+    assert exit_code == 0
+    assert stdout.getvalue() == b"cat -\nhello"
+    assert stderr.getvalue() == b"warning\n"
+
+
+def test_docker_exec_without_pty(dockerd, context, capfdbinary):
+    result = docker_tasks.docker_exec(context, "./manage.py check --deploy", pty=False,
+                                      workdir="/app", user="django")
+    assert result.exited == 0
+    assert dockerd.execs["0"]["Cmd"] == ["./manage.py", "check", "--deploy"]
+    assert (dockerd.execs["0"]["WorkingDir"], dockerd.execs["0"]["User"]) == ("/app", "django")
+    assert capfdbinary.readouterr().out == b"./manage.py check --deploy\n"
+
+
+def test_docker_exec_failure(dockerd, context, monkeypatch):
+    dockerd.exit_code = 2
+    monkeypatch.setenv("DOCKEREXEC_DEBUG", "1")
+    with pytest.raises(UnexpectedExit):
+        docker_tasks.docker_exec(context, "./manage.py check", pty=False, envs={"A": "b"})
+    assert dockerd.execs["0"]["Env"] == ["A=b", "DEBUG=1"]
+
+
+@pytest.mark.parametrize("compress", [None, "gzip"])
+def test_sync_put_get_only_changed(dockerd, context, tmp_path, capsys, compress):
+    dockerd.run_execs = True
+    source, container_dir, copy = tmp_path / "src", tmp_path / "in-container", tmp_path / "copy"
+    (source / "sub").mkdir(parents=True)
+    for i in range(20):
+        (source / "sub" / f"{i}.txt").write_text(f"file {i}")
+
+    docker_tasks.docker_put(context, str(source), str(container_dir), sync=True, compress=compress)
+    assert capsys.readouterr().out.splitlines()[-1] == "20 files changed"
+    assert (container_dir / "sub" / "7.txt").read_text() == "file 7"
+
+    (source / "sub" / "7.txt").write_text("changed")
+    docker_tasks.docker_put(context, str(source), str(container_dir), sync=True, compress=compress)
+    assert capsys.readouterr().out.splitlines() == ["sub/7.txt", "1 files changed"]
+    assert (container_dir / "sub" / "7.txt").read_text() == "changed"
+
+    docker_tasks.docker_get(context, str(container_dir), str(copy), sync=True, compress=compress)
+    assert capsys.readouterr().out.splitlines()[-1] == "20 files changed"
+    docker_tasks.docker_get(context, str(container_dir), str(copy), sync=True, compress=compress)
+    assert capsys.readouterr().out.splitlines() == ["0 files changed"]
+    assert (copy / "sub" / "7.txt").read_text() == "changed"
@@ -0,0 +1,243 @@
+import json
+import base64
+import time
+from datetime import datetime, timezone
+
+import pytest
+import requests
+from invoke import Config, Context, MockContext, Result
+from invoke.parser import Parser, ParserContext
+
+from py_docker_k8s_tasks import cache, docker_tasks
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    return tmp_path
+
+
+def _context(**config):
+    return Context(Config(overrides=dict({"registry_scheme": "http"}, **config)))
+
+
+@pytest.mark.parametrize("registry", [True, False], indirect=True, ids=["link", "cursor"])
+def test_last_version_paginates(registry):
+    version = docker_tasks._get_last_version(_context(), registry.address, "image")
+    assert version == "1.49.999"
+    assert registry.requests == 51
+
+
+def test_next_version_paginates(registry):
+    c = _context()
+    assert docker_tasks._get_next_version(c, registry.address, "image") == "1.49.1000"
+
+
+def test_last_version_cached(registry):
+    docker_tasks._get_last_version(_context(), registry.address, "image")
+    registry.requests = 0
+    assert docker_tasks._get_last_version(_context(), registry.address, "image") == "1.49.999"
+    assert registry.requests == 0
+
+
+def test_last_version_revalidates_with_etag(registry):
+    c = _context(tags_cache_ttl=0)
+    docker_tasks._get_last_version(c, registry.address, "image")
+    registry.tags.append("2.0.0")
+    registry.requests = 0
+    assert docker_tasks._get_last_version(c, registry.address, "image") == "2.0.0"
+    assert registry.requests == 51
+    assert registry.not_modified == 50
+
+
+def test_push_image_updates_cache(registry):
+    config = Config(overrides={"registry_scheme": "http"})
+    c = MockContext(config=config, run=Result(), repeat=True)
+    docker_tasks.push_image(c, registry=registry.address, image="image")
+    registry.requests = 0
+    assert docker_tasks._get_next_version(c, registry.address, "image") == "1.49.1001"
+    assert registry.requests == 0
+
+
+@pytest.fixture
+def aws_context(monkeypatch):
+    for var in ("AWS_TOKEN", ) + docker_tasks.TOKEN_ENV_VARS["aws"]:
+        monkeypatch.delenv(var, raising=False)
+    monkeypatch.setattr(docker_tasks, "_tokens", {})
+    monkeypatch.setattr(docker_tasks, "_logged_in", set())
+    return MockContext(run=Result(_aws_token_output(time.time() + 12 * 3600)), repeat=True)
+
+
+def _aws_token_output(expires_at, token="AWS:secret"):
+    token = base64.b64encode(token.encode()).decode()
+    return json.dumps({"authorizationToken": token, "expiresAt": expires_at})
+
+
+def test_aws_token_cached(aws_context, cache_home, monkeypatch):
+    registry = "123.dkr.ecr.us-east-1.amazonaws.com"
+    for i in range(3):
+        docker_tasks._auth_headers(aws_context, registry)
+        docker_tasks._docker_login(aws_context, registry)
+    commands = [call.args[0] for call in aws_context.run.call_args_list]
+    assert len([cmd for cmd in commands if cmd.startswith("aws ")]) == 1
+    assert len([cmd for cmd in commands if cmd.startswith("docker login")]) == 1
+
+    token_files = list((cache_home / "py-docker-k8s-tasks" / "tokens").iterdir())
+    assert [oct(f.stat().st_mode & 0o777) for f in token_files] == ["0o600"]
+
+    docker_tasks._tokens.clear()
+    docker_tasks._get_aws_token(aws_context)
+    assert aws_context.run.call_count == len(commands)  # Read from disk
+
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "AKIAOTHER")  # Another identity, another token
+    docker_tasks._get_aws_token(aws_context)
+    assert aws_context.run.call_count == len(commands) + 1
+
+
+def test_aws_token_refreshed_before_expiry(aws_context, monkeypatch):
+    now = time.time()
+    expires_at = datetime.fromtimestamp(now + 3600, timezone.utc).isoformat()
+    aws_context = MockContext(run=Result(_aws_token_output(expires_at)), repeat=True)
+    docker_tasks._get_aws_token(aws_context)
+    key = docker_tasks._token_key("aws")
+    assert docker_tasks._tokens[key]["expires_at"] == pytest.approx(now + 3600)
+
+    expires_in = 3600 - docker_tasks.TOKEN_REFRESH_MARGIN
+    monkeypatch.setattr(docker_tasks.time, "time", lambda: now + expires_in - 1)
+    docker_tasks._get_aws_token(aws_context)
+    assert aws_context.run.call_count == 1
+    monkeypatch.setattr(docker_tasks.time, "time", lambda: now + expires_in + 1)
+    docker_tasks._get_aws_token(aws_context)
+    assert aws_context.run.call_count == 2
+
+
+def test_gcloud_token_dropped_when_rejected(registry, cache_home, monkeypatch, capsys):
+    env_vars = ("NO_PROXY", "no_proxy", "GCLOUD_TOKEN") + docker_tasks.TOKEN_ENV_VARS["googlecloud"]
+    for var in env_vars:
+        monkeypatch.delenv(var, raising=False)
+    monkeypatch.setenv("HTTP_PROXY", f"http://{registry.address}")
+    monkeypatch.setattr(docker_tasks, "_tokens", {})
+    monkeypatch.setattr(docker_tasks, "_sessions", {})
+    registry.tags[:] = ["1.0", "1.1"]
+    registry.authorization = "Basic " + base64.b64encode(b"oauth2accesstoken:new").decode()
+
+    def gcloud_output(token):
+        return Result(json.dumps({"credential": {"access_token": token,
+                                                 "token_expiry": "2100-01-01T00:00:00Z"}}))
+
+    config = Config(overrides={"registry_scheme": "http"})
+    c = MockContext(config=config, run={
+        docker_tasks.TOKEN_COMMANDS["googlecloud"]: [gcloud_output("old"), gcloud_output("new"),
+                                                     gcloud_output("stale")],
+    })
+    docker_tasks._get_gcloud_token(c)  # Cached, but revoked
+    docker_tasks.last_version(c, registry="gcr.io", image="project/app")
+    assert capsys.readouterr().out == "1.1\n"
+    assert registry.requests == 2
+    assert cache.load("tokens", *docker_tasks._token_key("googlecloud"))["token"] == "new"
+
+    registry.authorization = "Basic " + base64.b64encode(b"oauth2accesstoken:newer").decode()
+    with pytest.raises(requests.HTTPError):  # Retried once only
+        docker_tasks._get_last_version(c, "gcr.io", "project/other")
+    assert registry.requests == 4
+
+
+def test_next_versions_concurrent(registry, capsys):
+    registry.tags[:] = ["0.1", "0.2", "latest"]
+    registry.delay = 0.1
+    docker_tasks.next_versions(_context(), [f"image{i}" for i in range(10)], registry.address,
+                               workers=4)
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ["IMAGE", "VERSION"]
+    assert [line.split() for line in lines[1:]] == [[f"image{i}", "0.3"] for i in range(10)]
+    assert registry.requests == 10
+    assert 1 < registry.max_inflight <= 4
+
+
+def test_release_pipeline(registry, capsys):
+    registry.tags[:] = ["1.0", "1.1"]
+    config = Config(overrides={"registry_scheme": "http", "registry": registry.address, "release": {
+        "workers": 2,
+        "images": [
+            {"image": "api", "context": "api/", "dockerfile": "api/Dockerfile"},
+            {"image": "web"},
+            {"image": "worker", "version": "3.0"},
+        ],
+    }})
+    c = MockContext(config=config, run=Result(), repeat=True)
+    docker_tasks.release(c, [])
+
+    commands = [call.args[0] for call in c.run.call_args_list]
+    assert f"docker build -t {registry.address}/api:1.2 -f api/Dockerfile api/" in commands
+    assert f"docker build -t {registry.address}/web:1.2 ." in commands
+    assert f"docker build -t {registry.address}/worker:3.0 ." in commands
+    for image in ("api:1.2", "web:1.2", "worker:3.0"):
+        build = [cmd.startswith(f"docker build -t {registry.address}/{image} ") for cmd in commands]
+        assert commands.index(f"docker push {registry.address}/{image}") > build.index(True)
+    out = capsys.readouterr().out.splitlines()
+    assert out[0].split() == ["IMAGE", "VERSION", "RESOLVE", "BUILD", "PUSH", "CACHE", "STATUS"]
+    assert [line.split()[-1] for line in out[1:4]] == ["ok", "ok", "ok"]
+    assert out[-1].startswith("Released 3 images")
+
+
+def test_release_resolve_failure(registry, capsys):
+    registry.tags[:] = ["1.0"]
+    images = [{"image": "api"}, {"image": "broken", "registry": "127.0.0.1:1"}]
+    config = Config(overrides={"registry_scheme": "http", "registry": registry.address,
+                               "release": {"images": images}})
+    c = MockContext(config=config, run=Result(), repeat=True)
+    with pytest.raises(RuntimeError, match="Failed to release broken"):
+        docker_tasks.release(c, [])
+
+    commands = [call.args[0] for call in c.run.call_args_list]
+    assert commands == [f"docker build -t {registry.address}/api:1.1 .",
+                        f"docker push {registry.address}/api:1.1"]
+    rows = {line.split()[0]: line for line in capsys.readouterr().out.splitlines()[1:3]}
+    assert rows["api"].split()[-1] == "ok"
+    assert "resolve failed:" in rows["broken"]
+
+
+BUILDKIT_OUTPUT = """#1 [internal] load build definition from Dockerfile
+#1 DONE 0.0s
+#5 [1/3] FROM docker.io/library/python:3.8
+#5 CACHED
+#6 [2/3] COPY requirements.txt .
+#6 CACHED
+#7 [3/3] RUN pip install -r requirements.txt
+#7 DONE 12.1s
+"""
+
+
+def test_build_buildx_local_cache(tmp_path, capsys):
+    config = Config(overrides={"build": {
+        "buildx": True,
+        "cache_from": str(tmp_path),
+        "cache_to": str(tmp_path),
+        "build_args": {"PYTHON_VERSION": "3.8"},
+        "target": "prod",
+    }})
+    c = MockContext(config=config, run=Result(stderr=BUILDKIT_OUTPUT), repeat=True)
+    docker_tasks.build(c, registry="reg.example.com", image="app", version="1.0")
+
+    c.run.assert_called_once_with(
+        "docker buildx build --progress=plain --load -t reg.example.com/app:1.0 "
+        "--build-arg PYTHON_VERSION=3.8 --target prod "
+        f"--cache-from type=local,src={tmp_path} --cache-to type=local,dest={tmp_path},mode=max ."
+    )
+    assert capsys.readouterr().out == "Layer cache hits: 2/3 (67%)\n"
+
+
+@pytest.mark.parametrize("argv, buildx", [
+    (["--buildx"], True), (["--buildx", "false"], False), (["--buildx", "yes"], True), ([], True),
+])
+def test_build_buildx_flag(argv, buildx):
+    parser_context = ParserContext(name="build", args=docker_tasks.build.get_arguments())
+    parsed = Parser(contexts=[parser_context]).parse_argv(["build"] + argv)[0]
+    kwargs = {name: arg.value for name, arg in parsed.args.items() if arg.value is not None}
+
+    config = Config(overrides={"build": {"buildx": True}})
+    c = MockContext(config=config, run=Result(), repeat=True)
+    docker_tasks.build(c, registry="reg.example.com", image="app", version="1.0", **kwargs)
+    command = c.run.call_args.args[0]
+    assert command.startswith("docker buildx build" if buildx else "docker build")
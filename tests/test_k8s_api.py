@@ -0,0 +1,341 @@
+import json
+import re
+import copy
+import stat
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import yaml
+import pytest
+from invoke import Config, Context
+
+from py_docker_k8s_tasks import k8s_api, k8s_tasks
+
+RESOURCES = {
+    "api/v1": [
+        {"name": "pods", "singularName": "pod", "kind": "Pod", "namespaced": True,
+         "shortNames": ["po"]},
+        {"name": "pods/log", "kind": "Pod", "namespaced": True},
+        {"name": "configmaps", "singularName": "configmap", "kind": "ConfigMap",
+         "namespaced": True, "shortNames": ["cm"]},
+        {"name": "namespaces", "singularName": "namespace", "kind": "Namespace",
+         "namespaced": False, "shortNames": ["ns"]},
+        {"name": "events", "singularName": "event", "kind": "Event", "namespaced": True,
+         "shortNames": ["ev"]},
+    ],
+    "apis/apps/v1": [
+        {"name": "deployments", "singularName": "deployment", "kind": "Deployment",
+         "namespaced": True, "shortNames": ["deploy"]},
+    ],
+}
+PATH_RE = re.compile(r"^/(api/v1|apis/apps/v1)(?:/namespaces/([^/]+))?/([^/]+)(?:/([^/]+))?$")
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    """Minimal stand-in for the Kubernetes API: discovery, list (JSON and Table), get, apply,
+    patch and delete"""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeApiHandler)
+        self.objects = {}
+        self.requests = []
+        self.connections = 0
+        self.resource_version = 0
+        self.watch_events = []
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def add(self, group_version, plural, obj):
+        metadata = obj["metadata"]
+        self.objects[(group_version, plural, metadata.get("namespace"), metadata["name"])] = obj
+
+
+def _lookup(obj, path):
+    for key in path.split("."):
+        obj = (obj or {}).get(key)
+    return obj
+
+
+def _merge(target, patch):
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self, plural, name):
+        self._send(404, {"kind": "Status", "reason": "NotFound", "code": 404,
+                         "message": f'{plural} "{name}" not found'})
+
+    def _handle(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        self.server.requests.append({
+            "method": self.command, "path": url.path, "query": query, "body": body,
+            "authorization": self.headers.get("Authorization"),
+            "content_type": self.headers.get("Content-Type"),
+        })
+        if url.path == "/apis":
+            return self._send(200, {"groups": [{"name": "apps",
+                                                "preferredVersion": {"version": "v1"}}]})
+        if url.path.strip("/") in RESOURCES:
+            return self._send(200, {"resources": RESOURCES[url.path.strip("/")]})
+        match = PATH_RE.match(url.path)
+        if not match:
+            return self._send(404, {"message": "unknown path"})
+        group_version, namespace, plural, name = match.groups()
+        if plural == "namespaces" and name is None and namespace:
+            plural, name, namespace = "namespaces", namespace, None
+        key = (group_version, plural, namespace, name)
+
+        if self.command == "GET" and "watch" in query:
+            return self._watch()
+        if self.command == "GET" and name is None:
+            return self._list(group_version, plural, namespace, query)
+        if self.command == "GET":
+            if key not in self.server.objects:
+                return self._not_found(plural, name)
+            return self._send(200, self.server.objects[key])
+        if self.command == "DELETE":
+            if self.server.objects.pop(key, None) is None:
+                return self._not_found(plural, name)
+            return self._send(200, {"kind": "Status", "status": "Success"})
+        if self.command == "PATCH":
+            self.server.resource_version += 1
+            if self.headers["Content-Type"] == "application/apply-patch+yaml":
+                obj = copy.deepcopy(body)
+                if namespace:
+                    obj["metadata"]["namespace"] = namespace
+            elif key not in self.server.objects:
+                return self._not_found(plural, name)
+            else:
+                obj = copy.deepcopy(self.server.objects[key])
+                _merge(obj, body)
+            obj["metadata"]["resourceVersion"] = str(self.server.resource_version)
+            self.server.objects[key] = obj
+            return self._send(200, obj)
+        self._send(405, {"message": "method not allowed"})
+
+    def _watch(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for obj in self.server.watch_events:
+            data = json.dumps({"type": "MODIFIED", "object": obj}).encode() + b"\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+            time.sleep(0.05)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _list(self, group_version, plural, namespace, query):
+        items = [obj for (gv, p, ns, _), obj in sorted(self.server.objects.items())
+                 if gv == group_version and p == plural and namespace in (None, ns)]
+        for term in filter(None, query.get("labelSelector", "").split(",")):
+            key, value = term.split("=")
+            items = [obj for obj in items
+                     if (obj["metadata"].get("labels") or {}).get(key) == value]
+        for term in filter(None, query.get("fieldSelector", "").split(",")):
+            path, value = term.split("=")
+            items = [obj for obj in items if _lookup(obj, path) == value]
+        if "as=Table" in self.headers.get("Accept", ""):
+            return self._send(200, {
+                "kind": "Table", "apiVersion": "meta.k8s.io/v1",
+                "columnDefinitions": [{"name": "Name", "priority": 0},
+                                      {"name": "Status", "priority": 0},
+                                      {"name": "Node", "priority": 1}],
+                "rows": [{"cells": [obj["metadata"]["name"], _lookup(obj, "status.phase"),
+                                    _lookup(obj, "spec.nodeName")],
+                          "object": {"metadata": obj["metadata"]}} for obj in items]})
+        # Like the real API, items of a list don't have kind and apiVersion
+        items = [{k: v for k, v in obj.items() if k not in ("kind", "apiVersion")}
+                 for obj in items]
+        self._send(200, {"kind": "List", "apiVersion": "v1", "metadata": {}, "items": items})
+
+    do_GET = do_PATCH = do_DELETE = _handle
+
+
+@pytest.fixture
+def api_server(tmp_path, monkeypatch):
+    server = FakeApiServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(k8s_api, "_clients", {})
+    # kubectl must not be used
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "kubectl").write_text("#!/bin/sh\necho kubectl called >&2\nexit 1\n")
+    (bin_dir / "kubectl").chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _kubeconfig(tmp_path, monkeypatch, server, user):
+    kubeconfig = tmp_path / "kubeconfig"
+    kubeconfig.write_text(yaml.safe_dump({
+        "apiVersion": "v1", "kind": "Config", "current-context": "test",
+        "clusters": [{"name": "test", "cluster": {"server": server.url}}],
+        "users": [{"name": "test", "user": user}],
+        "contexts": [{"name": "test", "context": {"cluster": "test", "user": "test",
+                                                  "namespace": "prod"}}],
+    }))
+    monkeypatch.setenv("KUBECONFIG", str(kubeconfig))
+
+
+def _context(**config):
+    return Context(Config(overrides=dict({"run": {"hide": True, "in_stream": False},
+                                          "kube_api": True}, **config)))
+
+
+def _pod(name, phase, node):
+    return {"apiVersion": "v1", "kind": "Pod",
+            "metadata": {"name": name, "namespace": "prod", "labels": {"app": name[:3]}},
+            "spec": {"nodeName": node}, "status": {"phase": phase}}
+
+
+def test_kget_through_api(api_server, tmp_path, monkeypatch, capsys):
+    _kubeconfig(tmp_path, monkeypatch, api_server, {"token": "secret"})
+    for i, phase in enumerate(["Running", "Pending", "Running"]):
+        api_server.add("api/v1", "pods", _pod(f"web-{i}", phase, f"node-{i % 2}"))
+    api_server.add("api/v1", "pods", _pod("db-0", "Running", "node-0"))
+
+    k8s_tasks.kget(_context(), status="running", app="web", structured=True)
+    assert capsys.readouterr().out.splitlines() == [
+        "NAME    STATUS    NODE", "web-0   Running   node-0", "web-2   Running   node-0"]
+    k8s_tasks.kget(_context(), "po", node="node-0", wide=True)
+    assert [line.split() for line in capsys.readouterr().out.splitlines()] == [
+        ["NAME", "STATUS", "NODE"], ["db-0", "Running", "node-0"],
+        ["web-0", "Running", "node-0"], ["web-2", "Running", "node-0"]]
+    k8s_tasks.kget(_context(), "pods", namespace="all", llist=True, grep="web")
+    assert capsys.readouterr().out.split() == ["prod", "prod", "prod"]
+
+    paths = [r["path"] for r in api_server.requests]
+    assert paths.count("/apis") == 1  # Discovery is cached
+    assert {r["authorization"] for r in api_server.requests} == {"Bearer secret"}
+    assert api_server.connections <= 2  # Discovery fetches the API groups in parallel
+
+
+def test_apply_kdelete_through_api(api_server, tmp_path, monkeypatch, capsys):
+    _kubeconfig(tmp_path, monkeypatch, api_server, {"token": "secret"})
+    manifests = []
+    for i in range(40):
+        path = tmp_path / f"manifest-{i:02}.yaml"
+        if i == 10:
+            obj = {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": "prod"}}
+        else:
+            obj = {"apiVersion": "apps/v1", "kind": "Deployment",
+                   "metadata": {"name": f"web{i}", "annotations": {"team": "a"}},
+                   "spec": {"replicas": i}}
+        path.write_text(yaml.safe_dump(obj))
+        manifests.append(str(path))
+
+    k8s_tasks.apply(_context(), ",".join(manifests), workers=4)
+    out = capsys.readouterr().out.splitlines()
+    assert len(out) == 40 and "deployment.apps/web5 serverside-applied" in out
+    patches = [r for r in api_server.requests if r["method"] == "PATCH"]
+    assert patches[0]["path"] == "/api/v1/namespaces/prod"  # Namespaces go first
+    assert patches[1]["query"] == {"fieldManager": k8s_api.FIELD_MANAGER, "force": "true"}
+    deployment = api_server.objects[("apis/apps/v1", "deployments", "prod", "web5")]
+    assert json.loads(deployment["metadata"]["annotations"][k8s_api.LAST_APPLIED]) == \
+        yaml.safe_load(open(manifests[5]))
+    assert api_server.connections <= 5
+
+    # A new process finds the discovery in the disk cache
+    monkeypatch.setattr(k8s_api, "_clients", {})
+    api_server.requests.clear()
+    k8s_tasks.apply(_context(), ",".join(manifests), diff=True)
+    assert capsys.readouterr().out.splitlines() == ["0 changed, 40 unchanged, 0 new"]
+    assert "/apis" not in [r["path"] for r in api_server.requests]
+
+    k8s_tasks.kdelete(_context(), manifests[5], force=True)
+    assert capsys.readouterr().out == "deployment.apps/web5 deleted\n"
+    assert api_server.requests[-1]["body"]["gracePeriodSeconds"] == 0
+    with pytest.raises(k8s_tasks.Failure, match="1 manifests failed to delete"):
+        k8s_tasks.kdelete(_context(), manifests[5])
+    assert capsys.readouterr().err == f'{manifests[5]}: deployments "web5" not found (404)\n'
+
+
+def test_rollout_describe_with_exec_auth(api_server, tmp_path, monkeypatch, capsys):
+    plugin = tmp_path / "bin" / "get-token"
+    plugin.write_text("#!/bin/sh\necho '{\"kind\": \"ExecCredential\", \"status\": "
+                      "{\"token\": \"t-'$1'\", "
+                      "\"expirationTimestamp\": \"2999-01-01T00:00:00Z\"}}'\n")
+    plugin.chmod(plugin.stat().st_mode | stat.S_IEXEC)
+    _kubeconfig(tmp_path, monkeypatch, api_server, {"exec": {
+        "apiVersion": "client.authentication.k8s.io/v1", "command": str(plugin), "args": ["42"]}})
+    api_server.add("apis/apps/v1", "deployments", {
+        "apiVersion": "apps/v1", "kind": "Deployment",
+        "metadata": {"name": "web", "namespace": "prod", "managedFields": [{}]},
+        "spec": {"template": {"metadata": {}}}})
+    api_server.add("api/v1", "events", {
+        "metadata": {"name": "web.1", "namespace": "prod"}, "type": "Normal",
+        "reason": "ScalingReplicaSet", "source": {"component": "deployment-controller"},
+        "involvedObject": {"kind": "Deployment", "name": "web"}, "message": "Scaled up"})
+
+    k8s_tasks.krollout(_context(), "web")
+    assert capsys.readouterr().out == "deployment/web restarted\n"
+    patch = api_server.requests[-1]
+    assert patch["content_type"] == "application/strategic-merge-patch+json"
+    assert "kubectl.kubernetes.io/restartedAt" in \
+        api_server.objects[("apis/apps/v1", "deployments", "prod", "web")]["spec"]["template"][
+            "metadata"]["annotations"]
+
+    k8s_tasks.kdescribe(_context(), "deploy", "web")
+    out = capsys.readouterr().out
+    described, events = out.split("Events:\n")
+    assert yaml.safe_load(described)["metadata"] == {"name": "web", "namespace": "prod",
+                                                     "resourceVersion": "1"}
+    assert events.splitlines()[1].split()[:2] == ["Normal", "ScalingReplicaSet"]
+    assert {r["authorization"] for r in api_server.requests} == {"Bearer t-42"}
+
+
+def test_krollout_wait_through_api(api_server, tmp_path, monkeypatch, capsys):
+    _kubeconfig(tmp_path, monkeypatch, api_server, {"token": "secret"})
+    api_server.add("apis/apps/v1", "deployments", {
+        "apiVersion": "apps/v1", "kind": "Deployment",
+        "metadata": {"name": "web", "namespace": "prod"}, "spec": {"template": {}}})
+    api_server.watch_events = [
+        {"kind": "Deployment", "metadata": {"name": "web", "generation": 2},
+         "spec": {"replicas": 1}, "status": {"observedGeneration": 2, "replicas": replicas,
+                                             "updatedReplicas": 1, "readyReplicas": ready,
+                                             "availableReplicas": ready}}
+        for replicas, ready in [(2, 1), (2, 2), (1, 1)]]
+
+    k8s_tasks.krollout(_context(), "web", wait=True, timeout=10)
+    out = capsys.readouterr().out.splitlines()
+    assert out[0] == "deployment/web restarted"
+    assert [line.split("s ", 1)[1] for line in out[1:4]] == [
+        "deployment/web 1/1 updated, 1/1 ready, 1/1 available",
+        "deployment/web 1/1 updated, 2/1 ready, 2/1 available", "deployment/web rolled out"]
+    assert out[-1].split()[:3] == ["deployment/web", "rolled", "out"]
+    watch = api_server.requests[-1]
+    assert (watch["path"], watch["query"]) == ("/apis/apps/v1/namespaces/prod/deployments",
+                                               {"watch": "1", "timeoutSeconds": "10"})
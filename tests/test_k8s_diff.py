@@ -0,0 +1,39 @@
+import json
+
+from py_docker_k8s_tasks.k8s_diff import classify, LAST_APPLIED
+
+
+def _configmap(name, data, **metadata):
+    return {"apiVersion": "v1", "kind": "ConfigMap", "metadata": dict(name=name, **metadata),
+            "data": data}
+
+
+def _live(desired, **extra):
+    live = json.loads(json.dumps(desired))
+    live["metadata"].update(uid="1234", resourceVersion="99", namespace="default",
+                            annotations={LAST_APPLIED: json.dumps(desired)})
+    live.update(extra)
+    return live
+
+
+def test_classify_ignores_server_fields():
+    same = _configmap("same", {"a": "1"})
+    changed = _configmap("changed", {"a": "2"})
+    new = _configmap("new", {})
+    live = [_live(same, status={"phase": "ok"}), _live(_configmap("changed", {"a": "1"}))]
+    assert classify([same, changed, new], live) == ([changed], [same], [new])
+
+
+def test_classify_detects_removed_fields():
+    desired = _configmap("app", {"a": "1"})
+    live = _live(_configmap("app", {"a": "1", "b": "2"}))
+    assert classify([desired], [live]) == ([desired], [], [])
+
+
+def test_classify_secret_string_data():
+    desired = {"apiVersion": "v1", "kind": "Secret", "metadata": {"name": "s"},
+               "stringData": {"password": "hunter2"}}
+    live = _live(desired)
+    del live["stringData"]
+    live["data"] = {"password": "aHVudGVyMg=="}
+    assert classify([desired], [live]) == ([], [desired], [])
@@ -0,0 +1,70 @@
+import io
+import threading
+
+import pytest
+
+from py_docker_k8s_tasks import k8s_logs
+
+
+def _echo_lines(count, text):
+    return ["sh", "-c", f'i=0; while [ $i -lt {count} ]; do echo "{text} $i"; i=$((i+1)); done']
+
+
+def test_multiplexer_is_fair_and_filters():
+    out = io.StringIO()
+    commands = {("chatty", "app"): _echo_lines(20000, "noise"),
+                ("quiet", "app"): _echo_lines(3, "hello"),
+                ("quiet", "sidecar"): _echo_lines(3, "debug")}
+    k8s_logs.LogMultiplexer(lambda: list(commands), lambda *target: commands[target],
+                            exclude="^debug", out=out).run()
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 20003
+    quiet = [i for i, line in enumerate(lines) if line.startswith("quiet/app ")]
+    assert [lines[i] for i in quiet] == [f"quiet/app hello {i}" for i in range(3)]
+    # Bounded queues keep the chatty pod from getting ahead of the others
+    assert quiet[-1] < 20000 - k8s_logs.QUEUE_SIZE
+    assert lines[-1] == "chatty noise 19999"
+
+
+def test_multiplexer_follows_new_pods():
+    out = io.StringIO()
+    pods = [("web-1", "app")]
+    multiplexer = k8s_logs.LogMultiplexer(
+        lambda: list(pods), lambda pod, container: ["echo", f"started {pod}"], follow=True,
+        out=out, discover_interval=0.05, color=True, include="started")
+
+    def add_pod_and_stop():
+        while "web-1" not in out.getvalue():
+            threading.Event().wait(0.01)
+        pods.append(("web-2", "app"))
+        while "web-2" not in out.getvalue():
+            threading.Event().wait(0.01)
+        multiplexer.stop()
+
+    helper = threading.Thread(target=add_pod_and_stop)
+    helper.start()
+    multiplexer.run()
+    helper.join()
+    assert out.getvalue().splitlines() == [
+        f"{k8s_logs.COLORS[0]}web-1{k8s_logs.RESET} started web-1",
+        f"{k8s_logs.COLORS[1]}web-2{k8s_logs.RESET} started web-2"]
+
+
+def test_multiplexer_follow_limit(capsys):
+    pods = [("web-1", "app"), ("web-2", "app"), ("web-3", "app")]
+    with pytest.raises(k8s_logs.TooManyStreams, match="limit of 2, use --max-log-requests"):
+        k8s_logs.LogMultiplexer(lambda: list(pods), lambda *target: ["true"], follow=True,
+                                max_followers=2).run()
+
+    # A pod showing up over the limit waits, instead of queueing for good
+    pods.pop()
+    out = io.StringIO()
+    multiplexer = k8s_logs.LogMultiplexer(
+        lambda: list(pods), lambda pod, container: ["sh", "-c", f"echo {pod}; sleep 10"],
+        follow=True, out=out, max_followers=2, discover_interval=0.05)
+    threading.Timer(0.2, pods.append, [("web-3", "app")]).start()
+    threading.Timer(1, multiplexer.stop).start()
+    multiplexer.run()
+    assert sorted(out.getvalue().splitlines()) == ["web-1 web-1", "web-2 web-2"]
+    assert capsys.readouterr().err == \
+        "Not following web-3/app yet, already following 2 log streams\n"
@@ -0,0 +1,45 @@
+import io
+import json
+
+import pytest
+
+from py_docker_k8s_tasks import k8s_query
+
+
+def _pod(name):
+    """A Pod as the API returns it, with the projected service account volume"""
+    return {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {"name": name, "namespace": "default", "labels": {"app": "web"}},
+        "spec": {
+            "containers": [{"name": "web", "image": "web:1.0"}],
+            "volumes": [
+                {"name": "config", "configMap": {"name": "web-config",
+                                                 "items": [{"key": "a", "path": "b"}]}},
+                {"name": "kube-api-access", "projected": {"sources": [
+                    {"serviceAccountToken": {"expirationSeconds": 3607, "path": "token"}},
+                    {"configMap": {"name": "kube-root-ca.crt",
+                                   "items": [{"key": "ca.crt", "path": "ca.crt"}]}},
+                ]}},
+            ],
+        },
+        "status": {"phase": "Running"},
+    }
+
+
+@pytest.mark.parametrize("chunk_size", [7, 4096])
+def test_iter_items_single_object(chunk_size):
+    pod = _pod("web-1")
+    text = json.dumps(pod, indent=4)
+    assert list(k8s_query.iter_items(io.StringIO(text), chunk_size)) == [pod]
+
+
+@pytest.mark.parametrize("chunk_size", [7, 4096])
+def test_iter_items_list(chunk_size):
+    pods = [_pod(f"web-{i}") for i in range(3)]
+    text = json.dumps({"apiVersion": "v1", "kind": "List", "items": pods,
+                       "metadata": {"resourceVersion": "12345"}}, indent=4)
+    assert list(k8s_query.iter_items(io.StringIO(text), chunk_size)) == pods
+    assert list(k8s_query.iter_items(io.StringIO('{"kind": "List", "items": []}'))) == []
+    assert list(k8s_query.iter_items(io.StringIO(""))) == []
@@ -0,0 +1,489 @@
+import io
+import os
+import json
+import base64
+
+import yaml
+import pytest
+from invoke import Config, Context, Failure, MockContext, Result, UnexpectedExit
+
+from py_docker_k8s_tasks import k8s_tasks
+from .stubs import install_stub
+
+FAKE_KUBECTL = """#!/bin/sh
+echo "$*" >> "$FAKE_KUBECTL_LOG"
+if [ -n "$FAKE_KUBECTL_INFLIGHT" ]; then
+  touch "$FAKE_KUBECTL_INFLIGHT/$$"
+  ls "$FAKE_KUBECTL_INFLIGHT" | wc -l >> "$FAKE_KUBECTL_LOG.inflight"
+fi
+sleep "${FAKE_KUBECTL_DELAY:-0}"
+[ -z "$FAKE_KUBECTL_INFLIGHT" ] || rm "$FAKE_KUBECTL_INFLIGHT/$$"
+if [ "$*" = "apply -f -" ]; then
+  cat > "$FAKE_KUBECTL_LOG.stdin"
+fi
+if [ -n "$FAKE_KUBECTL_OUTPUT" ]; then
+  cat "$FAKE_KUBECTL_OUTPUT"
+fi
+status=0
+for arg in "$@"; do
+  case "$arg" in
+    *bad*.yaml) echo "error: error validating \\"$arg\\": invalid" >&2; status=1;;
+    *.yaml) echo "configured $arg";;
+  esac
+done
+exit $status
+"""
+
+
+FAKE_YTT = """#!/bin/sh
+printf 'apiVersion: v1\\nkind: ConfigMap\\n'
+"""
+
+
+@pytest.fixture
+def fake_kubectl(bin_dir, tmp_path, monkeypatch):
+    """Puts a kubectl stand-in on PATH, returns a function that reads the calls it got"""
+    install_stub(bin_dir, "kubectl", FAKE_KUBECTL)
+    log = tmp_path / "kubectl.log"
+    log.write_text("")
+    monkeypatch.setenv("FAKE_KUBECTL_LOG", str(log))
+    monkeypatch.setenv("FAKE_KUBECTL_DELAY", "0.02")
+    return lambda: log.read_text().splitlines()
+
+
+@pytest.fixture
+def kubectl_stdin(fake_kubectl, tmp_path):
+    """Returns a function that reads the stdin of the last 'kubectl apply -f -' call"""
+    return lambda: (tmp_path / "kubectl.log.stdin").read_text()
+
+
+@pytest.fixture
+def manifests(tmp_path):
+    files = []
+    for i in range(200):
+        kind = "Namespace" if i % 50 == 0 else "Deployment"
+        path = tmp_path / f"manifest-{i:03}.yaml"
+        path.write_text(f"apiVersion: v1\nkind: {kind}\nmetadata:\n  name: obj{i}\n")
+        files.append(str(path))
+    return files
+
+
+def _context(**config):
+    return Context(Config(overrides=dict({"run": {"hide": True, "in_stream": False}}, **config)))
+
+
+def test_apply_batched_parallel(fake_kubectl, manifests, tmp_path, monkeypatch, capsys):
+    k8s_tasks.apply(_context(), ",".join(manifests), batch=50)
+    calls = fake_kubectl()
+    # Namespaces go first, in their own call
+    assert calls[0].split() == ["apply"] + [arg for i in range(0, 200, 50)
+                                            for arg in ("-f", manifests[i])]
+    assert len(calls) == 5
+
+    inflight = tmp_path / "inflight"
+    inflight.mkdir()
+    monkeypatch.setenv("FAKE_KUBECTL_INFLIGHT", str(inflight))
+    k8s_tasks.apply(_context(), ",".join(manifests), batch=10, workers=4)
+    assert len(fake_kubectl()) == 5 + 1 + 20
+    # Calls run concurrently, never more than the workers
+    counts = [int(n) for n in (tmp_path / "kubectl.log.inflight").read_text().split()]
+    assert 1 < max(counts) <= 4
+    assert capsys.readouterr().out.count("configured") == 400
+
+
+def test_apply_batched_reports_failed_files(fake_kubectl, manifests, tmp_path, capsys):
+    bad = tmp_path / "bad.yaml"
+    bad.write_text("kind: Deployment\n")
+    with pytest.raises(Failure):
+        k8s_tasks.apply(_context(), ",".join(manifests[:10] + [str(bad)]), batch=5, workers=2)
+    assert capsys.readouterr().err.splitlines() == [f'{bad}: error: error validating "{bad}": invalid']
+
+
+def test_kdelete_batched_order(fake_kubectl, manifests, monkeypatch):
+    names = [manifests[0], manifests[1], "web-1", manifests[2], "web-2"]
+    monkeypatch.setattr("sys.stdin", io.StringIO("\n".join(names)))
+    k8s_tasks.kdelete(_context(), "-", batch=5, workers=2)
+    # Pods first, the Namespace after the objects that may live in it
+    assert [call.split() for call in fake_kubectl()] == [
+        ["delete", "pod", "web-1", "web-2"],
+        ["delete", "-f", manifests[1], "-f", manifests[2]],
+        ["delete", "-f", manifests[0]],
+    ]
+
+
+def test_config_from_dir_single_lookup(tmp_path, monkeypatch, fake_kubectl, kubectl_stdin):
+    monkeypatch.setattr(k8s_tasks, "_annotation_indexes", {})
+    config_dir = tmp_path / "config"
+    config_dir.mkdir()
+    (config_dir / "settings.ini").write_text("debug = false\n")
+    items = [{"metadata": {"name": f"cm{i}", "annotations": {"config-from-dir": f"/other/{i}/"}}}
+             for i in range(300)]
+    items.append({"metadata": {"name": "app-config",
+                               "annotations": {"config-from-dir": f"{config_dir}/"}}})
+    items.append({"metadata": {"name": "no-annotations"}})
+    c = MockContext(run={
+        "kubectl get configmap -o json": Result(json.dumps({"items": items})),
+    })
+    k8s_tasks.config_from_dir(c, str(config_dir))
+    assert c.run.call_count == 1
+    assert fake_kubectl() == ["apply -f -"]
+    manifest = yaml.safe_load(kubectl_stdin())
+    assert manifest["metadata"]["name"] == "app-config"
+    assert manifest["data"] == {"settings.ini": "debug = false\n"}
+    k8s_tasks.config_from_dir(c, str(config_dir))  # Index reused, only apply runs again
+    assert c.run.call_count == 1
+    assert len(fake_kubectl()) == 2
+
+
+def test_config_from_dir_streaming_shards(tmp_path, fake_kubectl, kubectl_stdin, monkeypatch,
+                                          capsys):
+    config_dir = tmp_path / "config"
+    (config_dir / "certs").mkdir(parents=True)
+    (config_dir / "README.md").write_text("skip me")
+    for i in range(3):
+        (config_dir / "certs" / f"{i}.pem").write_bytes(os.urandom(300 * 1024))
+    os.mkdir(config_dir / "empty-subdir")
+
+    with pytest.raises(Failure, match="--shard to split it in 2 objects"):
+        k8s_tasks.config_from_dir(_context(), "certs", str(config_dir), secret=True,
+                                  recursive=True, exclude=["*.md"])
+
+    # A previous run left 4 shards, the ones over the new count go away
+    live = [{"metadata": {"name": f"{name}-{i}",
+                          "annotations": {"config-from-dir-shard-of": name}}}
+            for name in ("certs", "other") for i in range(1, 4)]
+    (tmp_path / "live.json").write_text(json.dumps({"kind": "List", "items": live}))
+    monkeypatch.setenv("FAKE_KUBECTL_OUTPUT", str(tmp_path / "live.json"))
+    k8s_tasks.config_from_dir(_context(), "certs", str(config_dir), secret=True, recursive=True,
+                              exclude=["*.md"], shard=True)
+    assert fake_kubectl()[-1] == "delete secret certs-2 certs-3"
+    first, second = yaml.safe_load_all(kubectl_stdin())
+    assert first["metadata"] == {"name": "certs",
+                                 "annotations": {"config-from-dir": f"{config_dir}/"}}
+    assert list(first["data"]) == ["certs__0.pem", "certs__1.pem"]
+    assert second["metadata"]["name"] == "certs-1"
+    assert list(second["data"]) == ["certs__2.pem"]
+    assert base64.b64decode(second["data"]["certs__2.pem"]) == \
+        (config_dir / "certs" / "2.pem").read_bytes()
+
+
+def test_native_render(bin_dir, tmp_path):
+    install_stub(bin_dir, "ytt", FAKE_YTT)
+    template = tmp_path / "configmap.yaml"
+    template.write_text(k8s_tasks.YTT_CREATE_CONFIGMAP)
+    values = {"name": "app", "annotations": {"config-from-dir": "conf/"},
+              "files": {f"{i}.ini": f"key = {i}\n" for i in range(10)}}
+
+    k8s_tasks.run_ytt(_context(native_render=False), str(template), values,
+                      output_file=str(tmp_path / "ytt.yaml"))
+    assert (tmp_path / "ytt.yaml").read_text() == "apiVersion: v1\nkind: ConfigMap\n"
+
+    k8s_tasks.run_ytt(_context(), str(template), values, output_file=str(tmp_path / "out.yaml"))
+    manifest = yaml.safe_load((tmp_path / "out.yaml").read_text())
+    assert manifest == {"apiVersion": "v1", "kind": "ConfigMap",
+                        "metadata": {"name": "app", "annotations": {"config-from-dir": "conf/"}},
+                        "data": values["files"]}
+
+
+def test_native_render_secret():
+    rendered = k8s_tasks.render_native(k8s_tasks.YTT_CREATE_SECRET, {
+        "name": "creds", "annotations": {}, "files": {"token": "c2VjcmV0"}})
+    assert yaml.safe_load(rendered) == {"apiVersion": "v1", "kind": "Secret", "type": "Opaque",
+                                        "metadata": {"name": "creds", "annotations": {}},
+                                        "data": {"token": "c2VjcmV0"}}
+
+
+def test_generate_templates_incremental(bin_dir, fake_kubectl, tmp_path, monkeypatch, capsys):
+    # Outputs the values file, so the generated output follows the values
+    install_stub(bin_dir, "ytt", '#!/bin/sh\ncat "$4"\n')
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "deployment.yaml").write_text("#@ load('@ytt:data', 'data')\n")
+    files = [{"name": f"out/app{i}.yaml", "values": {"replicas": i}} for i in range(6)]
+    (tmp_path / "out").mkdir()
+    templates = {"deployment.yaml": {"values": {"image": "app:1.0"}, "files": files}}
+
+    def generate(**kargs):
+        c = _context(templates=templates)
+        k8s_tasks.generate_templates(c, incremental=True, workers=3, **kargs)
+        return capsys.readouterr().err.splitlines()[-1]
+
+    assert generate() == "6 of 6 outputs generated"
+    assert "replicas: 4" in (tmp_path / "out/app4.yaml").read_text()
+    # Generated without --apply before, so they are applied now
+    assert generate(apply=True) == "0 of 6 outputs generated"
+    assert fake_kubectl() == [" ".join(["apply"] + [f"-f out/app{i}.yaml" for i in range(6)])]
+    assert generate(apply=True) == "0 of 6 outputs generated"
+    assert len(fake_kubectl()) == 1
+
+    files[2]["values"]["replicas"] = 20
+    (tmp_path / "out/app5.yaml").write_text("edited by hand")
+    assert generate(apply=True) == "2 of 6 outputs generated"
+    assert fake_kubectl()[1:] == ["apply -f out/app2.yaml -f out/app5.yaml"]
+    assert "replicas: 20" in (tmp_path / "out/app2.yaml").read_text()
+
+    # A failed apply is retried by the next run, even if nothing changed
+    files[1]["values"]["replicas"] = 10
+    install_stub(bin_dir, "kubectl", "#!/bin/sh\nexit 1\n")
+    with pytest.raises(UnexpectedExit):
+        generate(apply=True)
+    install_stub(bin_dir, "kubectl", FAKE_KUBECTL)
+    assert generate(apply=True) == "0 of 6 outputs generated"
+    assert fake_kubectl()[2:] == ["apply -f out/app1.yaml"]
+
+
+def test_apply_diff_only_changed(tmp_path, fake_kubectl, kubectl_stdin, capsys):
+    manifest = tmp_path / "app.yaml"
+    manifest.write_text(yaml.safe_dump_all([
+        {"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": "same"}, "data": {"a": "1"}},
+        {"apiVersion": "apps/v1", "kind": "Deployment", "metadata": {"name": "web"},
+         "spec": {"replicas": 3}},
+        {"apiVersion": "v1", "kind": "Service", "metadata": {"name": "web", "namespace": "prod"}},
+    ]))
+    live = {"kind": "List", "items": [
+        {"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": "same", "uid": "1"},
+         "data": {"a": "1"}},
+        {"apiVersion": "apps/v1", "kind": "Deployment", "metadata": {"name": "web"},
+         "spec": {"replicas": 2, "strategy": {"type": "RollingUpdate"}}},
+    ]}
+    c = MockContext(run={
+        "kubectl get ConfigMap/same Deployment.v1.apps/web -o json --ignore-not-found":
+            Result(json.dumps(live)),
+        "kubectl get Service/web -n prod -o json --ignore-not-found": Result(""),
+    })
+    k8s_tasks.apply(c, str(manifest), diff=True)
+    assert capsys.readouterr().out.splitlines() == [
+        "changed  deployment/web", "new      service/web", "1 changed, 1 unchanged, 1 new"]
+    applied = list(yaml.safe_load_all(kubectl_stdin()))
+    assert [obj["kind"] for obj in applied] == ["Deployment", "Service"]
+
+
+def _pod(i):
+    waiting = {"waiting": {"reason": "CrashLoopBackOff"}} if i % 10 == 3 else {"running": {}}
+    return {"metadata": {"name": f"web-{i}", "namespace": "prod",
+                         "labels": {"app": "web", "tier": "front" if i % 2 else "back"}},
+            "spec": {"nodeName": f"node-{i % 4}", "containers": [{"image": f"web:{i % 3}"}]},
+            "status": {"phase": "Running", "containerStatuses": [{"state": waiting}]}}
+
+
+def test_kget_structured(tmp_path, fake_kubectl, monkeypatch, capsys):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(k8s_tasks.k8s_query, "STREAM_CHUNK_SIZE", 4096)
+    output = tmp_path / "pods.json"
+    output.write_text(json.dumps({"apiVersion": "v1", "kind": "List",
+                                  "items": [_pod(i) for i in range(2000)]}, indent=4))
+    monkeypatch.setenv("FAKE_KUBECTL_OUTPUT", str(output))
+
+    def kget(**kargs):
+        k8s_tasks.kget(_context(), **kargs)
+        return capsys.readouterr().out.splitlines()
+
+    lines = kget(status="crashloopbackoff", node="node-1", label="tier=front",
+                 columns="NAME=.metadata.name,IMAGE=.spec.containers[0].image,status",
+                 match=[r".metadata.name=^web-1.3$"])
+    assert lines[0].split() == ["NAME", "IMAGE", "STATUS"]
+    assert [line.split()[:2] for line in lines[1:]] == [
+        ["web-113", "web:2"], ["web-133", "web:1"], ["web-153", "web:0"], ["web-173", "web:2"],
+        ["web-193", "web:1"]]
+    assert fake_kubectl() == ["get pods -o json"]
+
+    # Same query within kget_cache_ttl doesn't run kubectl again
+    assert kget(status="crashloopbackoff", node="node-1", label="tier=front",
+                columns="NAME=.metadata.name,IMAGE=.spec.containers[0].image,status",
+                match=[r".metadata.name=^web-1.3$"]) == lines
+    assert len(fake_kubectl()) == 1
+
+    assert kget(structured=True, namespace="all", label="tier!=front", llist=True,
+                match=["web-19"])[:2] == ["web-190", "web-192"]
+    assert fake_kubectl()[-1] == "get pods --all-namespaces -o json"
+
+
+TOP_PODS = """NAMESPACE   NAME    CPU(cores)   MEMORY(bytes)
+prod        web-1   250m         512Mi
+prod        web-2   2            1Gi
+prod        db-1    1500m        2097152Ki
+staging     web-1   5m           {memory}
+"""
+
+
+def test_ktop_parsed(tmp_path, fake_kubectl, monkeypatch, capsys):
+    pods = [{"metadata": {"name": name, "namespace": ns, "labels": {"app": name[:-2]}},
+             "spec": {"nodeName": node}}
+            for ns, name, node in [("prod", "web-1", "n1"), ("prod", "web-2", "n2"),
+                                   ("prod", "db-1", "n1"), ("staging", "web-1", "n1")]]
+    output = tmp_path / "pods.json"
+    output.write_text(json.dumps({"kind": "List", "items": pods}))
+    monkeypatch.setenv("FAKE_KUBECTL_OUTPUT", str(output))
+    monkeypatch.setattr(k8s_tasks.time, "sleep", lambda seconds: None)
+    c = MockContext(run={"kubectl top pods --all-namespaces": [
+        Result(TOP_PODS.format(memory=memory)) for memory in ("1G", "1G", "100M", "200M")]})
+
+    def ktop(**kargs):
+        k8s_tasks.ktop(c, "pods", namespace="all", **kargs)
+        return [line.split() for line in capsys.readouterr().out.splitlines()]
+
+    assert ktop(sort="memory", cpu=1000) == [
+        ["NAMESPACE", "NAME", "CPU(cores)", "MEMORY(bytes)"],
+        ["prod", "db-1", "1500m", "2097152Ki"], ["prod", "web-2", "2", "1Gi"]]
+    assert ktop(group="app") == [["APP", "CPU(m)", "MEMORY(Mi)", "COUNT"],
+                                 ["web", "2255", "2490", "3"], ["db", "1500", "2048", "1"]]
+    assert fake_kubectl() == ["get pods --all-namespaces -o json"]
+    lines = ktop(group="namespace", watch=True, samples=2)
+    assert [line for line in lines if len(line) > 1] == [
+        ["NAMESPACE", "CPU(m)", "MEMORY(Mi)", "COUNT"],
+        ["prod", "3750", "3584", "3"], ["staging", "5", "95", "1"],
+        ["NAMESPACE", "CPU(m)", "MEMORY(Mi)", "COUNT", "CPU-DELTA", "MEMORY-DELTA"],
+        ["prod", "3750", "3584", "3", "+0", "+0"], ["staging", "5", "191", "1", "+0", "+95"]]
+
+
+def test_ktop_unknown_nodes(capsys):
+    c = MockContext(run=Result("""NAME   CPU(cores)   CPU%        MEMORY(bytes)   MEMORY%
+n1     250m         12%         1Gi             25%
+n2     <unknown>    <unknown>   <unknown>       <unknown>
+n3     1            50%         512Mi           12%
+"""))
+    k8s_tasks.ktop(c, sort="cpu")
+    assert [line.split()[0] for line in capsys.readouterr().out.splitlines()] == [
+        "NAME", "n3", "n1"]
+
+
+def test_logs_multiplex(bin_dir, tmp_path, monkeypatch, capsys):
+    pods = [{"metadata": {"name": f"web-{i}"}, "status": {"phase": phase},
+             "spec": {"containers": [{"name": "app"}]}}
+            for i, phase in enumerate(["Running", "Pending", "Running"])]
+    (tmp_path / "pods.json").write_text(json.dumps({"kind": "List", "items": pods}))
+    install_stub(bin_dir, "kubectl", f"""#!/bin/sh
+case "$1" in
+  get) [ "$*" = "get pods -l app=web -o json" ] && cat {tmp_path}/pods.json;;
+  logs) echo "GET /health from $2"; echo "POST /login from $2";;
+esac
+""")
+    k8s_tasks.logs(_context(), "web", app=True, exclude="health")
+    assert sorted(capsys.readouterr().out.splitlines()) == [
+        "web-0 POST /login from web-0", "web-2 POST /login from web-2"]
+
+
+def test_logs_include_single_pod(bin_dir, tmp_path, capsys):
+    pod = {"kind": "Pod", "metadata": {"name": "web-1"}, "status": {"phase": "Running"},
+           "spec": {"containers": [{"name": "app"}], "volumes": [
+               {"name": "kube-api-access", "projected": {"sources": [{"configMap": {
+                   "name": "kube-root-ca.crt",
+                   "items": [{"key": "ca.crt", "path": "ca.crt"}]}}]}}]}}
+    (tmp_path / "pod.json").write_text(json.dumps(pod, indent=4))
+    install_stub(bin_dir, "kubectl", f"""#!/bin/sh
+case "$1" in
+  get) [ "$*" = "get pods web-1 -o json" ] && cat {tmp_path}/pod.json;;
+  logs) echo "GET /health from $2"; echo "POST /login from $2";;
+esac
+""")
+    k8s_tasks.logs(_context(), "web-1", include="login")
+    assert capsys.readouterr().out.splitlines() == ["web-1 POST /login from web-1"]
+
+
+def test_logs_multiplex_namespaces(bin_dir, tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    pods = {namespace: {"kind": "Pod", "status": {"phase": "Running"},
+                        "metadata": {"name": "web-1", "namespace": namespace,
+                                     "creationTimestamp": "2026-01-01T10:00:00Z"},
+                        "spec": {"containers": [{"name": "app"}]}}
+            for namespace in ("prod", "staging")}
+    (tmp_path / "prod.json").write_text(json.dumps({"kind": "List", "items": [pods["prod"]]}))
+    (tmp_path / "staging.json").write_text(json.dumps(pods["staging"]))
+    (tmp_path / "all.json").write_text(json.dumps({"kind": "List", "items": list(pods.values())}))
+    install_stub(bin_dir, "kubectl", f"""#!/bin/sh
+case "$*" in
+  "get pods -l app=web -n=prod -o json") cat {tmp_path}/prod.json;;
+  "get pods -l app=web --all-namespaces -o json") cat {tmp_path}/all.json;;
+  "get pods --all-namespaces -o json") cat {tmp_path}/all.json;;
+  "get pods web-1 -n=staging -o json") cat {tmp_path}/staging.json;;
+  logs*) echo "$*";;
+esac
+""")
+    k8s_tasks.logs(_context(), "web", app=True, namespace="prod", multiplex=True)
+    assert capsys.readouterr().out.splitlines() == ["web-1 logs web-1 -c app -n prod"]
+
+    k8s_tasks.logs(_context(), "web", app=True, namespace="all", multiplex=True)
+    assert sorted(capsys.readouterr().out.splitlines()) == [
+        "web-1 logs web-1 -c app -n prod", "web-1 logs web-1 -c app -n staging"]
+
+    pods["prod"]["metadata"]["creationTimestamp"] = "2025-01-01T10:00:00Z"
+    (tmp_path / "all.json").write_text(json.dumps({"kind": "List", "items": list(pods.values())}))
+    k8s_tasks.logs(_context(), "web-1", zfuzzy=True, namespace="all", include="logs")
+    assert capsys.readouterr().out.splitlines() == ["web-1 logs web-1 -c app -n staging"]
+
+
+def test_fuzzy_find_pod_index(tmp_path, fake_kubectl, monkeypatch, capsys):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    pods = [("web-7d9f8c6b5d-x2k4q", "Running", "2026-01-01T10:00:00Z"),
+            ("web-7d9f8c6b5d-a8b7c", "Running", "2026-01-02T10:00:00Z"),
+            ("web-5f6d7c8b9a-zz9zz", "Pending", "2026-01-03T10:00:00Z"),
+            ("web-admin-6c7d8e9f0a-q1w2e", "Running", "2026-01-04T10:00:00Z"),
+            ("db-0", "Running", "2026-01-01T10:00:00Z")]
+    output = tmp_path / "pods.json"
+    output.write_text(json.dumps({"kind": "List", "items": [
+        {"metadata": {"name": name, "namespace": "prod", "creationTimestamp": created},
+         "status": {"phase": phase}} for name, phase, created in pods]}))
+    monkeypatch.setenv("FAKE_KUBECTL_OUTPUT", str(output))
+    c = _context()
+
+    assert k8s_tasks._fuzzy_find_pod(c, "db-0") == "db-0"
+    # web- prefixes every pod but web-admin, workload name web picks the newest Running
+    assert k8s_tasks._fuzzy_find_pod(c, "web") == "web-7d9f8c6b5d-a8b7c"
+    assert "also matching: web-7d9f8c6b5d-x2k4q, web-5f6d7c8b9a-zz9zz" in capsys.readouterr().err
+    assert k8s_tasks._fuzzy_find_pod(c, "admin") == "web-admin-6c7d8e9f0a-q1w2e"
+    with pytest.raises(Failure, match="cache not found"):
+        k8s_tasks._fuzzy_find_pod(c, "cache")
+    assert fake_kubectl() == ["get pods -o json"]  # The index is cached pod_index_ttl seconds
+
+    assert k8s_tasks._fuzzy_find_pod(c, "db", namespace="all") == "db-0 -n=prod"
+    assert fake_kubectl()[1:] == ["get pods --all-namespaces -o json"]
+
+
+def _deployment(name, generation, observed, replicas, updated, ready):
+    return {"apiVersion": "apps/v1", "kind": "Deployment",
+            "metadata": {"name": name, "namespace": "prod", "generation": generation},
+            "spec": {"replicas": 2},
+            "status": {"observedGeneration": observed, "replicas": replicas,
+                       "updatedReplicas": updated, "readyReplicas": ready,
+                       "availableReplicas": ready}}
+
+
+def test_krollout_no_names():
+    c = MockContext(run=Result(), repeat=True)
+    k8s_tasks.krollout(c, ",", wait=True)
+    assert c.run.call_count == 0
+
+
+def test_krollout_wait(bin_dir, tmp_path, capsys):
+    events = [_deployment("web", 2, 1, 2, 2, 2), _deployment("api", 5, 5, 3, 1, 2),
+              _deployment("web", 2, 2, 3, 1, 2), _deployment("web", 2, 2, 3, 1, 3),
+              _deployment("web", 2, 2, 2, 2, 2), _deployment("api", 5, 5, 3, 1, 3)]
+    watch = tmp_path / "watch"
+    watch.mkdir()
+    for i, event in enumerate(events):
+        (watch / f"{i}.json").write_text(json.dumps(event, indent=4) + "\n")
+    install_stub(bin_dir, "kubectl", f"""#!/bin/sh
+echo "$*" >> {tmp_path}/kubectl.log
+case "$*" in
+  rollout*) echo "$3 restarted";;
+  *--watch*)
+    for f in {watch}/*.json; do cat $f; sleep 0.05; done
+    sleep 1; exit 1;;  # Like kubectl when --request-timeout ends the watch
+esac
+""")
+
+    with pytest.raises(Failure, match="Rollout of deployment/api didn't finish"):
+        k8s_tasks.krollout(_context(), "web,api", namespace="prod", wait=True, timeout=1)
+    assert sorted((tmp_path / "kubectl.log").read_text().splitlines()) == [
+        "get deployment -n=prod -o json --watch --request-timeout=1s",
+        "rollout restart deployment/api -n prod", "rollout restart deployment/web -n prod"]
+    out = capsys.readouterr().out.splitlines()
+    progress = [line.split("s ", 1)[1] for line in out if line.lstrip()[:1].isdigit()]
+    assert progress[-2:] == [
+        "deployment/web rolled out | deployment/api 1/2 updated, 2/2 ready, 2/2 available",
+        "deployment/web rolled out | deployment/api 1/2 updated, 3/2 ready, 3/2 available"]
+    summary = [line.split() for line in out[-3:]]
+    assert summary[0] == ["ROLLOUT", "STATUS", "FIRST", "READY", "ROLLED", "OUT"]
+    assert summary[1][:3] == ["deployment/web", "rolled", "out"]
+    assert float(summary[1][3][:-1]) <= float(summary[1][4][:-1]) < 1
+    assert summary[2][:3] + summary[2][4:] == ["deployment/api", "timed", "out", "-"]
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+from invoke import Config, MockContext, Result
+
+from py_docker_k8s_tasks import docker_tasks, k8s_tasks, profiling
+
+
+@pytest.fixture
+def profiler(monkeypatch):
+    """A fresh profiler that doesn't report at exit"""
+    profiler = profiling.Profiler()
+    monkeypatch.setattr(profiling, "profiler", profiler)
+    monkeypatch.setattr(profiling.atexit, "register", lambda fn: None)
+    return profiler
+
+
+def test_profiling_disabled(profiler):
+    c = MockContext(run=Result("pods\n"), repeat=True)
+    k8s_tasks.kubectl(c, "get pods")
+    assert not profiler.active and profiler.calls == []
+
+
+def test_profiling(profiler, tmp_path, capsys):
+    trace_file = tmp_path / "trace.json"
+    config = Config(overrides={"profile_trace": str(trace_file), "container": "web"})
+    c = MockContext(config=config, run={
+        "kubectl get pods -o name": Result("pod/a\npod/b\n"),
+        "kubectl get svc": Result("svc/a\n"),
+        "kubectl delete pod/x": Result(exited=1),
+        "docker exec -it  web ./manage.py migrate": Result(),
+    })
+    k8s_tasks.kubectl(c, "get pods -o name")
+    k8s_tasks.kubectl(c, "get svc")
+    k8s_tasks.kubectl(c, "delete pod/x", warn=True)
+    docker_tasks.docker_exec(c, "./manage.py migrate")
+
+    rows = {(kind, name): (calls, failed, stdout_bytes)
+            for kind, name, calls, _, _, failed, stdout_bytes in profiler.summary()}
+    assert rows == {
+        ("kubectl", "kubectl get"): (2, 0, 18),
+        ("kubectl", "kubectl delete"): (1, 1, 0),
+        ("docker exec", "./manage.py migrate"): (1, 0, 0),
+    }
+
+    profiler.report()
+    lines = capsys.readouterr().err.splitlines()
+    assert lines[0].split() == ["KIND", "COMMAND", "CALLS", "TOTAL", "MEAN", "MAX", "FAILED",
+                                "STDOUT"]
+    assert lines[-1] == f"Trace written to {trace_file}"
+
+    events = json.loads(trace_file.read_text())["traceEvents"]
+    assert [(e["cat"], e["name"], e["args"]["command"], e["args"]["exited"]) for e in events] == [
+        ("kubectl", "kubectl get", "get pods -o name", 0),
+        ("kubectl", "kubectl get", "get svc", 0),
+        ("kubectl", "kubectl delete", "delete pod/x", 1),
+        ("docker exec", "./manage.py migrate", "./manage.py migrate", 0),
+    ]
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in events)
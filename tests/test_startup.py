@@ -0,0 +1,46 @@
+import re
+import sys
+import subprocess
+
+# Import time of the task modules and what they import, once invoke is loaded, in
+# milliseconds. About 50ms when this was set
+STARTUP_BUDGET_MS = 100
+# Only imported by the tasks that use them
+DEFERRED_MODULES = ["requests", "urllib3", "http.client", "tarfile",
+                    "py_docker_k8s_tasks.k8s_api", "py_docker_k8s_tasks.docker_engine",
+                    "py_docker_k8s_tasks.docker_sync"]
+IMPORT_TIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+# invoke is imported first, so the package imports below don't include its time
+LOAD_TASKS = """
+from invoke import Collection
+from py_docker_k8s_tasks import django_tasks, docker_tasks, k8s_tasks, util_tasks
+ns = Collection()
+for module in (django_tasks, docker_tasks, k8s_tasks, util_tasks):
+    util_tasks.add_tasks(ns, module)
+"""
+
+
+def _import_times():
+    """{module: (self_us, cumulative_us, depth)} from python -X importtime loading the tasks"""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", LOAD_TASKS],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+    times = {}
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            times[module] = (int(self_us), int(cumulative_us), len(indent) // 2)
+    return times
+
+
+def test_startup_budget():
+    times = _import_times()
+    assert [module for module in DEFERRED_MODULES if module in times] == []
+
+    assert times["invoke"][2] == 0
+    own_ms = sum(cumulative for module, (_, cumulative, depth) in times.items()
+                 if depth == 0 and module.startswith("py_docker_k8s_tasks")) / 1000
+    slowest = sorted(times.items(), key=lambda item: item[1][0], reverse=True)[:10]
+    report = "\n".join(f"{self_us / 1000:8.1f}ms {module}" for module, (self_us, _, _) in slowest)
+    assert own_ms < STARTUP_BUDGET_MS, f"{own_ms:.1f}ms loading the tasks, slowest:\n{report}"
@@ -0,0 +1,40 @@
+import re
+from invoke import Collection
+from py_docker_k8s_tasks import docker_tasks, k8s_tasks, util_tasks
+from py_docker_k8s_tasks.util_tasks import add_tasks, compile_filter
+
+
+def test_compile_filter():
+    names = ["kget", "kshell", "klogs", "logs", "docker_exec", "export_env"]
+
+    def passing(filter):
+        matches = compile_filter(filter)
+        return [name for name in names if matches(name)]
+
+    assert passing(None) == names
+    assert passing("logs") == ["logs"]
+    assert passing("k*") == ["kget", "kshell", "klogs"]
+    assert passing(re.compile("k.*s")) == ["kshell", "klogs"]
+    assert passing(re.compile("KGET", re.IGNORECASE)) == ["kget"]
+    assert passing([re.compile("(?i)KGET"), re.compile("(?x) docker _ exec"), "k*s*"]) == [
+        "kget", "kshell", "klogs", "docker_exec"]
+    assert passing(["logs", "k*", "!kshell"]) == ["kget", "klogs", "logs"]
+    assert passing(["!k*", "!*_env"]) == ["logs", "docker_exec"]
+    assert passing([re.compile("docker"), "export_env"]) == ["docker_exec", "export_env"]
+    assert passing([]) == []
+
+
+def test_add_tasks():
+    ns = Collection()
+    add_tasks(ns, [k8s_tasks, docker_tasks, util_tasks], filter=["k*", "docker_put", "!kshell"],
+              aliases={"kget": ["get", "g"], "docker_put": "dput"})
+    assert "kget" in ns.task_names and "kshell" not in ns.task_names
+    assert ns["get"] is ns["g"] is k8s_tasks.kget
+    assert ns["dput"] is docker_tasks.docker_put
+    assert "sleep" not in ns.task_names
+
+    add_tasks(ns, util_tasks, filter="sleep", collection=["util", "u"])
+    add_tasks(ns, util_tasks, filter="export_env", collection="u")
+    assert ns.collections["util"] is ns.collections["u"]
+    assert sorted(ns.collections["util"].task_names) == ["export-env", "sleep"]
+    assert ns["u.sleep"] is util_tasks.sleep